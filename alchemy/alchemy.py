@@ -33,8 +33,20 @@ TODO
 #=============================================================================================
 
 import numpy as np
+import math
+import re
 import copy
+import collections
 import time
+import weakref
+import os
+import gzip
+import pickle
+import hashlib
+import itertools
+import threading
+import multiprocessing
+from xml.etree import ElementTree
 
 import simtk.openmm as openmm
 import simtk.unit as unit
@@ -49,66 +61,2174 @@ logger = logging.getLogger(__name__)
 ONE_4PI_EPS0 = 138.935456 # OpenMM constant for Coulomb interactions (openmm/platforms/reference/include/SimTKOpenMMRealType.h) in OpenMM units
                           # TODO: Replace this with an import from simtk.openmm.constants once these constants are available there
 
+kB = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA # Boltzmann constant
+
 #=============================================================================================
 # MODULE UTILITIES
 #=============================================================================================
 
-def _is_periodic(system):
+def _is_periodic(system):
+    """
+    Determine whether the specified system is periodic.
+
+    Parameters
+    ----------
+    system : simtk.openmm.System
+         The system to check.
+
+    Returns
+    -------
+    is_periodic : bool
+        If True, the system uses a nonbonded method recognized as being periodic.
+
+    Examples
+    --------
+
+    >>> from openmmtools import testsystems
+
+    Periodic water box.
+
+    >>> waterbox = testsystems.WaterBox()
+    >>> print(_is_periodic(waterbox.system))
+    True
+
+    Non-periodic Lennard-Jones cluster.
+
+    >>> cluster = testsystems.LennardJonesCluster()
+    >>> print(_is_periodic(cluster.system))
+    False
+
+    Notes
+    -----
+    This method simply checks to see if any nonbonded methods recognized to be periodic are in use.
+    Addition of new nonbonded methods or force types may require adding to recognized_periodic_methods.
+
+    """
+    forces = { system.getForce(index).__class__.__name__ for index in range(system.getNumForces()) }
+
+    # Only the following nonbonded methods are recognized as being periodic.
+    recognized_periodic_methods = {
+        'NonbondedForce' : [openmm.NonbondedForce.CutoffPeriodic, openmm.NonbondedForce.Ewald, openmm.NonbondedForce.PME],
+        'CustomNonbondedForce' : [openmm.CustomNonbondedForce.CutoffPeriodic],
+        'AmoebaVdwForce' : [openmm.AmoebaVdwForce.CutoffPeriodic],
+        }
+
+    for force_index in range(system.getNumForces()):
+        force = system.getForce(force_index)
+        force_name = force.__class__.__name__
+        if force_name in recognized_periodic_methods:
+            method = force.getNonbondedMethod()
+            if method in recognized_periodic_methods[force_name]:
+                return True
+
+    # Nothing we recognize was found, so assume system was not periodic.
+    return False
+
+#=============================================================================================
+# FORCE PARAMETER TABLES
+#=============================================================================================
+
+# Columnar (NumPy structured array) layouts for reference force parameters.
+# All quantities are stored as floats in the OpenMM (md_unit_system) unit system.
+_NONBONDED_PARTICLE_DTYPE = np.dtype([('charge', np.float64), ('sigma', np.float64), ('epsilon', np.float64)])
+_NONBONDED_EXCEPTION_DTYPE = np.dtype([('particle1', np.int32), ('particle2', np.int32),
+                                       ('chargeprod', np.float64), ('sigma', np.float64), ('epsilon', np.float64)])
+_GBSAOBC_PARTICLE_DTYPE = np.dtype([('charge', np.float64), ('radius', np.float64), ('scale', np.float64)])
+_BOND_DTYPE = np.dtype([('particle1', np.int32), ('particle2', np.int32), ('length', np.float64), ('k', np.float64)])
+_ANGLE_DTYPE = np.dtype([('particle1', np.int32), ('particle2', np.int32), ('particle3', np.int32),
+                         ('theta0', np.float64), ('k', np.float64)])
+_TORSION_DTYPE = np.dtype([('particle1', np.int32), ('particle2', np.int32), ('particle3', np.int32), ('particle4', np.int32),
+                           ('periodicity', np.int32), ('phase', np.float64), ('k', np.float64)])
+
+def _strip_units(quantity):
+    """
+    Return the value of a quantity in the OpenMM (md_unit_system) unit system as a float.
+
+    """
+    if unit.is_quantity(quantity):
+        return quantity.value_in_unit_system(unit.md_unit_system)
+    return quantity
+
+def _tabulate_nonbonded_force(force):
+    particles = [ tuple(_strip_units(value) for value in force.getParticleParameters(index))
+                  for index in range(force.getNumParticles()) ]
+    exceptions = list()
+    for index in range(force.getNumExceptions()):
+        [iatom, jatom, chargeprod, sigma, epsilon] = force.getExceptionParameters(index)
+        exceptions.append((iatom, jatom, _strip_units(chargeprod), _strip_units(sigma), _strip_units(epsilon)))
+    return { 'particles' : np.array(particles, dtype=_NONBONDED_PARTICLE_DTYPE),
+             'exceptions' : np.array(exceptions, dtype=_NONBONDED_EXCEPTION_DTYPE) }
+
+def _tabulate_gbsaobc_force(force):
+    particles = [ tuple(_strip_units(value) for value in force.getParticleParameters(index))
+                  for index in range(force.getNumParticles()) ]
+    return { 'particles' : np.array(particles, dtype=_GBSAOBC_PARTICLE_DTYPE) }
+
+def _tabulate_harmonic_bond_force(force):
+    bonds = list()
+    for index in range(force.getNumBonds()):
+        [particle1, particle2, length, k] = force.getBondParameters(index)
+        bonds.append((particle1, particle2, _strip_units(length), _strip_units(k)))
+    return { 'bonds' : np.array(bonds, dtype=_BOND_DTYPE) }
+
+def _tabulate_harmonic_angle_force(force):
+    angles = list()
+    for index in range(force.getNumAngles()):
+        [particle1, particle2, particle3, theta0, k] = force.getAngleParameters(index)
+        angles.append((particle1, particle2, particle3, _strip_units(theta0), _strip_units(k)))
+    return { 'angles' : np.array(angles, dtype=_ANGLE_DTYPE) }
+
+def _tabulate_periodic_torsion_force(force):
+    torsions = list()
+    for index in range(force.getNumTorsions()):
+        [particle1, particle2, particle3, particle4, periodicity, phase, k] = force.getTorsionParameters(index)
+        torsions.append((particle1, particle2, particle3, particle4, periodicity, _strip_units(phase), _strip_units(k)))
+    return { 'torsions' : np.array(torsions, dtype=_TORSION_DTYPE) }
+
+_FORCE_TABULATORS = {
+    'NonbondedForce' : _tabulate_nonbonded_force,
+    'GBSAOBCForce' : _tabulate_gbsaobc_force,
+    'HarmonicBondForce' : _tabulate_harmonic_bond_force,
+    'HarmonicAngleForce' : _tabulate_harmonic_angle_force,
+    'PeriodicTorsionForce' : _tabulate_periodic_torsion_force,
+    }
+
+def _tabulate_force(force):
+    """
+    Extract the parameters of a force into columnar NumPy structured arrays.
+
+    Each parameter getter is called exactly once per term, so that all subsequent processing
+    (selection of alchemical terms, parameter fixes, zeroing) can be done with array operations.
+
+    Parameters
+    ----------
+    force : simtk.openmm.Force
+        The force whose parameters are to be tabulated.
+
+    Returns
+    -------
+    tables : dict of str : numpy.ndarray, or None
+        tables[name] is a structured array of the terms of the given kind (e.g. 'particles', 'exceptions',
+        'bonds', 'angles', 'torsions'), in OpenMM units.  None is returned if the force type is not supported.
+
+    """
+    force_name = force.__class__.__name__
+    if force_name not in _FORCE_TABULATORS:
+        return None
+    return _FORCE_TABULATORS[force_name](force)
+
+def _term_particles(terms, nparticles):
+    """
+    Return the particle index columns of a term table as an (nterms, nparticles) integer array.
+
+    """
+    return np.column_stack([ terms['particle%d' % (index+1)] for index in range(nparticles) ]) if len(terms) else np.zeros([0, nparticles], np.int32)
+
+def _append_field(table, name, values):
+    """
+    Return a copy of a structured array with an additional float column.
+
+    Parameters
+    ----------
+    table : numpy structured array
+        The table to extend.
+    name : str
+        Name of the new column.
+    values : numpy array
+        Values of the new column.
+
+    """
+    dtype = np.dtype([ (field, table.dtype.fields[field][0]) for field in table.dtype.names ] + [(name, np.float64)])
+    result = np.zeros([len(table)], dtype)
+    for field in table.dtype.names:
+        result[field] = table[field]
+    result[name] = values
+    return result
+
+#=============================================================================================
+# MOLECULAR GRAPH
+#=============================================================================================
+
+class MolecularGraph(object):
+    """
+    Index of the covalent bond graph of a System in compressed sparse row (CSR) form.
+
+    The neighbors of particle i are `indices[indptr[i]:indptr[i+1]]`, in ascending order.  Bond, properness, and
+    neighborhood queries operate on arrays of particles at once, so that selecting alchemical bonds, angles, and torsions
+    or the atoms near a ligand does not require per-term Python loops, even for systems with hundreds of thousands of atoms.
+
+    Examples
+    --------
+
+    Select all atoms within three bonds of the first residue of alanine dipeptide.
+
+    >>> from openmmtools import testsystems
+    >>> testsystem = testsystems.AlanineDipeptideVacuum()
+    >>> graph = MolecularGraph.fromSystem(testsystem.system)
+    >>> atoms = graph.withinBonds(range(0,6), 3)
+
+    """
+
+    def __init__(self, nparticles, bonds):
+        """
+        Build the bond graph from a list of bonds.
+
+        Parameters
+        ----------
+        nparticles : int
+            The number of particles.
+        bonds : numpy array of int of shape (nbonds, 2)
+            The bonded particle pairs; duplicates, orientation, and self-bonds are ignored.
+
+        """
+        self.nparticles = nparticles
+        bonds = np.asarray(bonds, np.int64).reshape([-1, 2])
+        bonds = bonds[bonds[:,0] != bonds[:,1]]
+        # Store both orientations of each bond as sorted unique keys (particle1 * nparticles + particle2).
+        keys = np.unique(np.concatenate([bonds[:,0] * nparticles + bonds[:,1], bonds[:,1] * nparticles + bonds[:,0]]))
+        self._keys = keys
+        self._rows = keys // nparticles
+        self.indices = (keys % nparticles).astype(np.int32)
+        self.indptr = np.searchsorted(self._rows, np.arange(nparticles + 1)).astype(np.int64)
+
+    @classmethod
+    def fromSystem(cls, system, force_tables=None):
+        """
+        Build the bond graph of a System from its HarmonicBondForce and CustomBondForce bonds and its constraints.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The system for which bonds are to be indexed.
+        force_tables : list, optional, default=None
+            If provided, columnar tables of the forces of `system` (see `_tabulate_force`), used to avoid extracting
+            HarmonicBondForce parameters again.
+
+        Returns
+        -------
+        graph : MolecularGraph
+            The bond graph.
+
+        """
+        bonds = list()
+        for force_index in range(system.getNumForces()):
+            force = system.getForce(force_index)
+            force_name = force.__class__.__name__
+            if force_name == 'HarmonicBondForce':
+                table = force_tables[force_index] if (force_tables is not None) else _tabulate_harmonic_bond_force(force)
+                bonds.append(_term_particles(table['bonds'], 2))
+            elif force_name == 'CustomBondForce':
+                bonds.append(np.array([ force.getBondParameters(index)[:2] for index in range(force.getNumBonds()) ], np.int64).reshape([-1, 2]))
+        bonds.append(np.array([ system.getConstraintParameters(index)[:2] for index in range(system.getNumConstraints()) ], np.int64).reshape([-1, 2]))
+        return cls(system.getNumParticles(), np.concatenate(bonds))
+
+    def neighbors(self, particle):
+        """
+        Return the particles bonded to a particle, in ascending order.
+
+        """
+        return self.indices[self.indptr[particle]:self.indptr[particle+1]]
+
+    def areBonded(self, particles1, particles2):
+        """
+        Determine whether pairs of particles are bonded.
+
+        Parameters
+        ----------
+        particles1, particles2 : numpy array of int
+            The particles of each pair.
+
+        Returns
+        -------
+        bonded : numpy array of bool
+            bonded[i] is True if particles1[i] and particles2[i] are bonded.
+
+        """
+        keys = np.asarray(particles1, np.int64) * self.nparticles + np.asarray(particles2, np.int64)
+        positions = np.minimum(np.searchsorted(self._keys, keys), max(len(self._keys) - 1, 0))
+        return (self._keys[positions] == keys) if len(self._keys) else np.zeros(keys.shape, bool)
+
+    def isProperTorsion(self, particles):
+        """
+        Determine whether torsions are proper, i.e. whether their particles form a chain of three bonds.
+
+        Parameters
+        ----------
+        particles : numpy array of int of shape (ntorsions, 4)
+            The particles of each torsion.
+
+        Returns
+        -------
+        proper : numpy array of bool
+            proper[i] is True if torsion i is proper.
+
+        """
+        particles = np.asarray(particles).reshape([-1, 4])
+        return self.areBonded(particles[:,0], particles[:,1]) & self.areBonded(particles[:,1], particles[:,2]) & self.areBonded(particles[:,2], particles[:,3])
+
+    def withinBondsMask(self, particles, nbonds):
+        """
+        Return a boolean mask of the particles separated from any of the specified particles by at most `nbonds` bonds.
+
+        """
+        mask = np.zeros([self.nparticles], bool)
+        mask[np.asarray(list(particles), np.int64)] = True
+        for iteration in range(nbonds):
+            # Expand the frontier along all bonds starting from a selected particle.
+            expanded = mask.copy()
+            expanded[self.indices[mask[self._rows]]] = True
+            if np.array_equal(expanded, mask):
+                break
+            mask = expanded
+        return mask
+
+    def withinBonds(self, particles, nbonds):
+        """
+        Return the particles separated from any of the specified particles by at most `nbonds` bonds.
+
+        Parameters
+        ----------
+        particles : list of int
+            The particles from which to start, e.g. the ligand atoms.
+        nbonds : int
+            The maximum number of bonds separating a selected particle from the specified particles.
+
+        Returns
+        -------
+        selected : numpy array of int
+            The selected particles (including `particles`), in ascending order.
+
+        """
+        return np.where(self.withinBondsMask(particles, nbonds))[0]
+
+#=============================================================================================
+# SYSTEM BUILDERS
+#=============================================================================================
+
+# Layout of the terms of each supported force type, keyed by (force class name, term kind).
+# Each entry is (XML container element, XML term element, XML particle index attributes, XML parameter attributes, add method, set method),
+# where the XML names are those of the serialized force.  Parameter attributes of None denote per-term parameter lists
+# of Custom*Force objects, serialized as 'param1', 'param2', ...
+# Term rows are tuples of particle indices followed by parameters, in the order accepted by the add method.
+_TERM_LAYOUTS = {
+    ('HarmonicBondForce', 'bonds') : ('Bonds', 'Bond', ('p1', 'p2'), ('d', 'k'), 'addBond', 'setBondParameters'),
+    ('HarmonicAngleForce', 'angles') : ('Angles', 'Angle', ('p1', 'p2', 'p3'), ('a', 'k'), 'addAngle', 'setAngleParameters'),
+    ('PeriodicTorsionForce', 'torsions') : ('Torsions', 'Torsion', ('p1', 'p2', 'p3', 'p4'), ('periodicity', 'phase', 'k'), 'addTorsion', 'setTorsionParameters'),
+    ('NonbondedForce', 'particles') : ('Particles', 'Particle', (), ('q', 'sig', 'eps'), 'addParticle', 'setParticleParameters'),
+    ('NonbondedForce', 'exceptions') : ('Exceptions', 'Exception', ('p1', 'p2'), ('q', 'sig', 'eps'), 'addException', 'setExceptionParameters'),
+    ('GBSAOBCForce', 'particles') : ('Particles', 'Particle', (), ('q', 'r', 'scale'), 'addParticle', 'setParticleParameters'),
+    ('CustomNonbondedForce', 'particles') : ('Particles', 'Particle', (), None, 'addParticle', 'setParticleParameters'),
+    ('CustomNonbondedForce', 'exclusions') : ('Exclusions', 'Exclusion', ('p1', 'p2'), (), 'addExclusion', None),
+    ('CustomGBForce', 'particles') : ('Particles', 'Particle', (), None, 'addParticle', 'setParticleParameters'),
+    ('CustomBondForce', 'bonds') : ('Bonds', 'Bond', ('p1', 'p2'), None, 'addBond', 'setBondParameters'),
+    ('CustomAngleForce', 'angles') : ('Angles', 'Angle', ('p1', 'p2', 'p3'), None, 'addAngle', 'setAngleParameters'),
+    ('CustomTorsionForce', 'torsions') : ('Torsions', 'Torsion', ('p1', 'p2', 'p3', 'p4'), None, 'addTorsion', 'setTorsionParameters'),
+    }
+
+# Term kinds and table dtypes of the reference force types that can be tabulated.
+_TABLE_LAYOUTS = {
+    'NonbondedForce' : [('particles', _NONBONDED_PARTICLE_DTYPE), ('exceptions', _NONBONDED_EXCEPTION_DTYPE)],
+    'GBSAOBCForce' : [('particles', _GBSAOBC_PARTICLE_DTYPE)],
+    'HarmonicBondForce' : [('bonds', _BOND_DTYPE)],
+    'HarmonicAngleForce' : [('angles', _ANGLE_DTYPE)],
+    'PeriodicTorsionForce' : [('torsions', _TORSION_DTYPE)],
+    }
+
+def _set_force_terms(force, kind, indices, rows):
+    """
+    Set the parameters of existing terms of a force.
+
+    Parameters
+    ----------
+    force : simtk.openmm.Force
+        The force to modify.
+    kind : str
+        The kind of term (e.g. 'particles', 'bonds'), as in `_TERM_LAYOUTS`.
+    indices : list of int
+        Indices of the terms to modify.
+    rows : list of tuple
+        Term rows (particle indices followed by parameters) for each modified term.
+
+    """
+    (container_name, term_name, index_attributes, parameter_attributes, add_method, set_method) = _TERM_LAYOUTS[(force.__class__.__name__, kind)]
+    set_parameters = getattr(force, set_method)
+    nindices = len(index_attributes)
+    for (index, row) in zip(indices, rows):
+        if parameter_attributes is None:
+            set_parameters(int(index), *(tuple(row[:nindices]) + (list(row[nindices:]),)))
+        else:
+            set_parameters(int(index), *row)
+
+class _RegionTermRows(object):
+    """
+    Picklable function returning the rows of terms whose parameters depend on the alchemical region (see `_addRegionTerms`).
+
+    A term is alchemical if all (or, if `reduction` is 'any', any) of its particles are alchemical.  The rows are the
+    term table with an 'alchemical' column flagging alchemical terms or, if `zeroed_fields` is given, the term table with
+    these fields set to zero for alchemical terms.
+
+    Parameters
+    ----------
+    terms : numpy structured array
+        The term table.
+    particles : numpy array of int
+        The (nterms, nparticles) particle indices of each term.
+    reduction : str, optional, default='all'
+        'all' or 'any'.
+    zeroed_fields : list of str, optional, default=None
+        Fields set to zero for alchemical terms instead of adding an 'alchemical' column.
+
+    """
+    def __init__(self, terms, particles, reduction='all', zeroed_fields=None):
+        self.terms = terms.copy()
+        self.particles = particles
+        self.reduction = reduction
+        self.zeroed_fields = zeroed_fields
+
+    def __call__(self, alchemical_atom_mask):
+        alchemical = getattr(np, self.reduction)(alchemical_atom_mask[self.particles], axis=1)
+        if self.zeroed_fields is None:
+            return _append_field(self.terms, 'alchemical', alchemical)
+        rows = self.terms.copy()
+        for field in self.zeroed_fields:
+            rows[field][alchemical] = 0.0
+        return rows
+
+class _SystemBuilder(object):
+    """
+    Assemble an alchemically-modified System through the OpenMM Python API.
+
+    Forces are added as term-less definitions (expressions, parameters, and settings) together with their terms,
+    which are added one call at a time.
+
+    """
+    def __init__(self, reference_system):
+        self.reference_system = reference_system
+
+        # Create new system to modify.
+        system = openmm.System()
+
+        # Set periodic box vectors.
+        [a,b,c] = reference_system.getDefaultPeriodicBoxVectors()
+        system.setDefaultPeriodicBoxVectors(a,b,c)
+
+        # Add atoms.
+        for atom_index in range(reference_system.getNumParticles()):
+            mass = reference_system.getParticleMass(atom_index)
+            system.addParticle(mass)
+
+        # Add constraints
+        for constraint_index in range(reference_system.getNumConstraints()):
+            [iatom, jatom, r0] = reference_system.getConstraintParameters(constraint_index)
+            system.addConstraint(iatom, jatom, r0)
+
+        self.system = system
+
+    def addForce(self, force, interaction_groups=(), **terms):
+        """
+        Populate a term-less force with the specified terms and add it to the system.
+
+        Parameters
+        ----------
+        force : simtk.openmm.Force
+            The force definition, containing no terms.
+        interaction_groups : list of (list of int, list of int), optional
+            Interaction groups to add to a CustomNonbondedForce.
+        terms : dict of str : list of tuple
+            terms[kind] is the list of term rows of the given kind (e.g. 'particles', 'exclusions', 'bonds').
+
+        Returns
+        -------
+        force_index : int
+            The index of the force in the system being built.
+
+        """
+        force_name = force.__class__.__name__
+        for (kind, rows) in terms.items():
+            (container_name, term_name, index_attributes, parameter_attributes, add_method, set_method) = _TERM_LAYOUTS[(force_name, kind)]
+            add = getattr(force, add_method)
+            nindices = len(index_attributes)
+            if parameter_attributes is None:
+                for row in rows:
+                    add(*(tuple(row[:nindices]) + (list(row[nindices:]),)))
+            else:
+                for row in rows:
+                    add(*row)
+        for (set1, set2) in interaction_groups:
+            force.addInteractionGroup(list(set1), list(set2))
+        return self.system.addForce(force)
+
+    def addModifiedForce(self, force_index, **updates):
+        """
+        Add a copy of a reference force in which some terms have modified parameters.
+
+        Parameters
+        ----------
+        force_index : int
+            Index of the force in the reference system.
+        updates : dict of str : (list of int, list of tuple)
+            updates[kind] = (indices, rows) replaces terms of the given kind at the given indices with the given rows.
+
+        Returns
+        -------
+        force_index : int
+            The index of the force in the system being built.
+
+        """
+        force = copy.deepcopy(self.reference_system.getForce(force_index))
+        for (kind, (indices, rows)) in updates.items():
+            _set_force_terms(force, kind, indices, rows)
+        return self.system.addForce(force)
+
+    def copyForce(self, force_index):
+        """
+        Add an unmodified copy of a reference force.
+
+        """
+        return self.system.addForce(copy.deepcopy(self.reference_system.getForce(force_index)))
+
+    def getSystem(self):
+        return self.system
+
+def _alchemical_state_key(alchemical_state):
+    """
+    Return a hashable key that is identical for identical alchemical states.
+
+    """
+    return tuple(sorted(alchemical_state.items()))
+
+def _state_sweep_order(alchemical_states):
+    """
+    Order alchemical states so that consecutive states differ in as few parameters as possible.
+
+    States are chained greedily, starting from the first, by appending the remaining state that differs from the last
+    one in the fewest parameters.
+
+    Parameters
+    ----------
+    alchemical_states : list of AlchemicalState
+        The alchemical states.
+
+    Returns
+    -------
+    order : list of int
+        Indices of the states in sweep order.
+
+    """
+    def distance(state1, state2):
+        return sum(1 for key in set(state1) | set(state2) if state1.get(key) != state2.get(key))
+    remaining = list(range(1, len(alchemical_states)))
+    order = [0] if len(alchemical_states) > 0 else []
+    while remaining:
+        last = alchemical_states[order[-1]]
+        next_index = min(remaining, key=lambda index: distance(last, alchemical_states[index]))
+        remaining.remove(next_index)
+        order.append(next_index)
+    return order
+
+def _iterate_frames(frames):
+    """
+    Iterate over frames of coordinates (positions or box vectors), yielding unitless arrays in nanometers.
+
+    Parameters
+    ----------
+    frames : simtk.unit.Quantity, numpy array, or iterable
+        Either an array (possibly memory-mapped or a Quantity) whose first dimension indexes frames, or an iterable of frames.
+        Unitless values are assumed to be in nanometers.
+
+    """
+    if isinstance(frames, unit.Quantity):
+        frames = frames.value_in_unit(unit.nanometers)
+    for frame in frames:
+        if isinstance(frame, unit.Quantity):
+            frame = frame.value_in_unit(unit.nanometers)
+        yield np.asarray(frame, np.float64)
+
+class _ReducedPotentialSweep(object):
+    """
+    Energy evaluations needed to compute the potential of a frame in every alchemical state (see `computeReducedPotentials`).
+
+    Parameters
+    ----------
+    alchemical_states : list of AlchemicalState
+        The alchemical states.
+    swept_parameters : set of str
+        Parameters of the forces in `sweep_groups`, which are evaluated in each distinct combination of their values.
+    endpoint_kinds : list of str or None
+        The endpoint kind of each state evaluated with an endpoint system, or None.
+    sweep_groups : int
+        Force groups evaluated in every distinct state (0 if there are none, -1 for all force groups).
+    constant_groups : int
+        Force groups that do not depend on the alchemical state, evaluated once per frame.
+    polynomials : list of (str, numpy array, int)
+        For each lambda in which the energy of some force groups is polynomial, the lambda, its interpolation nodes,
+        and the force groups.
+
+    """
+    def __init__(self, alchemical_states, swept_parameters, endpoint_kinds, sweep_groups=-1, constant_groups=0, polynomials=list()):
+        self.alchemical_states = alchemical_states
+        self.sweep_groups = sweep_groups
+        self.constant_groups = constant_groups
+        self.polynomials = polynomials
+        self.endpoint_indices = dict((kind, [ index for (index, state_kind) in enumerate(endpoint_kinds) if state_kind == kind ]) for kind in set(endpoint_kinds) - set([None]))
+
+        # Evaluate each distinct combination of swept parameters only once, except in states evaluated with endpoint systems.
+        state_parameters = [ dict((name, value) for (name, value) in alchemical_state.items() if name in swept_parameters) for alchemical_state in alchemical_states ]
+        distinct_parameters = dict()
+        for (parameters, kind) in zip(state_parameters, endpoint_kinds):
+            if kind is None:
+                distinct_parameters.setdefault(_alchemical_state_key(parameters), parameters)
+        distinct_keys = list(distinct_parameters.keys())
+        self.sweep_parameters = [ distinct_parameters[key] for key in distinct_keys ]
+        self.order = _state_sweep_order(self.sweep_parameters) if sweep_groups else list()
+        self.state_sweep_indices = [ distinct_keys.index(_alchemical_state_key(parameters)) if (kind is None) else len(distinct_keys)
+                                     for (parameters, kind) in zip(state_parameters, endpoint_kinds) ]
+
+    def evaluate(self, worker):
+        """
+        Return the potential energy (in kJ/mol) in each alchemical state for the current frame of a worker.
+
+        Distinct states are swept in alternating directions on consecutive calls for the same worker.
+
+        """
+        potentials = np.zeros([len(self.alchemical_states)], np.float64)
+        if self.constant_groups:
+            potentials += worker.computeEnergy(self.constant_groups)
+        for (parameter, nodes, groups) in self.polynomials:
+            node_energies = list()
+            for node in nodes:
+                worker.setParameter(parameter, node)
+                node_energies.append(worker.computeEnergy(groups))
+            coefficients = np.linalg.solve(np.vander(nodes), node_energies)
+            potentials += np.polyval(coefficients, [ alchemical_state[parameter] for alchemical_state in self.alchemical_states ])
+        if self.sweep_groups:
+            sweep_potentials = np.zeros([len(self.sweep_parameters) + 1], np.float64)
+            for sweep_index in (self.order if (worker.direction == 0) else self.order[::-1]):
+                for (name, value) in self.sweep_parameters[sweep_index].items():
+                    worker.setParameter(name, value)
+                sweep_potentials[sweep_index] = worker.computeEnergy(self.sweep_groups)
+            potentials += sweep_potentials[self.state_sweep_indices]
+            worker.direction = 1 - worker.direction
+        for (kind, indices) in self.endpoint_indices.items():
+            potentials[indices] = worker.computeEndpointEnergy(kind)
+        return potentials
+
+class _ReducedPotentialWorker(object):
+    """
+    Contexts and current parameters of a worker thread of `computeReducedPotentials`.
+
+    Parameters
+    ----------
+    factory : AbsoluteAlchemicalFactory
+        The factory that created `system`.
+    system : simtk.openmm.System
+        The alchemically-modified system; with native electrostatics, its charges are scaled, so it must not be shared
+        with other workers.
+    endpoint_systems : dict of str : simtk.openmm.System
+        Systems with native forces only, keyed by endpoint kind.
+    platform : simtk.openmm.Platform or None
+        The platform to use, or None for the fastest available platform.
+
+    """
+    def __init__(self, factory, system, endpoint_systems, platform):
+        def create_context(system):
+            integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+            if platform is None:
+                return openmm.Context(system, integrator)
+            return openmm.Context(system, integrator, platform)
+        self.factory = factory
+        self.system = system
+        self.context = create_context(system)
+        self.endpoint_contexts = dict((kind, create_context(endpoint_system)) for (kind, endpoint_system) in endpoint_systems.items())
+        self.global_parameters = set(self.context.getParameters().keys())
+        self.native = (factory._native_electrostatics_terms is not None)
+        if self.native:
+            # Create the binding plans used to scale native charges now, rather than concurrently in worker threads.
+            for target in [system, self.context]:
+                factory.getParameterBindingPlan(target)
+        self.current_parameters = dict()
+        self.direction = 0
+
+    def setParameter(self, name, value):
+        """
+        Set an alchemical parameter, unless it already has this value.
+
+        """
+        if self.current_parameters.get(name) == value:
+            return
+        if self.native and (name == 'lambda_electrostatics'):
+            self.factory._scaleNativeElectrostatics(self.system, value, self.context)
+        if name in self.global_parameters:
+            self.context.setParameter(name, value)
+        self.current_parameters[name] = value
+
+    def setFrame(self, positions, box_vectors=None):
+        """
+        Set the positions, and box vectors if specified, of all Contexts.
+
+        """
+        for context in [self.context] + list(self.endpoint_contexts.values()):
+            if box_vectors is not None:
+                _set_periodic_box_vectors(context, box_vectors)
+            context.setPositions(positions)
+
+    def computeEnergy(self, groups=-1):
+        """
+        Return the potential energy (in kJ/mol) of the specified force groups of the alchemically-modified system.
+
+        """
+        return self.context.getState(getEnergy=True, groups=groups).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+
+    def computeEndpointEnergy(self, kind):
+        """
+        Return the potential energy (in kJ/mol) of the endpoint system of the specified kind.
+
+        """
+        return self.endpoint_contexts[kind].getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+
+    def computeVolume(self):
+        """
+        Return the volume of the periodic box.
+
+        """
+        return self.context.getState().getPeriodicBoxVolume()
+
+def _local_environment_mask(positions, center_mask, radius, block_size=4096):
+    """
+    Return a boolean mask selecting the particles not in `center_mask` within `radius` of any particle in `center_mask`.
+
+    Parameters
+    ----------
+    positions : simtk.unit.Quantity or numpy array of shape (natoms, 3)
+        Positions; unitless values are assumed to be in nanometers.
+    center_mask : numpy array of bool
+        Mask of the particles around which the environment is selected.
+    radius : float
+        Selection radius in nanometers.
+    block_size : int, optional, default=4096
+        Number of candidate particles whose distances are computed at once.
+
+    """
+    positions = next(_iterate_frames([positions]))
+    mask = np.zeros([len(positions)], bool)
+    centers = positions[center_mask]
+    if len(centers) == 0:
+        return mask
+    # Only particles within the bounding box of the centers, grown by the radius, can be within the radius.
+    inside = np.all((positions >= centers.min(axis=0) - radius) & (positions <= centers.max(axis=0) + radius), axis=1)
+    candidates = np.where(inside & ~center_mask)[0]
+    for start in range(0, len(candidates), block_size):
+        block = candidates[start:start+block_size]
+        distances = ((positions[block,np.newaxis,:] - centers[np.newaxis,:,:])**2).sum(axis=2)
+        mask[block] = (distances.min(axis=1) <= radius**2)
+    return mask
+
+#=============================================================================================
+# TEMPLATE CACHE
+#=============================================================================================
+
+class AlchemicalTemplateCache(object):
+    """
+    Persistent, content-addressed on-disk cache of alchemically-modified template systems.
+
+    Entries are keyed by a fingerprint of the serialized reference system and all factory arguments that affect the
+    alchemically-modified system, and are stored compressed in the cache directory.  When the total size of the cache
+    exceeds `max_size`, the least recently used entries are evicted.
+
+    Parameters
+    ----------
+    directory : str
+        The directory in which cached template systems are stored; it is created if it does not exist.
+    max_size : int, optional, default=1024**3
+        Maximum total size of the cache (in bytes).
+
+    Attributes
+    ----------
+    hits : int
+        Number of cache lookups that found an entry.
+    misses : int
+        Number of cache lookups that did not find an entry.
+
+    Examples
+    --------
+
+    Create an alchemical factory for alanine dipeptide, storing the alchemically-modified system in a cache.
+
+    >>> import tempfile
+    >>> from openmmtools import testsystems
+    >>> testsystem = testsystems.AlanineDipeptideImplicit()
+    >>> cache = AlchemicalTemplateCache(tempfile.mkdtemp())
+    >>> factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=[0, 1, 2], cache=cache)
+    >>> # A second factory with identical inputs retrieves the alchemically-modified system from the cache.
+    >>> factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=[0, 1, 2], cache=cache)
+    >>> cache.statistics()['hits']
+    1
+
+    """
+
+    # Incremented whenever the alchemical modification scheme changes, so that stale entries are never reused.
+    VERSION = 1
+
+    def __init__(self, directory, max_size=1024**3):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def fingerprint(cls, serialized_reference_system, arguments):
+        """
+        Compute the cache key for a reference system and set of factory arguments.
+
+        Parameters
+        ----------
+        serialized_reference_system : str
+            The serialized reference system.
+        arguments : dict
+            Factory arguments that affect the alchemically-modified system.
+
+        Returns
+        -------
+        key : str
+            Hexadecimal SHA-256 digest identifying the alchemically-modified system.
+
+        """
+        sha = hashlib.sha256()
+        sha.update(serialized_reference_system.encode('utf-8'))
+        sha.update(repr((cls.VERSION, sorted(arguments.items()))).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, '%s.pickle.gz' % key)
+
+    def get(self, key):
+        """
+        Retrieve a cache entry, marking it as most recently used.
+
+        Parameters
+        ----------
+        key : str
+            The cache key.
+
+        Returns
+        -------
+        entry : dict or None
+            The cached entry, or None if there is no entry for this key.
+
+        """
+        filename = self._filename(key)
+        try:
+            with gzip.open(filename, 'rb') as infile:
+                entry = pickle.load(infile)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(filename, None)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """
+        Store a cache entry, evicting least recently used entries if the cache exceeds its maximum size.
+
+        Parameters
+        ----------
+        key : str
+            The cache key.
+        entry : dict
+            The entry to store; must be picklable.
+
+        """
+        filename = self._filename(key)
+        temporary_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with gzip.open(temporary_filename, 'wb', compresslevel=1) as outfile:
+            pickle.dump(entry, outfile, protocol=2)
+        os.rename(temporary_filename, filename)
+        self._evict()
+
+    def invalidate(self, key=None):
+        """
+        Remove a cache entry, or all entries if no key is specified.
+
+        Parameters
+        ----------
+        key : str, optional, default=None
+            The cache key to remove; if None, the entire cache is cleared.
+
+        """
+        keys = [key] if (key is not None) else [ filename.split('.')[0] for filename in os.listdir(self.directory) if filename.endswith('.pickle.gz') ]
+        for key in keys:
+            if os.path.exists(self._filename(key)):
+                os.remove(self._filename(key))
+
+    def _evict(self):
+        entries = list()
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.pickle.gz'):
+                stat = os.stat(os.path.join(self.directory, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        total_size = sum(size for (mtime, size, filename) in entries)
+        # Always keep the most recently used entry.
+        while (total_size > self.max_size) and (len(entries) > 1):
+            (mtime, size, filename) = entries.pop(0)
+            logger.debug("Evicting alchemical template %s from cache." % filename)
+            os.remove(os.path.join(self.directory, filename))
+            total_size -= size
+
+    def statistics(self):
+        """
+        Return cache statistics.
+
+        Returns
+        -------
+        statistics : dict
+            'hits' and 'misses' count lookups, 'entries' and 'size' give the number and total size (in bytes) of stored entries.
+
+        """
+        sizes = [ os.path.getsize(os.path.join(self.directory, filename)) for filename in os.listdir(self.directory) if filename.endswith('.pickle.gz') ]
+        return { 'hits' : self.hits, 'misses' : self.misses, 'entries' : len(sizes), 'size' : sum(sizes) }
+
+#=============================================================================================
+# PARAMETER BINDING PLANS
+#=============================================================================================
+
+class ParameterBindingPlan(object):
+    """
+    Precomputed plan for setting alchemical parameters of a System or Context.
+
+    The plan records which global parameters are present in its target (and, for a System, the force and parameter
+    indices of each one), so that applying a state only pushes parameters whose values have changed.  For a Context,
+    values are compared against the current parameters of the Context, so that changes made by other means (for example
+    by calling `setParameter` or `reinitialize`) are taken into account.  For a System, values are compared against the
+    ones the plan last applied; if the default values are changed by other means, `invalidate` must be called before
+    the plan is used again.
+
+    Parameters
+    ----------
+    target : simtk.openmm.System or simtk.openmm.Context
+        The System whose default global parameter values, or the Context whose parameters, are set by the plan.
+
+    Attributes
+    ----------
+    parameters : set of str
+        Names of the global parameters present in the target.
+    applied : int
+        Number of parameter values pushed to the target.
+    skipped : int
+        Number of parameter values not pushed because they were unchanged.
+
+    """
+    def __init__(self, target):
+        self._is_context = isinstance(target, openmm.Context)
+        self._bindings = dict() # parameter name -> list of (force index, parameter index)
+        if self._is_context:
+            self.parameters = set(target.getParameters().keys())
+        else:
+            for force_index in range(target.getNumForces()):
+                force = target.getForce(force_index)
+                if hasattr(force, 'getNumGlobalParameters'):
+                    for parameter_index in range(force.getNumGlobalParameters()):
+                        self._bindings.setdefault(force.getGlobalParameterName(parameter_index), list()).append((force_index, parameter_index))
+            self.parameters = set(self._bindings.keys())
+            self._num_forces = target.getNumForces()
+        self._last_applied = dict()
+        self.applied = 0
+        self.skipped = 0
+
+    @classmethod
+    def forTarget(cls, target):
+        """
+        Return the binding plan of a System or Context, creating it on first use; it is kept for as long as the target exists.
+
+        """
+        with _parameter_binding_plans_lock:
+            plan = _parameter_binding_plans.get(target)
+            if (plan is None) or (not plan.isValid(target)):
+                plan = cls(target)
+                _parameter_binding_plans[target] = plan
+        return plan
+
+    @classmethod
+    def invalidateTarget(cls, target):
+        """
+        Invalidate the binding plan of a System or Context (see `invalidate`), if it has one.
+
+        """
+        with _parameter_binding_plans_lock:
+            plan = _parameter_binding_plans.get(target)
+        if plan is not None:
+            plan.invalidate()
+
+    def isValid(self, target):
+        """
+        Return True if the recorded bindings still match the forces of the target.
+
+        """
+        return self._is_context or (target.getNumForces() == self._num_forces)
+
+    def invalidate(self):
+        """
+        Forget the last applied parameter values, so that the next state applied to a System is pushed in full.
+
+        """
+        self._last_applied = dict()
+
+    def apply(self, target, alchemical_state, use_all_parameters=False):
+        """
+        Set the parameters of the target to the values of an alchemical state, skipping unchanged values.
+
+        Parameters
+        ----------
+        target : simtk.openmm.System or simtk.openmm.Context
+            The System or Context the plan was created for.
+        alchemical_state : AlchemicalState
+            The alchemical state to apply.
+        use_all_parameters : bool, optional, default=False
+            If True, raise an Exception if the state contains parameters that are not present in the target.
+
+        """
+        if use_all_parameters:
+            missing_parameters = set(alchemical_state.keys()) - self.parameters
+            if missing_parameters:
+                raise Exception("Parameters %s not available in %s; available parameters are: %s" % (str(sorted(missing_parameters)), target.__class__.__name__, str(sorted(self.parameters))))
+        last_applied = self._last_applied
+        for (name, value) in alchemical_state.items():
+            if name not in self.parameters:
+                continue
+            if self._is_context:
+                if target.getParameter(name) == value:
+                    self.skipped += 1
+                    continue
+                target.setParameter(name, value)
+            else:
+                if (name in last_applied) and (last_applied[name] == value):
+                    self.skipped += 1
+                    continue
+                for (force_index, parameter_index) in self._bindings[name]:
+                    target.getForce(force_index).setGlobalParameterDefaultValue(parameter_index, value)
+                last_applied[name] = value
+            self.applied += 1
+
+# Binding plans of Systems and Contexts, discarded along with their targets; the lock guards the dictionary, which
+# is used from worker threads (see `computeReducedPotentials`).
+_parameter_binding_plans = weakref.WeakKeyDictionary()
+_parameter_binding_plans_lock = threading.Lock()
+
+# Global parameter recording the lambda_electrostatics by which native charges are scaled, in systems created with
+# native electrostatics; it does not appear in any energy expression.
+NATIVE_ELECTROSTATICS_PARAMETER = 'native_lambda_electrostatics'
+
+#=============================================================================================
+# CONTEXT CACHE
+#=============================================================================================
+
+class ContextCache(object):
+    """
+    In-memory least-recently-used cache of OpenMM Context objects for energy evaluation.
+
+    Creating a Context compiles the platform kernels for its System, which usually takes much longer than evaluating
+    the energy.  Contexts are keyed by a fingerprint of the System (with the default values of global parameters
+    blanked out), the platform, and the platform properties, so Systems that differ only in their alchemical parameters
+    share a Context.  On retrieval, the global parameters and periodic box vectors of the Context are reset to the
+    defaults of the requested System, so the Context behaves like one freshly created from it.
+
+    Cached Contexts are intended for computing energies and forces: callers should set positions before each
+    evaluation, and must not modify per-particle or per-term parameters of a cached Context.  Contexts are cached
+    separately for each thread, so that a Context is never handed out to two threads at once (for example to
+    `iterPerturbedSystems` checking systems in a background thread while the caller computes energies).
+
+    Parameters
+    ----------
+    capacity : int, optional, default=None
+        Maximum number of cached Contexts; if None, the number is not limited.
+    max_size : int, optional, default=None
+        Approximate memory budget (in bytes) for cached Contexts; if None, the budget is not limited.  The memory
+        footprint of a Context is estimated from the size of its serialized System.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups that reused a cached Context.
+    misses : int
+        Number of lookups that created a new Context.
+
+    Examples
+    --------
+
+    Compute the energy of alanine dipeptide at two alchemical states, compiling the kernels only once.
+
+    >>> from openmmtools import testsystems
+    >>> testsystem = testsystems.AlanineDipeptideImplicit()
+    >>> factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=[0, 1, 2])
+    >>> cache = ContextCache(capacity=4)
+    >>> for lambda_value in [1.0, 0.5]:
+    ...     system = factory.createPerturbedSystem(AlchemicalState(lambda_electrostatics=lambda_value))
+    ...     context = cache.getContext(system)
+    ...     context.setPositions(testsystem.positions)
+    ...     energy = context.getState(getEnergy=True).getPotentialEnergy()
+    >>> cache.statistics()['hits']
+    1
+
+    """
+
+    def __init__(self, capacity=None, max_size=None):
+        self.capacity = capacity
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() # (thread identifier, key) -> (context, integrator, estimated size)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fingerprint(cls, system, platform=None, properties=None):
+        """
+        Compute the cache key for a System on a platform.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The System.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform; if None, the fastest available platform is used.
+        properties : dict, optional, default=None
+            Platform properties.
+
+        Returns
+        -------
+        key : str
+            Hexadecimal SHA-256 digest identifying the System, platform, and platform properties.
+        size : int
+            Size of the serialized System (in bytes).
+
+        """
+        serialized_system = openmm.XmlSerializer.serialize(system)
+        # Global parameter defaults can be changed in a live Context, so they don't distinguish Contexts.
+        serialized_system = re.sub(r'<Parameter default="[^"]*"', '<Parameter default=""', serialized_system)
+        sha = hashlib.sha256()
+        sha.update(serialized_system.encode('utf-8'))
+        sha.update(repr(sorted((properties or dict()).items())).encode('utf-8'))
+        if platform is not None:
+            default_properties = [ (name, platform.getPropertyDefaultValue(name)) for name in platform.getPropertyNames() ]
+            sha.update(repr((platform.getName(), sorted(default_properties))).encode('utf-8'))
+        return (sha.hexdigest(), len(serialized_system))
+
+    def getContext(self, system, platform=None, properties=None):
+        """
+        Retrieve a Context for the specified System, creating it if it is not cached.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The System; the global parameters of the Context are set to its default values.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform; if None, the fastest available platform is used.
+        properties : dict, optional, default=None
+            Platform properties; requires `platform` to be specified.
+
+        Returns
+        -------
+        context : simtk.openmm.Context
+            A Context for `system`; positions must be set before computing energies.
+
+        """
+        (key, size) = self.fingerprint(system, platform, properties)
+        # Contexts are only reused by the thread that created them.
+        key = (threading.current_thread().ident, key)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+        if entry is not None:
+            context = entry[0]
+            for force_index in range(system.getNumForces()):
+                force = system.getForce(force_index)
+                if hasattr(force, 'getNumGlobalParameters'):
+                    for parameter_index in range(force.getNumGlobalParameters()):
+                        context.setParameter(force.getGlobalParameterName(parameter_index), force.getGlobalParameterDefaultValue(parameter_index))
+            context.setPeriodicBoxVectors(*system.getDefaultPeriodicBoxVectors())
+            # Parameters were changed behind the back of any binding plan for this Context.
+            ParameterBindingPlan.invalidateTarget(context)
+            return context
+
+        initial_time = time.time()
+        integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+        if platform is None:
+            context = openmm.Context(system, integrator)
+        elif properties is None:
+            context = openmm.Context(system, integrator, platform)
+        else:
+            context = openmm.Context(system, integrator, platform, properties)
+        logger.debug("Created Context for cache in %.3f s." % (time.time() - initial_time))
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (context, integrator, size)
+            self._evict()
+        return context
+
+    def _evict(self):
+        # Drop the Contexts of threads that have exited, since they can never be retrieved again.
+        live_threads = set(thread.ident for thread in threading.enumerate())
+        for key in [ key for key in self._entries if key[0] not in live_threads ]:
+            del self._entries[key]
+        # Always keep the most recently used Context.
+        while len(self._entries) > 1:
+            total_size = sum(size for (context, integrator, size) in self._entries.values())
+            if ((self.capacity is None) or (len(self._entries) <= self.capacity)) and ((self.max_size is None) or (total_size <= self.max_size)):
+                break
+            self._entries.popitem(last=False)
+
+    def empty(self):
+        """
+        Remove all cached Contexts.
+
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def statistics(self):
+        """
+        Return cache statistics.
+
+        Returns
+        -------
+        statistics : dict
+            'hits' and 'misses' count lookups, 'entries' and 'size' give the number and estimated total size (in bytes) of cached Contexts.
+
+        """
+        with self._lock:
+            size = sum(size for (context, integrator, size) in self._entries.values())
+            return { 'hits' : self.hits, 'misses' : self.misses, 'entries' : len(self._entries), 'size' : size }
+
+# Library-wide Context cache used for energy evaluations.
+global_context_cache = ContextCache(capacity=16)
+
+#=============================================================================================
+# NON-FINITE ENERGY DIAGNOSTICS
+#=============================================================================================
+
+class NonFiniteEnergyError(Exception):
+    """
+    Exception raised when an alchemically-modified system has a non-finite potential energy.
+
+    Attributes
+    ----------
+    report : dict
+        The diagnostic report produced by `AbsoluteAlchemicalFactory.diagnoseNonFiniteEnergy`.
+
+    """
+    def __init__(self, message, report):
+        Exception.__init__(self, message)
+        self.report = report
+
+# Maximum number of force groups supported by OpenMM.
+_MAX_FORCE_GROUPS = 32
+
+def _split_serialized_system(xml):
+    """
+    Split a serialized System into the System element without its forces and the list of its Force elements.
+
+    """
+    root = ElementTree.fromstring(xml)
+    forces_element = root.find('Forces')
+    forces = list(forces_element)
+    del forces_element[:]
+    return (root, forces)
+
+def _deserialize_system_elements(root, forces):
+    """
+    Create a System from a System element without forces, as returned by `_split_serialized_system`, and a list of Force elements.
+
+    """
+    forces_element = root.find('Forces')
+    forces_element.extend(forces)
+    try:
+        xml = ElementTree.tostring(root)
+    finally:
+        del forces_element[:]
+    if not isinstance(xml, str):
+        xml = xml.decode('ascii')
+    return openmm.XmlSerializer.deserialize(xml)
+
+def _serialize_force_element(force):
+    """
+    Serialize a force as a Force element.
+
+    """
+    return ElementTree.fromstring(openmm.XmlSerializer.serialize(force))
+
+def _copy_force_element(force, containers=None):
+    """
+    Return a copy of a Force element, sharing its children except for the container elements whose children are replaced.
+
+    Parameters
+    ----------
+    force : xml.etree.ElementTree.Element
+        The Force element.
+    containers : dict of str : list of xml.etree.ElementTree.Element, optional, default=None
+        containers[name] is the new list of children of the container element `name`.
+
+    """
+    if containers is None:
+        containers = dict()
+    copied = ElementTree.Element(force.tag, force.attrib)
+    (copied.text, copied.tail) = (force.text, force.tail)
+    for child in force:
+        if child.tag in containers:
+            container = ElementTree.SubElement(copied, child.tag, child.attrib)
+            container.extend(containers[child.tag])
+        else:
+            copied.append(child)
+    return copied
+
+def _single_force_group_system(root, forces):
+    """
+    Create a System from a System element without forces and a list of Force elements (see `_split_serialized_system`).
+
+    Each force is placed in its own force group, numbered in the order given.
+
+    """
+    grouped_forces = list()
+    for (group, force) in enumerate(forces):
+        grouped_force = _copy_force_element(force)
+        grouped_force.set('forceGroup', str(group))
+        grouped_forces.append(grouped_force)
+    return _deserialize_system_elements(root, grouped_forces)
+
+def _compute_reference_energy(system, positions, groups=-1):
+    """
+    Compute the potential energy (in kJ/mol) of a System on the Reference platform.
+
+    """
+    context = openmm.Context(system, openmm.VerletIntegrator(1.0 * unit.femtoseconds), openmm.Platform.getPlatformByName('Reference'))
+    context.setPositions(positions)
+    return context.getState(getEnergy=True, groups=groups).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+
+def _bisect(candidates, is_nonfinite):
+    """
+    Narrow down a list of candidates for which `is_nonfinite(candidates)` is True by repeated halving.
+
+    Returns the smallest sublist found; this contains more than one candidate only if no half is non-finite by itself.
+
+    """
+    while len(candidates) > 1:
+        half = len(candidates) // 2
+        if is_nonfinite(candidates[:half]):
+            candidates = candidates[:half]
+        elif is_nonfinite(candidates[half:]):
+            candidates = candidates[half:]
+        else:
+            break
+    return candidates
+
+def _bisect_nonfinite_terms(root, force, positions):
+    """
+    Find a bonded term of a Force element that produces a non-finite energy.
+
+    Returns a (term index, particles) tuple, or None if the force has no bonded terms.
+
+    """
+    force_type = force.get('type')
+    layouts = [ layout for ((name, kind), layout) in _TERM_LAYOUTS.items() if (name == force_type) and (kind in ['bonds', 'angles', 'torsions']) ]
+    if len(layouts) == 0:
+        return None
+    (container_name, term_name, index_attributes) = layouts[0][:3]
+    container = force.find(container_name)
+    if container is None:
+        return None
+    terms = list(container)
+    if len(terms) == 0:
+        return None
+    def is_nonfinite(term_indices):
+        subset_force = _copy_force_element(force, { container_name : [ terms[index] for index in term_indices ] })
+        return not np.isfinite(_compute_reference_energy(_single_force_group_system(root, [subset_force]), positions))
+    term_indices = _bisect(list(range(len(terms))), is_nonfinite)
+    particles = tuple( int(terms[term_indices[0]].get(attribute)) for attribute in index_attributes )
+    return (term_indices[0], particles)
+
+def _bisect_nonfinite_pairs(root, force, positions):
+    """
+    Find a pair of particles whose CustomNonbondedForce interaction produces a non-finite energy.
+
+    The interactions evaluated are selected by two per-particle flags added to a copy of the force, so that all subsets
+    are probed with a single Context by updating particle parameters rather than creating a Context for each probe.
+
+    Returns a tuple of the particles found (a single particle if no partner could be isolated), or None if the force
+    has no particles.
+
+    """
+    nparticles = force.getNumParticles()
+    groups = [ force.getInteractionGroupParameters(index) for index in range(force.getNumInteractionGroups()) ]
+    particles = sorted(set().union(*[ set(set1) | set(set2) for (set1, set2) in groups ])) if len(groups) else list(range(nparticles))
+    if len(particles) == 0:
+        return None
+
+    # Only interactions between a particle flagged with diagnostic_a and a particle flagged with diagnostic_b, in either order, are evaluated.
+    diagnostic_force = openmm.XmlSerializer.clone(force)
+    diagnostic_force.setEnergyFunction("select(diagnostic_pair, diagnostic_energy, 0); diagnostic_pair = diagnostic_a1*diagnostic_b2 + diagnostic_b1*diagnostic_a2; diagnostic_energy = " + force.getEnergyFunction())
+    diagnostic_force.addPerParticleParameter('diagnostic_a')
+    diagnostic_force.addPerParticleParameter('diagnostic_b')
+    diagnostic_force.setUseLongRangeCorrection(False)
+    parameters = [ list(force.getParticleParameters(index)) for index in range(nparticles) ]
+    for index in range(nparticles):
+        diagnostic_force.setParticleParameters(index, parameters[index] + [0.0, 0.0])
+    system = _single_force_group_system(root, [_serialize_force_element(diagnostic_force)])
+    diagnostic_force = system.getForce(0)
+    context = openmm.Context(system, openmm.VerletIntegrator(1.0 * unit.femtoseconds), openmm.Platform.getPlatformByName('Reference'))
+    context.setPositions(positions)
+    def is_nonfinite(subset1, subset2):
+        (subset1, subset2) = (set(subset1), set(subset2))
+        for index in range(nparticles):
+            diagnostic_force.setParticleParameters(index, parameters[index] + [float(index in subset1), float(index in subset2)])
+        diagnostic_force.updateParametersInContext(context)
+        return not np.isfinite(context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole))
+
+    everything = range(nparticles)
+    particle = _bisect(particles, lambda subset: is_nonfinite(subset, everything))[0]
+    partners = [ index for index in everything if index != particle ]
+    partners = _bisect(partners, lambda subset: is_nonfinite([particle], subset))
+    if len(partners) != 1:
+        return (particle,)
+    return tuple(sorted([particle, partners[0]]))
+
+#=============================================================================================
+# DISPERSION CORRECTION
+#=============================================================================================
+
+# Number of equally spaced values of lambda_sterics at which precomputed dispersion corrections are tabulated.
+_DISPERSION_CORRECTION_GRID_SIZE = 101
+
+# Global parameter holding the inverse volume (in nm^-3) of the periodic box, which scales a precomputed dispersion
+# correction; Contexts do not update it when the box changes, so box vectors are set with `_set_periodic_box_vectors`.
+INVERSE_VOLUME_PARAMETER = 'inverse_box_volume'
+
+def _softcore_dispersion_coefficients(sigma, epsilon, alchemical_atom_mask, lambda_values, softcore, cutoff, switching_distance=None, npoints=64):
+    """
+    Compute the long-range dispersion correction of softcore sterics between alchemical atoms and all other atoms.
+
+    This reproduces the correction that OpenMM computes by numerical integration for a CustomNonbondedForce with an
+    interaction group between the alchemical atoms and all atoms: particles are grouped into classes with identical
+    parameters, and each pair of particles involving an alchemical atom is counted once.
+
+    Parameters
+    ----------
+    sigma, epsilon : numpy array of float
+        Lennard-Jones parameters of every particle, in OpenMM units.
+    alchemical_atom_mask : numpy array of bool
+        alchemical_atom_mask[i] is True if particle i is alchemically modified.
+    lambda_values : numpy array of float
+        Values of lambda_sterics at which the correction is computed.
+    softcore : tuple of float
+        The softcore parameters (softcore_alpha, softcore_a, softcore_b, softcore_c).
+    cutoff : float
+        The cutoff distance, in nanometers.
+    switching_distance : float, optional, default=None
+        The distance at which the switching function begins, or None if no switching function is used.
+    npoints : int, optional, default=64
+        Number of Gauss-Legendre quadrature points of each integral.
+
+    Returns
+    -------
+    coefficients : numpy array of float
+        coefficients[k] is the dispersion correction energy times the box volume (in kJ/mol nm^3) at lambda_values[k].
+
+    """
+    (softcore_alpha, softcore_a, softcore_b, softcore_c) = softcore
+
+    # Count the pairs involving an alchemical atom for each pair of particle classes.
+    (classes, particle_classes) = np.unique(np.column_stack([sigma, epsilon]), axis=0, return_inverse=True)
+    nclasses = len(classes)
+    counts = np.bincount(particle_classes, minlength=nclasses).astype(np.float64)
+    alchemical_counts = np.bincount(particle_classes[alchemical_atom_mask], minlength=nclasses).astype(np.float64)
+    pair_counts = np.outer(alchemical_counts, counts) + np.outer(counts, alchemical_counts) - np.outer(alchemical_counts, alchemical_counts)
+    pair_counts[np.diag_indices(nclasses)] = counts * alchemical_counts - alchemical_counts * (alchemical_counts + 1) / 2
+    (class1, class2) = np.triu_indices(nclasses)
+    pair_counts = pair_counts[class1, class2]
+    selected = (pair_counts > 0)
+    (class1, class2, pair_counts) = (class1[selected], class2[selected], pair_counts[selected])
+    pair_sigma = 0.5 * (classes[class1, 0] + classes[class2, 0])[:,np.newaxis]
+    pair_epsilon = np.sqrt(classes[class1, 1] * classes[class2, 1])[:,np.newaxis]
+
+    (nodes, weights) = np.polynomial.legendre.leggauss(npoints)
+    (nodes, weights) = (0.5 * (nodes + 1.0), 0.5 * weights)
+    def energy(r, lambda_value):
+        reff = pair_sigma * (softcore_alpha * (1.0 - lambda_value)**softcore_b + (r / pair_sigma)**softcore_c)**(1.0 / softcore_c)
+        x = (pair_sigma / reff)**6
+        return (lambda_value**softcore_a) * 4.0 * pair_epsilon * x * (x - 1.0)
+
+    coefficients = np.zeros([len(lambda_values)], np.float64)
+    for (lambda_index, lambda_value) in enumerate(lambda_values):
+        # Integrate from the cutoff to infinity with the change of variables x = cutoff / r.
+        r = cutoff / nodes
+        integrals = np.dot(energy(r, lambda_value) * r**4, weights) / cutoff
+        if switching_distance is not None:
+            # Integrate (1 - S(r)) U(r) r^2 over the switching interval.
+            x = nodes
+            r = switching_distance + x * (cutoff - switching_distance)
+            integrals += (cutoff - switching_distance) * np.dot(x**3 * (10.0 + x * (-15.0 + x * 6.0)) * energy(r, lambda_value) * r**2, weights)
+        coefficients[lambda_index] = 2.0 * np.pi * np.dot(pair_counts, integrals)
+    return coefficients
+
+def _inverse_box_volume(box_vectors):
+    """
+    Return the inverse volume (in nm^-3) of the periodic box spanned by the specified box vectors.
+
+    Parameters
+    ----------
+    box_vectors : list of simtk.openmm.Vec3 with units compatible with nanometers
+        The periodic box vectors, as returned by `System.getDefaultPeriodicBoxVectors` or `State.getPeriodicBoxVectors`.
+
+    """
+    if unit.is_quantity(box_vectors):
+        box_vectors = box_vectors.value_in_unit(unit.nanometers)
+    box = np.array([ vector.value_in_unit(unit.nanometers) if unit.is_quantity(vector) else vector for vector in box_vectors ], np.float64)
+    return 1.0 / abs(np.linalg.det(box))
+
+def _set_periodic_box_vectors(context, box_vectors):
+    """
+    Set the periodic box vectors of a Context, and the inverse box volume scaling a precomputed dispersion correction.
+
+    """
+    context.setPeriodicBoxVectors(*box_vectors)
+    if INVERSE_VOLUME_PARAMETER in context.getParameters().keys():
+        context.setParameter(INVERSE_VOLUME_PARAMETER, _inverse_box_volume(box_vectors))
+
+#=============================================================================================
+# SOFTCORE KERNEL TABLES
+#=============================================================================================
+
+# Smallest value of r/sigma covered by tabulated softcore sterics kernels; pairs at shorter distances are clamped to it.
+_SOFTCORE_TABLE_MIN_DISTANCE = 0.5
+# Largest value of r/sigma covered by tabulated softcore sterics kernels for nonbonded methods without a cutoff.
+_SOFTCORE_TABLE_MAX_DISTANCE = 10.0
+# Smallest effective distance (in nm) covered by tabulated Ewald direct-space kernels.
+_EWALD_TABLE_MIN_DISTANCE = 0.05
+
+def _softcore_sterics_kernel(s, lambda_value, softcore):
+    """
+    Evaluate the softcore Lennard-Jones energy in units of epsilon as a function of s = r/sigma and lambda_sterics.
+
+    Parameters
+    ----------
+    s, lambda_value : numpy array of float
+        Reduced distances r/sigma and values of lambda_sterics (broadcast against each other).
+    softcore : tuple of float
+        The softcore parameters (softcore_alpha, softcore_a, softcore_b, softcore_c).
+
+    """
+    (softcore_alpha, softcore_a, softcore_b, softcore_c) = softcore
+    x = (softcore_alpha * (1.0 - lambda_value)**softcore_b + s**softcore_c)**(-6.0 / softcore_c)
+    return (lambda_value**softcore_a) * 4.0 * x * (x - 1.0)
+
+def _tabulate_softcore_kernel(function, xrange, xsize, yrange=None, ysize=None):
+    """
+    Tabulate a kernel of one or two variables on a uniform grid.
+
+    Parameters
+    ----------
+    function : callable
+        function(x) or function(x, y) evaluating the kernel on numpy arrays.
+    xrange, yrange : tuple of float
+        The (min, max) range of each variable; `yrange` is None for kernels of one variable.
+    xsize, ysize : int
+        The number of grid points along each variable.
+
+    Returns
+    -------
+    table : dict
+        'values' holds the kernel on the grid (indexed [y, x] for kernels of two variables), 'range' the ranges of
+        the variables, and 'function' the analytic kernel.
+
+    """
+    x = np.linspace(xrange[0], xrange[1], xsize)
+    if yrange is None:
+        return { 'values' : function(x), 'range' : tuple(xrange), 'function' : function }
+    y = np.linspace(yrange[0], yrange[1], ysize)
+    return { 'values' : function(x[np.newaxis,:], y[:,np.newaxis]), 'range' : tuple(xrange) + tuple(yrange), 'function' : function }
+
+def _softcore_kernel_function(table):
+    """
+    Create the OpenMM tabulated function interpolating a table created by `_tabulate_softcore_kernel`.
+
+    """
+    values = table['values']
+    if values.ndim == 1:
+        return openmm.Continuous1DFunction(values.tolist(), *table['range'])
+    (ysize, xsize) = values.shape
+    return openmm.Continuous2DFunction(xsize, ysize, values.ravel().tolist(), *table['range'])
+
+def _evaluate_tabulated_function(function, x, y=None, platform=None):
+    """
+    Evaluate an OpenMM tabulated function of one or two variables with OpenMM.
+
+    The function is the energy of a CustomBondForce between two particles, whose distance is the first variable and
+    whose global parameter is the second.
+
+    Parameters
+    ----------
+    function : simtk.openmm.TabulatedFunction
+        The function to evaluate.
+    x : numpy array of float
+        The values of the first variable.
+    y : numpy array of float, optional, default=None
+        The values of the second variable, for functions of two variables.
+    platform : simtk.openmm.Platform, optional, default=None
+        The platform used for the evaluation; the Reference platform if None.
+
+    Returns
+    -------
+    values : numpy array of float
+        values[k] (or values[j,k] for functions of two variables) is the function at x[k] (and y[j]).
+
+    """
+    system = openmm.System()
+    system.addParticle(1.0)
+    system.addParticle(1.0)
+    force = openmm.CustomBondForce("kernel(r)" if (y is None) else "kernel(r, y)")
+    force.addTabulatedFunction('kernel', function)
+    if y is not None:
+        force.addGlobalParameter('y', 0.0)
+    force.addBond(0, 1, [])
+    system.addForce(force)
+    if platform is None:
+        platform = openmm.Platform.getPlatformByName('Reference')
+    context = openmm.Context(system, openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+
+    def evaluate():
+        energies = np.zeros([len(x)], np.float64)
+        for (index, distance) in enumerate(x):
+            context.setPositions([openmm.Vec3(0.0, 0.0, 0.0), openmm.Vec3(float(distance), 0.0, 0.0)] * unit.nanometers)
+            energies[index] = context.getState(getEnergy=True).getPotentialEnergy() / unit.kilojoules_per_mole
+        return energies
+
+    if y is None:
+        values = evaluate()
+    else:
+        values = np.zeros([len(y), len(x)], np.float64)
+        for (index, value) in enumerate(y):
+            context.setParameter('y', float(value))
+            values[index,:] = evaluate()
+    del context
+    return values
+
+#=============================================================================================
+# EXPRESSION SPECIALIZATION
+#=============================================================================================
+
+# Softcore parameters that can be frozen as constants in the energy expressions of alchemical forces.
+SOFTCORE_PARAMETERS = ['softcore_alpha', 'softcore_beta', 'softcore_a', 'softcore_b', 'softcore_c', 'softcore_d', 'softcore_e', 'softcore_f']
+
+_EXPRESSION_TOKEN = re.compile(r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_][A-Za-z0-9_]*)|(\S))")
+
+def _parse_expression(expression):
+    """
+    Parse an OpenMM energy expression into syntax trees.
+
+    Trees are tuples: ('num', value), ('var', name), ('neg', operand), (operator, left, right) for the binary
+    operators '+', '-', '*', '/' and '^', and ('call', name, arguments) for function calls.
+
+    Parameters
+    ----------
+    expression : str
+        The energy expression, followed by semicolon-separated definitions of intermediate variables.
+
+    Returns
+    -------
+    energy : tuple
+        The syntax tree of the energy.
+    definitions : list of (str, tuple)
+        The names and syntax trees of the intermediate variables, in order.
+
+    """
+    tokens = []
+    for match in _EXPRESSION_TOKEN.finditer(expression):
+        (number, name, symbol) = match.groups()
+        if number is not None:
+            tokens.append(('num', float(number)))
+        elif name is not None:
+            tokens.append(('name', name))
+        elif symbol is not None:
+            tokens.append(('symbol', symbol))
+    tokens.append(('symbol', None))
+    position = [0]
+
+    def peek():
+        return tokens[position[0]]
+    def take(symbol=None):
+        token = tokens[position[0]]
+        if (symbol is not None) and (token != ('symbol', symbol)):
+            raise Exception("Expected '%s' in energy expression '%s'." % (symbol, expression))
+        position[0] += 1
+        return token
+    def parse_sum():
+        node = parse_product()
+        while peek() in [('symbol', '+'), ('symbol', '-')]:
+            node = (take()[1], node, parse_product())
+        return node
+    def parse_product():
+        node = parse_unary()
+        while peek() in [('symbol', '*'), ('symbol', '/')]:
+            node = (take()[1], node, parse_unary())
+        return node
+    def parse_unary():
+        if peek() == ('symbol', '-'):
+            take()
+            return ('neg', parse_unary())
+        node = parse_atom()
+        if peek() == ('symbol', '^'):
+            take()
+            node = ('^', node, parse_unary())
+        return node
+    def parse_atom():
+        (kind, value) = take()
+        if kind == 'num':
+            return ('num', value)
+        if (kind == 'name') and (peek() == ('symbol', '(')):
+            take('(')
+            arguments = [ parse_sum() ]
+            while peek() == ('symbol', ','):
+                take()
+                arguments.append(parse_sum())
+            take(')')
+            return ('call', value, tuple(arguments))
+        if kind == 'name':
+            return ('var', value)
+        if (kind, value) == ('symbol', '('):
+            node = parse_sum()
+            take(')')
+            return node
+        raise Exception("Unexpected '%s' in energy expression '%s'." % (str(value), expression))
+
+    trees = []
+    while True:
+        if peek() == ('symbol', None):
+            break
+        if peek() == ('symbol', ';'):
+            take()
+            continue
+        name = None
+        if (peek()[0] == 'name') and (tokens[position[0]+1] == ('symbol', '=')):
+            name = take()[1]
+            take('=')
+        trees.append((name, parse_sum()))
+        if peek() != ('symbol', None):
+            take(';')
+    energy = trees[0][1]
+    definitions = trees[1:]
+    names = [ name for (name, tree) in definitions ]
+    if (trees[0][0] is not None) or (None in names) or (len(set(names)) != len(names)):
+        raise Exception("Energy expression '%s' must be an energy followed by uniquely named definitions." % expression)
+    return (energy, definitions)
+
+def _format_expression_tree(node):
+    """
+    Format a syntax tree created by `_parse_expression` as an OpenMM expression.
+
+    """
+    precedence = { '+' : 1, '-' : 1, '*' : 2, '/' : 2, '^' : 4 }
+    def format_operand(child, minimum):
+        text = _format_expression_tree(child)
+        if ((child[0] in precedence) and (precedence[child[0]] < minimum)) or (child[0] == 'neg') or ((child[0] == 'num') and (child[1] < 0)):
+            return "(%s)" % text
+        return text
+    kind = node[0]
+    if kind == 'num':
+        value = node[1]
+        if float(value).is_integer() and (abs(value) < 1.0e15):
+            return "%d" % int(value)
+        return repr(float(value))
+    if kind == 'var':
+        return node[1]
+    if kind == 'neg':
+        return "-%s" % format_operand(node[1], 4)
+    if kind == 'call':
+        return "%s(%s)" % (node[1], ", ".join(_format_expression_tree(argument) for argument in node[2]))
+    operator = node[0]
+    left = format_operand(node[1], precedence[operator] + (1 if operator == '^' else 0))
+    right = format_operand(node[2], precedence[operator] + (0 if operator in ['+', '*'] else 1))
+    return "%s%s%s" % (left, operator, right)
+
+def _substitute_expression_tree(node, substitutions):
+    """
+    Replace variables (and any other subtrees) of a syntax tree by the syntax trees in the dict `substitutions`.
+
     """
-    Determine whether the specified system is periodic.
+    if node in substitutions:
+        return substitutions[node]
+    if node[0] in ['num', 'var']:
+        return node
+    if node[0] == 'call':
+        return ('call', node[1], tuple(_substitute_expression_tree(argument, substitutions) for argument in node[2]))
+    return (node[0],) + tuple(_substitute_expression_tree(child, substitutions) for child in node[1:])
+
+def _expression_tree_variables(node):
+    """
+    Return the set of variables referenced by a syntax tree.
+
+    """
+    if node[0] == 'var':
+        return set([node[1]])
+    if node[0] == 'num':
+        return set()
+    children = node[2] if (node[0] == 'call') else node[1:]
+    return set().union(*[ _expression_tree_variables(child) for child in children ])
+
+def _reduce_power(base, exponent):
+    """
+    Return the syntax tree of base^exponent, strength-reducing powers with constant exponents.
+
+    Integer powers are decomposed into squares and cubes (for example x^6 becomes (x^2)^3), which OpenMM evaluates
+    by multiplication, and square roots use sqrt().  Powers that cannot be folded exactly (such as 0^-1, or (-8)^(1/3),
+    which is not real) are left for OpenMM to evaluate.
+
+    """
+    if exponent[0] != 'num':
+        return ('^', base, exponent)
+    power = exponent[1]
+    if base[0] == 'num':
+        if (base[1] < 0.0) and not float(power).is_integer():
+            return ('^', base, exponent)
+        try:
+            return ('num', base[1]**power)
+        except (ZeroDivisionError, OverflowError):
+            return ('^', base, exponent)
+    if (base[0] == '^') and (base[2][0] == 'num') and float(base[2][1]).is_integer() and float(power).is_integer():
+        # (x^p)^n = x^(p*n) for integers p and n; for fractional p, x^p may not be real (e.g. (x^0.5)^2 for x < 0).
+        return _reduce_power(base[1], ('num', base[2][1] * power))
+    if power < 0.0:
+        return ('/', ('num', 1.0), _reduce_power(base, ('num', -power)))
+    if power == 0.0:
+        return ('num', 1.0)
+    if power == 1.0:
+        return base
+    if power == 0.5:
+        return ('call', 'sqrt', (base,))
+    if (not float(power).is_integer()) or (power <= 3.0):
+        return ('^', base, exponent)
+    power = int(power)
+    for factor in [3, 2]:
+        if (power % factor == 0) and (power // factor > 1):
+            return ('^', _reduce_power(base, ('num', float(power // factor))), ('num', float(factor)))
+    return ('^', base, exponent)
+
+def _simplify_expression_tree(node):
+    """
+    Fold constants, drop identity operations, and strength-reduce constant powers in a syntax tree.
+
+    """
+    kind = node[0]
+    if kind in ['num', 'var']:
+        return node
+    if kind == 'call':
+        return ('call', node[1], tuple(_simplify_expression_tree(argument) for argument in node[2]))
+    if kind == 'neg':
+        operand = _simplify_expression_tree(node[1])
+        if operand[0] == 'num':
+            return ('num', -operand[1])
+        if operand[0] == 'neg':
+            return operand[1]
+        return ('neg', operand)
+    (left, right) = (_simplify_expression_tree(node[1]), _simplify_expression_tree(node[2]))
+    if kind == '^':
+        return _reduce_power(left, right)
+    (left_value, right_value) = (left[1] if (left[0] == 'num') else None, right[1] if (right[0] == 'num') else None)
+    if (left_value is not None) and (right_value is not None) and not ((kind == '/') and (right_value == 0.0)):
+        return ('num', { '+' : lambda a, b: a + b, '-' : lambda a, b: a - b, '*' : lambda a, b: a * b, '/' : lambda a, b: a / b }[kind](left_value, right_value))
+    if kind == '+':
+        if left_value == 0.0:
+            return right
+        if right_value == 0.0:
+            return left
+    elif kind == '-':
+        if right_value == 0.0:
+            return left
+        if left_value == 0.0:
+            return ('neg', right)
+    elif kind == '*':
+        if (left_value == 0.0) or (right_value == 0.0):
+            return ('num', 0.0)
+        if left_value == 1.0:
+            return right
+        if right_value == 1.0:
+            return left
+        if left_value == -1.0:
+            return ('neg', right)
+        if right_value == -1.0:
+            return ('neg', left)
+        if (right[0] == '/') and (right[1] == ('num', 1.0)):
+            return ('/', left, right[2])
+        if (left[0] == '/') and (left[1] == ('num', 1.0)):
+            return ('/', right, left[2])
+    elif kind == '/':
+        if right_value == 1.0:
+            return left
+    return (kind, left, right)
+
+def _fold_expression(expression, constants):
+    """
+    Replace parameters of an OpenMM energy expression by constants, and simplify it until no more definitions are constant.
 
     Parameters
     ----------
-    system : simtk.openmm.System
-         The system to check.
+    expression : str
+        The OpenMM energy expression.
+    constants : dict of str : float
+        The values of the parameters to replace by constants; names of intermediate variables are ignored.
 
     Returns
     -------
-    is_periodic : bool
-        If True, the system uses a nonbonded method recognized as being periodic.
+    trees : collections.OrderedDict of str : tuple
+        The simplified syntax trees of the energy (keyed by None) and of the remaining intermediate variables.
 
-    Examples
-    --------
+    """
+    (energy, definitions) = _parse_expression(expression)
+    trees = collections.OrderedDict([(None, energy)] + definitions)
+    substitutions = { ('var', name) : ('num', float(value)) for (name, value) in constants.items() if name not in trees }
+
+    # Propagate constants until no more definitions become constant.
+    while True:
+        trees = collections.OrderedDict((name, _simplify_expression_tree(_substitute_expression_tree(tree, substitutions))) for (name, tree) in trees.items())
+        constant_definitions = { ('var', name) : tree for (name, tree) in trees.items() if (name is not None) and (tree[0] == 'num') }
+        if len(constant_definitions) == 0:
+            break
+        substitutions = constant_definitions
+        for key in constant_definitions:
+            del trees[key[1]]
+    return trees
+
+def _specialize_energy_expression(expression, constants, prefix='cse'):
+    """
+    Specialize an OpenMM energy expression for parameters with fixed values.
 
-    >>> from openmmtools import testsystems
+    The parameters are replaced by constants, the expression is simplified (see `_simplify_expression_tree`), unused
+    definitions are dropped, and subexpressions occurring more than once are hoisted into shared definitions.  The
+    specialized expression computes the same energy as the original one with the parameters set to `constants`.
 
-    Periodic water box.
+    Parameters
+    ----------
+    expression : str
+        The OpenMM energy expression.
+    constants : dict of str : float
+        The values of the parameters to replace by constants.
+    prefix : str, optional, default='cse'
+        Prefix of the names of hoisted common subexpressions.
 
-    >>> waterbox = testsystems.WaterBox()
-    >>> print(_is_periodic(waterbox.system))
-    True
+    Returns
+    -------
+    expression : str
+        The specialized energy expression.
 
-    Non-periodic Lennard-Jones cluster.
+    """
+    trees = _fold_expression(expression, constants)
+
+    # Hoist the largest repeated subexpression until none remain.
+    def subtrees(node):
+        if node[0] in ['num', 'var']:
+            return
+        yield node
+        for child in (node[2] if (node[0] == 'call') else node[1:]):
+            for subtree in subtrees(child):
+                yield subtree
+    def size(node):
+        return sum(1 for subtree in subtrees(node))
+    names = set(trees) | set().union(*[ _expression_tree_variables(tree) for tree in trees.values() ])
+    index = 0
+    while True:
+        counts = collections.Counter(subtree for tree in trees.values() for subtree in subtrees(tree))
+        candidates = [ subtree for (subtree, count) in counts.items() if (count > 1) and not ((subtree[0] == 'neg') and (subtree[1][0] in ['num', 'var'])) ]
+        if len(candidates) == 0:
+            break
+        subtree = max(candidates, key=lambda subtree: (size(subtree), _format_expression_tree(subtree)))
+        while '%s%d' % (prefix, index) in names:
+            index += 1
+        name = '%s%d' % (prefix, index)
+        names.add(name)
+        trees = collections.OrderedDict((key, _substitute_expression_tree(tree, { subtree : ('var', name) })) for (key, tree) in trees.items())
+        trees[name] = subtree
+
+    # Drop unused definitions, and order the rest so that every definition precedes the definitions it uses.
+    order = []
+    def visit(name):
+        if (name in order) or ((name is not None) and (name not in trees)):
+            return
+        for variable in sorted(_expression_tree_variables(trees[name])):
+            visit(variable)
+        order.append(name)
+    visit(None)
+    order.reverse()
+    return "".join("%s;" % _format_expression_tree(trees[name]) if (name is None) else " %s = %s;" % (name, _format_expression_tree(trees[name])) for name in order)
 
-    >>> cluster = testsystems.LennardJonesCluster()
-    >>> print(_is_periodic(cluster.system))
-    False
+#=============================================================================================
+# FORCE PRUNING
+#=============================================================================================
 
-    Notes
-    -----
-    This method simply checks to see if any nonbonded methods recognized to be periodic are in use.
-    Addition of new nonbonded methods or force types may require adding to recognized_periodic_methods.
+# Methods returning the number of terms of forces that do nothing without terms.
+_FORCE_TERM_COUNTS = {
+    'HarmonicBondForce' : 'getNumBonds',
+    'HarmonicAngleForce' : 'getNumAngles',
+    'PeriodicTorsionForce' : 'getNumTorsions',
+    'CustomBondForce' : 'getNumBonds',
+    'CustomAngleForce' : 'getNumAngles',
+    'CustomTorsionForce' : 'getNumTorsions',
+    }
+
+def _is_empty_force(force):
+    """
+    Return True if a force has no terms, so that its energy is always zero.
+
+    A CustomNonbondedForce is empty if it has no particles, or if each of its interaction groups has an empty set.
 
     """
-    forces = { system.getForce(index).__class__.__name__ for index in range(system.getNumForces()) }
+    force_name = force.__class__.__name__
+    if force_name in _FORCE_TERM_COUNTS:
+        return getattr(force, _FORCE_TERM_COUNTS[force_name])() == 0
+    if force_name == 'CustomNonbondedForce':
+        if force.getNumParticles() == 0:
+            return True
+        groups = [ force.getInteractionGroupParameters(index) for index in range(force.getNumInteractionGroups()) ]
+        return (len(groups) > 0) and all((len(set1) == 0) or (len(set2) == 0) for (set1, set2) in groups)
+    return False
 
-    # Only the following nonbonded methods are recognized as being periodic.
-    recognized_periodic_methods = {
-        'NonbondedForce' : [openmm.NonbondedForce.CutoffPeriodic, openmm.NonbondedForce.Ewald, openmm.NonbondedForce.PME],
-        'CustomNonbondedForce' : [openmm.CustomNonbondedForce.CutoffPeriodic],
-        'AmoebaVdwForce' : [openmm.AmoebaVdwForce.CutoffPeriodic],
-        }
+def _is_inactive_force(force, parameters=None):
+    """
+    Return True if the energy expression of a custom force is identically zero for the values of its global parameters.
 
-    for force_index in range(system.getNumForces()):
-        force = system.getForce(force_index)
-        force_name = force.__class__.__name__
-        if force_name in recognized_periodic_methods:
-            method = force.getNonbondedMethod()
-            if method in recognized_periodic_methods[force_name]:
-                return True
+    Parameters
+    ----------
+    force : simtk.openmm.Force
+        The force; only CustomBondForce, CustomAngleForce, CustomTorsionForce, and CustomNonbondedForce are analyzed.
+    parameters : dict of str : float, optional, default=None
+        Values overriding the default values of global parameters of the force.
 
-    # Nothing we recognize was found, so assume system was not periodic.
-    return False
+    """
+    if force.__class__.__name__ not in ['CustomBondForce', 'CustomAngleForce', 'CustomTorsionForce', 'CustomNonbondedForce']:
+        return False
+    values = { force.getGlobalParameterName(index) : force.getGlobalParameterDefaultValue(index) for index in range(force.getNumGlobalParameters()) }
+    if parameters is not None:
+        values.update((name, value) for (name, value) in parameters.items() if name in values)
+    return _fold_expression(force.getEnergyFunction(), values)[None] == ('num', 0.0)
+
+def _time_softcore_forces(system, positions, platform=None, nevaluations=10):
+    """
+    Return the time (in seconds) per evaluation of energies and forces of the CustomNonbondedForces of a System.
+
+    The forces are evaluated `nevaluations` times at `positions`, after one untimed evaluation; other forces are removed
+    from a copy of the System.
+
+    """
+    system = copy.deepcopy(system)
+    for force_index in reversed(range(system.getNumForces())):
+        if not isinstance(system.getForce(force_index), openmm.CustomNonbondedForce):
+            system.removeForce(force_index)
+    integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+    context = openmm.Context(system, integrator, platform) if (platform is not None) else openmm.Context(system, integrator)
+    context.setPositions(positions)
+    context.getState(getEnergy=True, getForces=True)
+    initial_time = time.time()
+    for evaluation in range(nevaluations):
+        context.getState(getEnergy=True, getForces=True)
+    elapsed_time = (time.time() - initial_time) / nevaluations
+    del context, integrator
+    return elapsed_time
+
+def _describe_pruned_force(force_index, force, reason):
+    """
+    Describe a force removed from a System for pruning reports.
+
+    """
+    return { 'force_index' : force_index, 'force_class' : force.__class__.__name__, 'role' : _alchemical_force_role(force), 'reason' : reason }
+
+#=============================================================================================
+# FORCE GROUPS
+#=============================================================================================
+
+# Force groups of alchemically-modified systems, keyed by the role of the forces they contain.
+# 'lambda_independent' : forces that do not depend on the alchemical state
+# 'lambda_bonds', 'lambda_angles', 'lambda_torsions' : alchemically-softened bonds, angles, and torsions
+# 'lambda_electrostatics', 'lambda_sterics' : other forces depending only on electrostatics (e.g. generalized Born) or sterics lambdas
+# 'lambda_nonbonded' : other forces depending on both (e.g. alchemical exceptions)
+# 'softcore_electrostatics', 'softcore_sterics', 'softcore_nonbonded' : the expensive softcore CustomNonbondedForces
+# 'lambda_other' : forces depending on any other combination of alchemical parameters
+ALCHEMICAL_FORCE_GROUPS = {
+    'lambda_independent' : 0,
+    'lambda_bonds' : 1,
+    'lambda_angles' : 2,
+    'lambda_torsions' : 3,
+    'lambda_electrostatics' : 4,
+    'lambda_sterics' : 5,
+    'lambda_nonbonded' : 6,
+    'softcore_electrostatics' : 7,
+    'softcore_sterics' : 8,
+    'softcore_nonbonded' : 9,
+    'lambda_other' : 10,
+    }
+
+def _alchemical_force_role(force):
+    """
+    Return the role of a force of an alchemically-modified system, as a key of `ALCHEMICAL_FORCE_GROUPS`.
+
+    The role is determined by the families of alchemical parameters ('lambda_[family]' or 'lambda_[family]_[region]')
+    among the global parameters of the force, and by whether it is a CustomNonbondedForce.
+
+    """
+    families = set()
+    if hasattr(force, 'getNumGlobalParameters'):
+        for index in range(force.getNumGlobalParameters()):
+            name = force.getGlobalParameterName(index)
+            if name.startswith('lambda_'):
+                families.add(name.split('_')[1])
+    prefix = 'softcore_' if isinstance(force, openmm.CustomNonbondedForce) else 'lambda_'
+    if len(families) == 0:
+        return 'lambda_independent'
+    elif families == set(['electrostatics', 'sterics']):
+        return prefix + 'nonbonded'
+    elif (len(families) == 1) and families.issubset(['electrostatics', 'sterics']):
+        return prefix + families.pop()
+    elif (len(families) == 1) and families.issubset(['bonds', 'angles', 'torsions']):
+        return 'lambda_' + families.pop()
+    return 'lambda_other'
+
+def _create_multiple_time_step_integrator(timestep, levels):
+    """
+    Create a reversible multiple-time-step (r-RESPA) velocity Verlet integrator.
+
+    Parameters
+    ----------
+    timestep : simtk.unit.Quantity with units compatible with femtoseconds
+        The outer timestep.
+    levels : list of (list of int, int)
+        levels[i] = (groups, substeps) integrates the forces of the given force groups with timestep/substeps.
+        Levels are ordered from the outermost to the innermost, and the substeps of each level must be a multiple of
+        the substeps of the level before it.
+
+    Returns
+    -------
+    integrator : simtk.openmm.CustomIntegrator
+        The integrator.
+
+    """
+    integrator = openmm.CustomIntegrator(timestep)
+    integrator.addPerDofVariable("x1", 0)
+    integrator.addUpdateContextState()
+    def add_substeps(level_index, parent_substeps):
+        (groups, substeps) = levels[level_index]
+        force = '(%s)' % '+'.join( 'f%d' % group for group in groups )
+        for step in range(substeps // parent_substeps):
+            integrator.addComputePerDof("v", "v+0.5*(dt/%d)*%s/m" % (substeps, force))
+            if level_index == len(levels) - 1:
+                integrator.addComputePerDof("x1", "x")
+                integrator.addComputePerDof("x", "x+(dt/%d)*v" % substeps)
+                integrator.addConstrainPositions()
+                integrator.addComputePerDof("v", "(x-x1)/(dt/%d)" % substeps)
+            else:
+                add_substeps(level_index + 1, substeps)
+            integrator.addComputePerDof("v", "v+0.5*(dt/%d)*%s/m" % (substeps, force))
+    add_substeps(0, 1)
+    integrator.addConstrainVelocities()
+    return integrator
 
 #=============================================================================================
 # AlchemicalState
@@ -134,6 +2254,10 @@ class AlchemicalState(dict):
         Scaling factor for alchemically-softened angles.
     labmda_bonds : float
         Scaling factor for alchemically-softened bonds.
+    lambda_sterics_<name>, lambda_electrostatics_<name> : float
+        Scaling factors for the sterics and electrostatics of the named alchemical region `name`
+        (see the `alchemical_regions` argument of `AbsoluteAlchemicalFactory`); regions not listed are left fully interacting
+        in newly created systems and unchanged in perturbed ones.
 
     """
     def __init__(self, **kwargs):
@@ -146,7 +2270,7 @@ class AlchemicalState(dict):
 
         for key in kwargs.keys():
             # Raise an exception if we don't know how to handle a specified parameter.
-            if key not in self:
+            if (key not in self) and not key.startswith(('lambda_sterics_', 'lambda_electrostatics_')):
                 raise Exception("AlchemicalState parameter '%s' unknown" % key)
 
             self[key] = kwargs[key]
@@ -241,7 +2365,12 @@ class AbsoluteAlchemicalFactory(object):
                  annihilate_electrostatics=True, annihilate_sterics=False,
                  softcore_alpha=0.5, softcore_beta=1.0, softcore_a=1, softcore_b=1, softcore_c=6, softcore_d=1, softcore_e=1, softcore_f=2,
                  alchemical_functions=None,
-                 test_positions=None, platform=None):
+                 test_positions=None, platform=None, cache=None, alchemical_region_capacity=None,
+                 alchemical_regions=None, nonbonded_layout='split', assign_force_groups=False, dispersion_correction='native',
+                 tabulate_softcore=False, softcore_table_size=(512, 101),
+                 freeze_softcore_parameters=None, prune_empty_forces=False, interaction_topology='full',
+                 region_decomposition='interaction_groups', native_electrostatics=False,
+                 local_environment_radius=None, local_environment_buffer=0.2*unit.nanometers):
         """
         Initialize absolute alchemical intermediate factory with reference system.
 
@@ -289,11 +2418,108 @@ class AbsoluteAlchemicalFactory(object):
             If the potential energy is NaN, the energy for each force component will be computed for the Reference platform to aid in debugging.
         platform : simtk.openmm.Platform, optionl default=None
             If provided, this Platform will be used to check energies are finite.
+        cache : AlchemicalTemplateCache, optional, default=None
+            If provided, the alchemically-modified system (and lists of alchemical bonds, angles, and torsions) are retrieved
+            from this cache when the reference system and all arguments match a previous factory, and stored in it otherwise.
+            The cache key is stored as `cache_key`.
+        alchemical_region_capacity : list of int, optional, default=None
+            If provided, the set of atoms (a superset of `ligand_atoms`) that may later be made alchemical with `updateAlchemicalRegion`.
+            Softcore interactions, alchemical exceptions, and (automatically selected) alchemical bonds, angles, and torsions are then
+            created for all of these atoms, and flagged as alchemical or not with a per-particle or per-term 'alchemical' parameter,
+            so that the alchemical region can be changed in an existing Context without rebuilding it.
+        alchemical_regions : dict of str : list of int, optional, default=None
+            If provided, additional named alchemical regions, disjoint from each other and from `ligand_atoms`.
+            Sterics and electrostatics of region `name` are controlled by the global parameters 'lambda_sterics_[name]' and
+            'lambda_electrostatics_[name]', while `ligand_atoms` remain controlled by 'lambda_sterics' and 'lambda_electrostatics'.
+            Interactions within a region are scaled by the region lambda, and interactions between two regions by the product of
+            their lambdas.  Alchemical bonds, angles, and torsions of all regions share the common 'lambda_bonds', 'lambda_angles',
+            and 'lambda_torsions' parameters.  Cannot be combined with `alchemical_region_capacity`.
+        nonbonded_layout : str, optional, default='split'
+            Layout of the softcore forces replacing NonbondedForce interactions of alchemical atoms.
+            'split' creates separate CustomNonbondedForces for sterics and electrostatics.
+            'fused' creates a single CustomNonbondedForce that evaluates both in one pass over the interacting pairs, with
+            shared per-particle parameters.  The switching function of sterics is then applied within the energy expression.
+            Since the long-range correction of a CustomNonbondedForce applies to its whole energy, the 'split' layout is
+            used instead (with a warning) if the reference NonbondedForce uses both a switching function and a dispersion
+            correction, unless `dispersion_correction` is 'precomputed'.
+        assign_force_groups : bool, optional, default=False
+            If True, every force of the alchemically-modified system is placed in the force group of its role given by
+            `ALCHEMICAL_FORCE_GROUPS` (see `getForceGroupLayout`), replacing any force groups assigned in the reference
+            system, including those of forces copied without modification.  If False, copied forces keep their force
+            groups and alchemically-modified forces are placed in force group 0.  Assigning force groups allows the
+            alchemical energy to be evaluated separately and the softcore forces to be integrated with a longer timestep
+            (see `createMultipleTimeStepIntegrator`).
+        dispersion_correction : str, optional, default='native'
+            Treatment of the long-range dispersion correction of softcore sterics, if the reference system uses one.
+            'native' enables the long-range correction of the softcore CustomNonbondedForce, which OpenMM recomputes by
+            numerical integration whenever a global parameter such as lambda_sterics changes.
+            'precomputed' tabulates the correction as a function of lambda_sterics when the system is created, for the
+            softcore parameters given to the factory, and applies it through a separate CustomCVForce scaling the global
+            parameter INVERSE_VOLUME_PARAMETER, so that changing alchemical parameters does not trigger any recomputation.
+            The inverse box volume is not updated by the Context, so it must be set along with the box vectors, and
+            cannot follow a barostat.
+            Cannot be combined with `alchemical_regions` or `alchemical_region_capacity`, or with a barostat.
+        tabulate_softcore : bool, optional, default=False
+            If True, the softcore CustomNonbondedForces interpolate precomputed kernels instead of evaluating the analytic
+            softcore expressions: softcore sterics is tabulated as a Continuous2DFunction of (r/sigma, lambda_sterics), and
+            Ewald direct-space electrostatics as a Continuous1DFunction of the effective softcore distance.  The kernels
+            are computed for the softcore parameters given to the factory, so changing the softcore global parameters of a
+            Context has no effect on them.  Exceptions are still computed analytically.  If the reference system uses a
+            dispersion correction, `dispersion_correction` must be 'precomputed'.
+            Use `computeSoftcoreTableErrors` to check the accuracy of the tables.
+        softcore_table_size : tuple of int, optional, default=(512, 101)
+            The number of grid points of tabulated kernels along r/sigma (or the effective distance) and lambda.
+        freeze_softcore_parameters : list of str or bool, optional, default=None
+            Softcore parameters (from `SOFTCORE_PARAMETERS`, or all of them if True) to freeze at the values given to the
+            factory.  Frozen parameters are not added as global parameters; instead, the energy expressions of the softcore
+            forces are specialized for their values, with constants folded, powers strength-reduced (x^1 is dropped, x^(1/2)
+            becomes sqrt(x), and x^6 becomes (x^2)^3), and repeated subexpressions shared.
+        prune_empty_forces : bool, optional, default=False
+            If True, forces without any terms (such as the CustomBondForce for alchemical exceptions when sterics are not
+            annihilated) are removed from the alchemically-modified system.  Removed forces are listed by `getPruningReport`.
+            Since this changes the number and indices of forces, it is off by default.
+        interaction_topology : str, optional, default='full'
+            Interaction groups and exclusions of the softcore CustomNonbondedForces.
+            'full' evaluates alchemical atoms against all atoms in a single interaction group, and excludes every exception of
+            the reference NonbondedForce.
+            'minimal' splits the interaction group into alchemical-environment and alchemical-alchemical pairs, and only
+            excludes exceptions involving an alchemical atom, since no other pair is evaluated.  Both give identical energies,
+            but since 'minimal' changes the exclusions and interaction groups of the softcore forces, it must be requested
+            explicitly; see `getInteractionTopologyReport`.
+        region_decomposition : str, optional, default='interaction_groups'
+            How the softcore CustomNonbondedForces select the pairs involving alchemical atoms.
+            'interaction_groups' restricts them to interaction groups of the alchemical atoms (see `interaction_topology`),
+            which is efficient for small alchemical regions.
+            'masked' evaluates all pairs with the standard neighbor list and flags alchemical particles, so that pairs
+            between environment atoms vanish; this is cheaper when the alchemical region is a large fraction of the system,
+            such as an annihilated protein.
+            'auto' times the softcore forces of both decompositions at `test_positions` on `platform` and uses the cheaper
+            one (see `region_decomposition_timings`); 'interaction_groups' is used if `test_positions` is not given.
+            'masked' cannot be combined with `alchemical_regions`.
+        native_electrostatics : bool, optional, default=False
+            If True, electrostatics are scaled linearly by rescaling the charges of alchemical atoms in the native
+            NonbondedForce and GBSAOBCForce, which are kept in the alchemically-modified system; softcore custom forces are
+            only used for sterics.  The charges are set by `createPerturbedSystem`, `perturbNativeSystem`, and
+            `perturbNativeContext` (which uses `updateParametersInContext`).  Pairs of alchemical atoms, including exceptions,
+            are scaled by lambda_electrostatics^2, and exceptions between an alchemical and an environment atom by
+            lambda_electrostatics; reciprocal-space interactions of alchemical atoms are included, and alchemical atoms keep
+            descreening other atoms and their surface area term in GBSA.  Requires softcore_beta=0 and softcore_d=1, and
+            cannot be combined with `alchemical_functions`, `alchemical_regions`, `alchemical_region_capacity`, or the
+            'fused' nonbonded layout.
+        local_environment_radius : simtk.unit.Quantity with units compatible with nanometers, optional, default=None
+            If specified, the softcore CustomNonbondedForces of nonperiodic systems only include environment atoms within
+            this distance of an alchemical atom at `test_positions` (which are then required), plus
+            `local_environment_buffer`; interactions between alchemical atoms and the remaining environment are neglected,
+            since their parameters are zeroed in the native forces.  Call `updateLocalEnvironment` periodically to refresh
+            the selection, and `computeLocalEnvironmentError` to compute the neglected energy.  With a GBSAOBCForce, the
+            CustomGBForce still includes all pairs unless `native_electrostatics` is True.
+        local_environment_buffer : simtk.unit.Quantity with units compatible with nanometers, optional, default=0.2 nm
+            Additional distance within which environment atoms are selected, so that the selection only has to be rebuilt
+            when an environment atom moves from beyond it to within `local_environment_radius` of an alchemical atom.
 
         TODO:
         * Can we use a Topology object to simplify this?
         * Can we replace ligand_atoms and receptor_atoms with just alchemical_atoms?
-        * Can we specify multiple groups of alchemically-modified atoms that have different alchemical parameters associated with them, like `lambda_sterics_[groupname]`?
         * Can we collect related parameters (e.g. softcore parameters) into a dict?
 
         """
@@ -313,12 +2539,84 @@ class AbsoluteAlchemicalFactory(object):
         if self.alchemical_functions == None:
             self.alchemical_functions = dict()
 
+        if nonbonded_layout not in ['split', 'fused']:
+            raise Exception("Unknown nonbonded layout '%s'; must be one of 'split' or 'fused'." % nonbonded_layout)
+        self.nonbonded_layout = nonbonded_layout
+        self.assign_force_groups = assign_force_groups
+
+        if dispersion_correction not in ['native', 'precomputed']:
+            raise Exception("Unknown dispersion correction '%s'; must be one of 'native' or 'precomputed'." % dispersion_correction)
+        if (dispersion_correction == 'precomputed') and ((alchemical_regions is not None) or (alchemical_region_capacity is not None)):
+            raise Exception("A precomputed dispersion correction cannot be combined with alchemical_regions or alchemical_region_capacity.")
+        if (dispersion_correction == 'precomputed') and any([ 'Barostat' in force.__class__.__name__ for force in reference_system.getForces() ]):
+            raise Exception("A precomputed dispersion correction cannot be combined with a barostat, which does not update the inverse box volume.")
+        self.dispersion_correction = dispersion_correction
+
+        if (len(softcore_table_size) != 2) or (min(softcore_table_size) < 4):
+            raise Exception("softcore_table_size must be a pair of grid sizes of at least 4 points; got %s." % str(softcore_table_size))
+        self.tabulate_softcore = tabulate_softcore
+        self.softcore_table_size = tuple(int(size) for size in softcore_table_size)
+
+        if freeze_softcore_parameters is True:
+            freeze_softcore_parameters = SOFTCORE_PARAMETERS
+        elif freeze_softcore_parameters in [None, False]:
+            freeze_softcore_parameters = []
+        for name in freeze_softcore_parameters:
+            if name not in SOFTCORE_PARAMETERS:
+                raise Exception("Unknown softcore parameter '%s'; must be one of %s." % (name, ', '.join(SOFTCORE_PARAMETERS)))
+        self.frozen_softcore_parameters = { name : getattr(self, name) for name in freeze_softcore_parameters }
+        self.prune_empty_forces = prune_empty_forces
+
+        if interaction_topology not in ['full', 'minimal']:
+            raise Exception("Unknown interaction topology '%s'; must be one of 'full' or 'minimal'." % interaction_topology)
+        self.interaction_topology = interaction_topology
+
+        if region_decomposition not in ['interaction_groups', 'masked', 'auto']:
+            raise Exception("Unknown region decomposition '%s'; must be one of 'interaction_groups', 'masked', or 'auto'." % region_decomposition)
+        if (region_decomposition == 'masked') and (alchemical_regions is not None):
+            raise Exception("The 'masked' region decomposition cannot be combined with alchemical_regions.")
+        self.region_decomposition = region_decomposition
+        self.region_decomposition_timings = None
+
+        if native_electrostatics:
+            if (softcore_beta != 0.0) or (softcore_d != 1):
+                raise Exception("Native electrostatics require linear electrostatics scaling (softcore_beta=0 and softcore_d=1).")
+            if (len(self.alchemical_functions) > 0) or (alchemical_regions is not None) or (alchemical_region_capacity is not None):
+                raise Exception("Native electrostatics cannot be combined with alchemical_functions, alchemical_regions, or alchemical_region_capacity.")
+            if nonbonded_layout == 'fused':
+                raise Exception("Native electrostatics require the 'split' nonbonded layout.")
+        self.native_electrostatics = native_electrostatics
+
+        if local_environment_radius is not None:
+            if region_decomposition != 'interaction_groups':
+                raise Exception("A local environment requires the 'interaction_groups' region decomposition.")
+            if test_positions is None:
+                raise Exception("A local environment requires test_positions to select the initial environment atoms.")
+            for force in reference_system.getForces():
+                if isinstance(force, openmm.NonbondedForce) and (force.getNonbondedMethod() not in [openmm.NonbondedForce.NoCutoff, openmm.NonbondedForce.CutoffNonPeriodic]):
+                    raise Exception("A local environment can only be used for nonperiodic systems.")
+                if isinstance(force, openmm.GBSAOBCForce) and not native_electrostatics:
+                    logger.warning("The alchemically-modified GBSAOBCForce includes all pairs regardless of the local environment; consider native_electrostatics=True.")
+        self.local_environment_radius = local_environment_radius
+        self.local_environment_buffer = local_environment_buffer
+
         # Store serialized form of reference system.
-        self.reference_system = copy.deepcopy(reference_system)
+        self._reference_xml = None
+        if cache is not None:
+            self._reference_xml = openmm.XmlSerializer.serialize(reference_system)
+            self.reference_system = openmm.XmlSerializer.deserialize(self._reference_xml)
+        else:
+            self.reference_system = copy.deepcopy(reference_system)
 
         # Store reference forces.
         self.reference_forces = { self.reference_system.getForce(index).__class__.__name__ : self.reference_system.getForce(index) for index in range(self.reference_system.getNumForces()) }
 
+        # Parameters of reference forces are extracted into columnar tables on first use (see `reference_force_tables`).
+        self._reference_force_tables = None
+
+        # The bond graph of the reference system is built on first use (see `molecular_graph`).
+        self._molecular_graph = None
+
         # Store copy of atom sets.
         all_particles_set = set(range(reference_system.getNumParticles()))
         if not (set(ligand_atoms).issubset(all_particles_set)):
@@ -330,21 +2628,122 @@ class AbsoluteAlchemicalFactory(object):
         # Store atom sets
         self.ligand_atomset = set(self.ligand_atoms)
 
+        # Store boolean mask of alchemically-modified particles.
+        self.alchemical_atom_mask = np.zeros([reference_system.getNumParticles()], bool)
+        self.alchemical_atom_mask[list(self.ligand_atoms)] = True
+
+        # Store named alchemical regions, and the index of the region of each particle:
+        # 0 for the environment, 1 for ligand atoms, and 2, 3, ... for named regions in sorted order (or None).
+        self.alchemical_regions = None
+        self.alchemical_region_index = None
+        if alchemical_regions is not None:
+            if alchemical_region_capacity is not None:
+                raise Exception("alchemical_regions cannot be combined with alchemical_region_capacity.")
+            self.alchemical_regions = { name : list(atoms) for (name, atoms) in alchemical_regions.items() }
+            self.alchemical_region_index = self.alchemical_atom_mask.astype(np.int32)
+            for (region_index, name) in enumerate(sorted(self.alchemical_regions)):
+                if not re.match(r'^[A-Za-z0-9_]+$', name):
+                    raise Exception("Alchemical region name '%s' may only contain letters, digits, and underscores." % name)
+                atoms = self.alchemical_regions[name]
+                if not set(atoms).issubset(all_particles_set):
+                    raise Exception("Alchemical region '%s' contains atoms that are not in the system: %s" % (name, str(set(atoms).difference(all_particles_set))))
+                if np.any(self.alchemical_region_index[atoms] != 0):
+                    raise Exception("Alchemical region '%s' overlaps with ligand atoms or another region." % name)
+                self.alchemical_region_index[atoms] = region_index + 2
+            self.alchemical_atom_mask = (self.alchemical_region_index > 0)
+
+        # Store boolean mask of atoms that may become alchemical in an existing Context (or None).
+        self.capacity_atom_mask = None
+        if alchemical_region_capacity is not None:
+            self.capacity_atom_mask = self._indexMask(alchemical_region_capacity, reference_system.getNumParticles())
+            if np.any(self.alchemical_atom_mask & ~self.capacity_atom_mask):
+                raise Exception("alchemical_region_capacity must include all ligand atoms.")
+
+        # Store boolean mask of environment atoms included in the softcore forces (or None for all).
+        self.local_environment_mask = None
+        if self.local_environment_radius is not None:
+            self.local_environment_mask = self._selectLocalEnvironment(test_positions, self.local_environment_radius + self.local_environment_buffer)
+
+        # Record whether alchemical bonds and angles are selected automatically from the alchemical region.
+        self._automatic_alchemical_bonds = (alchemical_bonds is True)
+        self._automatic_alchemical_angles = (alchemical_angles is True)
+        self._automatic_alchemical_torsions = (alchemical_torsions is True)
+
         # Store specified lists of alchemical bonds, angles, and torsions to soften (or None).
         self.alchemical_bonds = alchemical_bonds
         self.alchemical_angles = alchemical_angles
         self.alchemical_torsions = alchemical_torsions
 
-        # If True was specified, build lists of bonds, angles, or torsions involving alchemical atoms.
-        if self.alchemical_bonds is True:
-            self.alchemical_bonds = self._buildAlchemicalBondList(self.ligand_atomset)
-        if self.alchemical_angles is True:
-            self.alchemical_angles = self._buildAlchemicalAngleList(self.ligand_atomset)
-        if self.alchemical_torsions is True:
-            self.alchemical_torsions = self._buildAlchemicalTorsionList(self.ligand_atomset)
+        # Look up the alchemically-modified system in the cache.
+        entry = None
+        self.cache_key = None
+        if cache is not None:
+            def normalize(value):
+                if (value is None) or (value is True) or (value is False):
+                    return value
+                return [ int(index) for index in value ]
+            arguments = { 'ligand_atoms' : normalize(self.ligand_atoms),
+                          'alchemical_bonds' : normalize(alchemical_bonds), 'alchemical_angles' : normalize(alchemical_angles), 'alchemical_torsions' : normalize(alchemical_torsions),
+                          'annihilate_electrostatics' : annihilate_electrostatics, 'annihilate_sterics' : annihilate_sterics,
+                          'softcore' : (softcore_alpha, softcore_beta, softcore_a, softcore_b, softcore_c, softcore_d, softcore_e, softcore_f),
+                          'alchemical_functions' : sorted(self.alchemical_functions.items()),
+                          'alchemical_region_capacity' : normalize(alchemical_region_capacity),
+                          'alchemical_regions' : sorted((name, normalize(atoms)) for (name, atoms) in alchemical_regions.items()) if (alchemical_regions is not None) else None,
+                          'nonbonded_layout' : nonbonded_layout, 'assign_force_groups' : assign_force_groups,
+                          'dispersion_correction' : dispersion_correction,
+                          'tabulate_softcore' : tabulate_softcore, 'softcore_table_size' : list(self.softcore_table_size) if tabulate_softcore else None,
+                          'frozen_softcore_parameters' : sorted(self.frozen_softcore_parameters), 'prune_empty_forces' : prune_empty_forces,
+                          'interaction_topology' : interaction_topology, 'region_decomposition' : region_decomposition,
+                          'native_electrostatics' : native_electrostatics,
+                          'local_environment' : normalize(np.where(self.local_environment_mask)[0]) if (self.local_environment_mask is not None) else None }
+            self.cache_key = cache.fingerprint(self._reference_xml, arguments)
+            entry = cache.get(self.cache_key)
+
+        if entry is not None:
+            logger.debug("Retrieved alchemically-modified system from cache.")
+            self.alchemical_bonds = entry['alchemical_bonds']
+            self.alchemical_angles = entry['alchemical_angles']
+            self.alchemical_torsions = entry['alchemical_torsions']
+            self.alchemically_modified_system = openmm.XmlSerializer.deserialize(entry['alchemically_modified_system'])
+            self.pruned_forces = entry.get('pruned_forces', list())
+            self.region_decomposition = entry.get('region_decomposition', self.region_decomposition)
+            self._region_terms = entry.get('region_terms')
+        else:
+            # If True was specified, build lists of bonds, angles, or torsions involving alchemical atoms.
+            if self.alchemical_bonds is True:
+                self.alchemical_bonds = self._buildAlchemicalBondList(self.alchemical_atom_mask)
+            if self.alchemical_angles is True:
+                self.alchemical_angles = self._buildAlchemicalAngleList(self.alchemical_atom_mask)
+            if self.alchemical_torsions is True:
+                self.alchemical_torsions = self._buildAlchemicalTorsionList(self.alchemical_atom_mask)
+
+            # Select the cheaper decomposition of the alchemical region by timing both.
+            if self.region_decomposition == 'auto':
+                self.region_decomposition = self._selectRegionDecomposition(test_positions, platform)
+
+            # Create an alchemically-modified system to cache
+            self.alchemically_modified_system = self._createAlchemicallyModifiedSystem(self.reference_system)
+
+            if cache is not None:
+                cache.put(self.cache_key, { 'alchemically_modified_system' : openmm.XmlSerializer.serialize(self.alchemically_modified_system),
+                                            'alchemical_bonds' : self.alchemical_bonds, 'alchemical_angles' : self.alchemical_angles, 'alchemical_torsions' : self.alchemical_torsions,
+                                            'pruned_forces' : self.pruned_forces, 'region_decomposition' : self.region_decomposition,
+                                            'region_terms' : self._region_terms })
+
+        # Perturbed systems shared among identical alchemical states, kept for as long as a caller holds them.
+        self._shared_perturbed_systems = weakref.WeakValueDictionary()
 
-        # Create an alchemically-modified system to cache
-        self.alchemically_modified_system = self._createAlchemicallyModifiedSystem(self.reference_system)
+        # Systems with only native forces equivalent to endpoint alchemical states, keyed by endpoint kind.
+        self._endpoint_systems = dict()
+
+        # Charges of alchemical atoms in native forces, scaled by lambda_electrostatics (see `_nativeElectrostaticsTerms`).
+        self._native_electrostatics_terms = self._nativeElectrostaticsTerms() if self.native_electrostatics else None
+
+        # Environment atoms included in the softcore forces of Contexts whose local environment was updated.
+        self._local_environment_masks = weakref.WeakKeyDictionary()
+
+        # Energies of the reference system, keyed by a hash of the test positions and the platform name.
+        self._reference_energies = dict()
 
         # Store information for use in aiding debugging of alchemical factory
         self.test_positions = test_positions
@@ -366,53 +2765,77 @@ class AbsoluteAlchemicalFactory(object):
 
         return
 
-    @classmethod
-    def _tabulateBonds(cls, system):
+    def __getstate__(self):
         """
-        Tabulate bonds for the specified system.
+        Return the state of the factory for pickling (for example, to send it to worker processes).
 
-        Parameters
-        ----------
-        system : simtk.openmm.System
-            The system for which bonds are to be tabulated.
+        Systems are serialized to XML and the platform is stored by name.  Perturbed systems, endpoint systems, and local
+        environments of Contexts are not part of the state.
 
-        Returns
-        -------
-        bonds : list of set
-            bonds[i] is the set of bonds to atom i
+        """
+        state = self.__dict__.copy()
+        for name in ['reference_system', 'alchemically_modified_system']:
+            state[name] = openmm.XmlSerializer.serialize(state[name])
+        state['platform'] = self.platform.getName() if (self.platform is not None) else None
+        for name in ['reference_forces', '_shared_perturbed_systems', '_endpoint_systems', '_local_environment_masks']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore the state of the factory returned by `__getstate__`.
 
-        TODO:
-        * Could we use a Topology object to simplify this?
+        """
+        self.__dict__.update(state)
+        for name in ['reference_system', 'alchemically_modified_system']:
+            setattr(self, name, openmm.XmlSerializer.deserialize(state[name]))
+        if self.platform is not None:
+            self.platform = openmm.Platform.getPlatformByName(self.platform)
+        self.reference_forces = { self.reference_system.getForce(index).__class__.__name__ : self.reference_system.getForce(index) for index in range(self.reference_system.getNumForces()) }
+        self._shared_perturbed_systems = weakref.WeakValueDictionary()
+        self._endpoint_systems = dict()
+        self._local_environment_masks = weakref.WeakKeyDictionary()
+
+    @property
+    def reference_force_tables(self):
+        """
+        Columnar tables of reference force parameters, indexed by force index (see `_tabulate_force`).
+
+        Tables are extracted once, on first use.
 
         """
-        bonds = [ set() for particle_index in range(system.getNumParticles()) ]
+        if self._reference_force_tables is None:
+            self._reference_force_tables = [ _tabulate_force(self.reference_system.getForce(index)) for index in range(self.reference_system.getNumForces()) ]
+        return self._reference_force_tables
 
-        forces = { system.getForce(index).__class__.__name__ : system.getForce(index) for index in range(system.getNumForces()) }
+    @property
+    def molecular_graph(self):
+        """
+        Bond graph of the reference system (see `MolecularGraph`), built once, on first use.
 
-        # Process HarmonicBondForce
-        bond_force = forces['HarmonicBondForce']
-        for bond_index in range(bond_force.getNumBonds()):
-            [particle1, particle2, r, K] = bond_force.getBondParameters(bond_index)
-            bonds[particle1].add(particle2)
-            bonds[particle2].add(particle1)
-        # Process constraints.
-        for constraint_index in range(system.getNumConstraints()):
-            [particle1, particle2, r] = system.getConstraintParameters(constraint_index)
-            bonds[particle1].add(particle2)
-            bonds[particle2].add(particle1)
+        """
+        if self._molecular_graph is None:
+            self._molecular_graph = MolecularGraph.fromSystem(self.reference_system, force_tables=self.reference_force_tables)
+        return self._molecular_graph
 
-        # TODO: Process CustomBondForce?
+    def _referenceForceTable(self, force_name, kind):
+        """
+        Return the columnar table of terms of the reference force `self.reference_forces[force_name]`.
 
-        return bonds
+        """
+        force_indices = [ index for index in range(self.reference_system.getNumForces()) if self.reference_system.getForce(index).__class__.__name__ == force_name ]
+        if len(force_indices) == 0:
+            raise KeyError(force_name)
+        return self.reference_force_tables[force_indices[-1]][kind]
 
-    def _buildAlchemicalTorsionList(self, alchemical_atomset):
+    def _buildAlchemicalTorsionList(self, alchemical_atom_mask):
         """
         Build a list of proper torsion indices that involve any alchemical atom.
 
         Parameters
         ----------
-        alchemical_atomset : set of int
-            The set of alchemically modified atoms
+        alchemical_atom_mask : numpy array of bool
+            alchemical_atom_mask[i] is True if atom i is alchemically modified
 
         Returns
         -------
@@ -420,37 +2843,19 @@ class AbsoluteAlchemicalFactory(object):
             The list of torsion indices that should be alchemically softened
 
         """
+        particles = _term_particles(self._referenceForceTable('PeriodicTorsionForce', 'torsions'), 4)
+        alchemical = np.any(alchemical_atom_mask[particles], axis=1)
+        alchemical[alchemical] = self.molecular_graph.isProperTorsion(particles[alchemical])
+        return np.where(alchemical)[0].tolist()
 
-        # Tabulate all bonds
-        bonds = self._tabulateBonds(self.reference_system)
-        def is_bonded(i,j):
-            if j in bonds[i]:
-                return True
-            return False
-        def is_proper_torsion(i,j,k,l):
-            if is_bonded(i,j) and is_bonded(j,k) and is_bonded(k,l):
-                return True
-            return False
-
-        # Create a list of proper torsions that involve any alchemical atom.
-        torsion_list = list()
-        force = self.reference_forces['PeriodicTorsionForce']
-        for torsion_index in range(force.getNumTorsions()):
-            [particle1, particle2, particle3, particle4, periodicity, phase, k] = force.getTorsionParameters(torsion_index)
-            if set([particle1,particle2,particle3,particle4]).intersection(alchemical_atomset):
-                if is_proper_torsion(particle1,particle2,particle3,particle4):
-                    torsion_list.append(torsion_index)
-
-        return torsion_list
-
-    def _buildAlchemicalAngleList(self, alchemical_atomset):
+    def _buildAlchemicalAngleList(self, alchemical_atom_mask):
         """
         Build a list of angle indices that involve any alchemical atom.
 
         Parameters
         ----------
-        alchemical_atomset : set of int
-            The set of alchemically modified atoms
+        alchemical_atom_mask : numpy array of bool
+            alchemical_atom_mask[i] is True if atom i is alchemically modified
 
         Returns
         -------
@@ -458,23 +2863,17 @@ class AbsoluteAlchemicalFactory(object):
             The list of angle indices that should be alchemically softened
 
         """
-        angle_list = list()
-        force = self.reference_forces['HarmonicAngleForce']
-        for angle_index in range(force.getNumAngles()):
-            [particle1, particle2, particle3, theta0, K] = force.getAngleParameters(angle_index)
-            if set([particle1,particle2,particle3]).intersection(alchemical_atomset):
-                angle_list.append(angle_index)
+        particles = _term_particles(self._referenceForceTable('HarmonicAngleForce', 'angles'), 3)
+        return np.where(np.any(alchemical_atom_mask[particles], axis=1))[0].tolist()
 
-        return angle_list
-
-    def _buildAlchemicalBondList(self, alchemical_atomset):
+    def _buildAlchemicalBondList(self, alchemical_atom_mask):
         """
-        Build a list of bond indices that involve any alchemical atom, allowing a list of bonds to override.
+        Build a list of bond indices that involve any alchemical atom.
 
         Parameters
         ----------
-        alchemical_atomset : set of int
-            The set of alchemically modified atoms
+        alchemical_atom_mask : numpy array of bool
+            alchemical_atom_mask[i] is True if atom i is alchemically modified
 
         Returns
         -------
@@ -482,19 +2881,15 @@ class AbsoluteAlchemicalFactory(object):
             The list of bond indices that should be alchemically softened
 
         """
-        bond_list = list()
-        force = self.reference_forces['HarmonicBondForce']
-        for bond_index in range(force.getNumBonds()):
-            [particle1, particle2, r, K] = force.getBondParameters(bond_index)
-            if set([particle1,particle2]).intersection(alchemical_atomset):
-                bond_list.append(bond_index)
-
-        return bond_list
+        particles = _term_particles(self._referenceForceTable('HarmonicBondForce', 'bonds'), 2)
+        return np.where(np.any(alchemical_atom_mask[particles], axis=1))[0].tolist()
 
     def _checkEnergyIsFinite(self, system, positions, platform=None):
         """
         Test that the potential energy is finite for the provided positions.
-        If energy is NaN, compute energy from each force component on Reference platform to aid in debugging.
+        If the energy is not finite, diagnose the forces and terms responsible on the Reference platform.
+
+        The energy of the reference system is computed only once for each set of positions and platform.
 
         Parameters
         ----------
@@ -505,54 +2900,97 @@ class AbsoluteAlchemicalFactory(object):
         platform : simtk.openmm.Platform, optional, default=None
             If specified, this platform will be used to compute test energy (but not by force component).
 
+        Raises
+        ------
+        NonFiniteEnergyError
+            If the energy of the alchemical system is not finite; its `report` attribute holds the diagnostic report
+            produced by `diagnoseNonFiniteEnergy`.
+
         """
         logger.debug("Checking alchemical system produces finite energies.")
 
-        def compute_potential_energy(system, positions, platform=None, groups=-1):
-            # Compute potential energy of reference system.
-            integrator = openmm.VerletIntegrator(1.0 * unit.femtosecond)
-            if platform is not None:
-                # Compute potential energy with requested platform.
-                context = openmm.Context(system, integrator, platform)
-            else:
-                # Use fastest available platform.
-                context = openmm.Context(system, integrator)
+        def compute_potential_energy(system, positions, platform=None):
+            # Compute potential energy of reference system, reusing a cached Context if possible.
+            # If platform is None, the fastest available platform is used.
+            context = global_context_cache.getContext(system, platform)
             context.setPositions(positions)
-            potential = context.getState(getEnergy=True,groups=groups).getPotentialEnergy()
-            del context, integrator
+            potential = context.getState(getEnergy=True).getPotentialEnergy()
             return potential
 
         # Compute potential energy error between reference and alchemical system.
-        reference_potential = compute_potential_energy(self.reference_system, positions, platform)
+        positions_key = hashlib.sha1(np.ascontiguousarray(_strip_units(positions), np.float64).tobytes()).hexdigest()
+        reference_key = (positions_key, platform.getName() if (platform is not None) else None)
+        if reference_key not in self._reference_energies:
+            self._reference_energies[reference_key] = compute_potential_energy(self.reference_system, positions, platform)
+        reference_potential = self._reference_energies[reference_key]
         alchemical_potential = compute_potential_energy(system, positions, platform)
         energy_error = alchemical_potential - reference_potential
 
-        # If alchemical potential energy is NaN, compute energy by component on Reference platform.
-        if np.isnan(alchemical_potential / unit.kilocalories_per_mole):
-            logger.debug("Energy for alchemically modified system is NaN.")
-            logger.debug("Decomposing energy by force component on Reference platform:")
+        # If alchemical potential energy is not finite, diagnose it on the Reference platform.
+        if not np.isfinite(alchemical_potential / unit.kilocalories_per_mole):
+            logger.debug("Energy for alchemically modified system is not finite; diagnosing on Reference platform.")
+            report = self.diagnoseNonFiniteEnergy(system, positions)
+            report['reference_energy'] = reference_potential / unit.kilojoules_per_mole
+            raise NonFiniteEnergyError("Energy for alchemically modified system is %s; non-finite terms: %s" % (str(alchemical_potential), str(report['nonfinite_terms'])), report)
 
-            # Assign all forces to separate components.
-            system = self.alchemically_modified_system
-            for force_index in range(system.getNumForces()):
-                system.getForce(force_index).setForceGroup(force_index)
+        # Return the energy error.
+        logger.debug("Difference between alchemical and reference potential energy is %8.3f kcal/mol" % (energy_error / unit.kilocalories_per_mole))
+        return energy_error
 
-            # Compute potential energy for each force using Reference platform.
-            reference_platform = openmm.Platform.getPlatformByName('Reference')
-            for force_index in range(system.getNumForces()):
-                groups = 1 << force_index # group index bitwise selector
-                potential = compute_potential_energy(system, positions, reference_platform, groups)
-                force_classname = system.getForce(force_index).__class__.__name__
-                logger.debug("Force %5d / %5d [%24s] %12.3f kcal/mol" % (force_index, system.getNumForces(), force_classname, potential / unit.kilocalories_per_mole))
+    @classmethod
+    def diagnoseNonFiniteEnergy(cls, system, positions):
+        """
+        Identify the forces, and where possible the terms, of a System that produce a non-finite potential energy.
 
-            # Clean up
-            del context, integrator
+        Energies of all forces are computed on the Reference platform from a single Context for every 32 forces, each
+        force in its own force group.  For each force with a non-finite energy, the responsible bonded term is found by
+        bisection over terms, and for CustomNonbondedForce the responsible pair of particles is found by bisection over
+        particle subsets; other force types are only identified at the force level.
 
-            raise Exception("Energy for alchemically modified system is NaN.")
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The System to diagnose.
+        positions : simtk.unit.Quantity of dimension (natoms,3) with units compatible with nanometers
+            Coordinates at which the energy is not finite.
 
-        # Return the energy error.
-        logger.debug("Difference between alchemical and reference potential energy is %8.3f kcal/mol" % (energy_error / unit.kilocalories_per_mole))
-        return energy_error
+        Returns
+        -------
+        report : dict
+            'alchemical_energy' is the total energy, and 'force_energies' is a list with a (force index, force class name,
+            energy) tuple for each force; energies are in kJ/mol.  'nonfinite_terms' is a list with a dict for each
+            force with a non-finite energy, with keys 'force_index', 'force_class', 'energy', 'term_index' (the index of
+            the responsible bonded term, or None), and 'particles' (a tuple with the particles of the responsible term
+            or pair, or None).
+
+        """
+        initial_time = time.time()
+        (root, forces) = _split_serialized_system(openmm.XmlSerializer.serialize(system))
+        report = { 'force_energies' : list(), 'nonfinite_terms' : list() }
+        for batch_start in range(0, len(forces), _MAX_FORCE_GROUPS):
+            batch = forces[batch_start:batch_start+_MAX_FORCE_GROUPS]
+            context = openmm.Context(_single_force_group_system(root, batch), openmm.VerletIntegrator(1.0 * unit.femtoseconds), openmm.Platform.getPlatformByName('Reference'))
+            context.setPositions(positions)
+            for (group, force) in enumerate(batch):
+                energy = context.getState(getEnergy=True, groups=(1 << group)).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+                report['force_energies'].append((batch_start + group, force.get('type'), energy))
+            del context
+        report['alchemical_energy'] = sum(energy for (force_index, force_class, energy) in report['force_energies'])
+
+        for (force_index, force_class, energy) in report['force_energies']:
+            logger.debug("Force %5d / %5d [%24s] %12.3f kJ/mol" % (force_index, len(forces), force_class, energy))
+            if np.isfinite(energy):
+                continue
+            term = { 'force_index' : force_index, 'force_class' : force_class, 'energy' : energy, 'term_index' : None, 'particles' : None }
+            if force_class == 'CustomNonbondedForce':
+                term['particles'] = _bisect_nonfinite_pairs(root, system.getForce(force_index), positions)
+            else:
+                result = _bisect_nonfinite_terms(root, forces[force_index], positions)
+                if result is not None:
+                    (term['term_index'], term['particles']) = result
+            report['nonfinite_terms'].append(term)
+        logger.debug("Diagnosed non-finite energy in %.3f s." % (time.time() - initial_time))
+        return report
 
     @classmethod
     def defaultComplexProtocolImplicit(cls):
@@ -707,137 +3145,240 @@ class AbsoluteAlchemicalFactory(object):
 
         return alchemical_states
 
-    def _alchemicallyModifyPeriodicTorsionForce(self, system, reference_force):
+    @staticmethod
+    def _indexMask(indices, size):
+        """
+        Return a boolean mask of the given size that is True for the specified indices.
+
+        """
+        mask = np.zeros([size], bool)
+        if indices is not None:
+            mask[list(indices)] = True
+        return mask
+
+    def _alchemicalParticleMask(self, terms, nparticles):
+        """
+        Return a boolean mask selecting terms for which all particles are alchemically modified.
+
+        Parameters
+        ----------
+        terms : numpy structured array
+            Term table with columns 'particle1', ..., 'particle{nparticles}'.
+        nparticles : int
+            Number of particles involved in each term.
+
+        """
+        particles = _term_particles(terms, nparticles)
+        return np.all(self.alchemical_atom_mask[particles], axis=1)
+
+    def _addRegionTerms(self, force_index, kind, term_indices, rows):
+        """
+        Record terms of a force in the alchemically-modified system whose parameters depend on the alchemical region.
+
+        Parameters
+        ----------
+        force_index : int
+            Index of the force in the alchemically-modified system.
+        kind : str
+            The kind of term (e.g. 'particles', 'bonds'), as in `_TERM_LAYOUTS`.
+        term_indices : numpy array of int
+            Indices of the terms within the force.
+        rows : _RegionTermRows
+            rows(alchemical_atom_mask) returns a structured array of term rows for the specified alchemical region.
+
+        """
+        self._region_terms.append((force_index, kind, np.asarray(term_indices), rows))
+
+    def _regionLambdaDefinitions(self, parameter, suffixes=('1', '2')):
+        """
+        Return energy expression definitions of the value of an alchemical parameter for particles in different alchemical regions.
+
+        For each suffix, 'region_[parameter][suffix]' is defined from the per-particle alchemical region index 'region[suffix]'
+        (1 for the environment, `parameter` for ligand atoms, and '[parameter]_[name]' for named regions).
+        If suffixes '1' and '2' are given, 'pair_[parameter]' is also defined as the region value if both particles are in the
+        same region, and the product of their region values otherwise.
+
+        Parameters
+        ----------
+        parameter : str
+            The alchemical parameter, e.g. 'lambda_sterics'.
+        suffixes : tuple of str, optional, default=('1', '2')
+            Suffixes of the per-particle region index parameter in the energy expression.
+
+        Returns
+        -------
+        definitions : str
+            Energy expression definitions.
+
+        """
+        names = [parameter] + [ '%s_%s' % (parameter, name) for name in sorted(self.alchemical_regions) ]
+        definitions = ""
+        if tuple(suffixes) == ('1', '2'):
+            definitions += "pair_%s = select(region1-region2, region_%s1*region_%s2, region_%s1);" % (parameter, parameter, parameter, parameter)
+        for suffix in suffixes:
+            terms = [ 'delta(region%s)' % suffix ] + [ 'delta(region%s-%d)*%s' % (suffix, region_index + 1, name) for (region_index, name) in enumerate(names) ]
+            definitions += "region_%s%s = %s;" % (parameter, suffix, ' + '.join(terms))
+        return definitions
+
+    def _alchemicallyModifyPeriodicTorsionForce(self, builder, force_index):
         """
         Create alchemically-modified version of PeriodicTorsionForce.
 
         Parameters
         ----------
-        system : simtk.openmm.System
-            The new alchemically-modified System object being built.  This object will be modified.
-        reference_force : simtk.openmm.PeriodicTorsionForce
-            The reference copy of the PeriodicTorsionForce to be alchemically-modified.
+        builder : _SystemBuilder
+            Builder for the new alchemically-modified System object.  Forces will be added to it.
+        force_index : int
+            Index of the reference PeriodicTorsionForce to be alchemically-modified.
 
         """
 
+        torsions = self.reference_force_tables[force_index]['torsions']
+
         # Create PeriodicTorsionForce to handle unmodified torsions.
         force = openmm.PeriodicTorsionForce()
 
         # Create CustomTorsionForce to handle alchemically modified torsions.
         energy_function = "lambda_torsions*k*(1+cos(periodicity*theta-phase))"
+        if self.capacity_atom_mask is not None:
+            energy_function = "(lambda_torsions*alchemical + (1-alchemical))*k*(1+cos(periodicity*theta-phase))"
         custom_force = openmm.CustomTorsionForce(energy_function)
         custom_force.addGlobalParameter('lambda_torsions', 1.0)
         custom_force.addPerTorsionParameter('periodicity')
         custom_force.addPerTorsionParameter('phase')
         custom_force.addPerTorsionParameter('k')
-        # Process reference torsions.
-        for torsion_index in range(reference_force.getNumTorsions()):
-            # Retrieve parameters.
-            [particle1, particle2, particle3, particle4, periodicity, phase, k] = reference_force.getTorsionParameters(torsion_index)
-            # Create torsions.
-            if set([particle1,particle2,particle3,particle4]).issubset(self.ligand_atomset):
-                # Alchemically modified torsion.
-                custom_force.addTorsion(particle1, particle2, particle3, particle4, [periodicity, phase, k])
-            else:
-                # Standard torsion.
-                force.addTorsion(particle1, particle2, particle3, particle4, periodicity, phase, k)
 
-        # Add newly-populated forces to system.
-        system.addForce(force)
-        system.addForce(custom_force)
+        if self.capacity_atom_mask is None:
+            # Torsions in which all particles are alchemical are alchemically modified.
+            alchemical = self._alchemicalParticleMask(torsions, 4)
 
-    def _alchemicallyModifyHarmonicAngleForce(self, system, reference_force):
+            # Add newly-populated forces to system.
+            builder.addForce(force, torsions=torsions[~alchemical].tolist())
+            builder.addForce(custom_force, torsions=torsions[alchemical].tolist())
+        else:
+            # Torsions in which all particles may become alchemical are handled by the custom force, flagged if all particles are alchemical.
+            custom_force.addPerTorsionParameter('alchemical')
+            candidates = np.all(self.capacity_atom_mask[_term_particles(torsions, 4)], axis=1)
+            candidate_torsions = torsions[candidates]
+            particles = _term_particles(candidate_torsions, 4)
+            rows = _RegionTermRows(candidate_torsions, particles)
+            builder.addForce(force, torsions=torsions[~candidates].tolist())
+            custom_force_index = builder.addForce(custom_force, torsions=rows(self.alchemical_atom_mask).tolist())
+            self._addRegionTerms(custom_force_index, 'torsions', np.arange(len(candidate_torsions)), rows)
+
+    def _alchemicallyModifyHarmonicAngleForce(self, builder, force_index):
         """
         Create alchemically-modified version of HarmonicAngleForce
 
         Parameters
         ----------
-        system : simtk.openmm.System
-            The new alchemically-modified System object being built.  This object will be modified.
-        reference_force : simtk.openmm.HarmonicAngleForec
-            The reference copy of the HarmonicAngleForce to be alchemically-modified.
+        builder : _SystemBuilder
+            Builder for the new alchemically-modified System object.  Forces will be added to it.
+        force_index : int
+            Index of the reference HarmonicAngleForce to be alchemically-modified.
 
         """
 
+        angles = self.reference_force_tables[force_index]['angles']
+
         # Create standard HarmonicAngleForce to handle unmodified angles.
         force = openmm.HarmonicAngleForce()
 
         # Create CustomAngleForce to handle alchemically modified angles.
         energy_function = "lambda_angles*(K/2)*(theta-theta0)^2;"
+        if (self.capacity_atom_mask is not None) and self._automatic_alchemical_angles:
+            energy_function = "(lambda_angles*alchemical + (1-alchemical))*(K/2)*(theta-theta0)^2;"
         custom_force = openmm.CustomAngleForce(energy_function)
         custom_force.addGlobalParameter('lambda_angles', 1.0)
         custom_force.addPerAngleParameter('theta0')
         custom_force.addPerAngleParameter('K')
-        # Process reference torsions.
-        for angle_index in range(reference_force.getNumAngles()):
-            # Retrieve parameters.
-            [particle1, particle2, particle3, theta0, K] = reference_force.getAngleParameters(angle_index)
-            if angle_index in self.alchemical_angles:
-                # Alchemically modified angle.
-                custom_force.addAngle(particle1, particle2, particle3, [theta0, K])
-            else:
-                # Standard torsion.
-                force.addAngle(particle1, particle2, particle3, theta0, K)
 
-        # Add newly-populated forces to system.
-        system.addForce(force)
-        system.addForce(custom_force)
+        if (self.capacity_atom_mask is None) or not self._automatic_alchemical_angles:
+            # Angles in the alchemical angle list are alchemically modified.
+            alchemical = self._indexMask(self.alchemical_angles, len(angles))
 
-    def _alchemicallyModifyHarmonicBondForce(self, system, reference_force):
+            # Add newly-populated forces to system.
+            builder.addForce(force, angles=angles[~alchemical].tolist())
+            builder.addForce(custom_force, angles=angles[alchemical].tolist())
+        else:
+            # Angles involving any atom that may become alchemical are handled by the custom force, flagged if they involve any alchemical atom.
+            custom_force.addPerAngleParameter('alchemical')
+            candidates = np.any(self.capacity_atom_mask[_term_particles(angles, 3)], axis=1)
+            candidate_angles = angles[candidates]
+            particles = _term_particles(candidate_angles, 3)
+            rows = _RegionTermRows(candidate_angles, particles, reduction='any')
+            builder.addForce(force, angles=angles[~candidates].tolist())
+            custom_force_index = builder.addForce(custom_force, angles=rows(self.alchemical_atom_mask).tolist())
+            self._addRegionTerms(custom_force_index, 'angles', np.arange(len(candidate_angles)), rows)
+
+    def _alchemicallyModifyHarmonicBondForce(self, builder, force_index):
         """
         Create alchemically-modified version of HarmonicBondForce
 
         Parameters
         ----------
-        system : simtk.openmm.System
-            The new alchemically-modified System object being built.  This object will be modified.
-        reference_force : simtk.openmm.HarmonicBondForec
-            The reference copy of the HarmonicBondForce to be alchemically-modified.
-
-
+        builder : _SystemBuilder
+            Builder for the new alchemically-modified System object.  Forces will be added to it.
+        force_index : int
+            Index of the reference HarmonicBondForce to be alchemically-modified.
 
         """
 
+        bonds = self.reference_force_tables[force_index]['bonds']
+
         # Create standard HarmonicBondForce to handle unmodified bonds.
         force = openmm.HarmonicBondForce()
 
         # Create CustomBondForce to handle alchemically modified bonds.
         energy_function = "lambda_bonds*(K/2)*(r-r0)^2;"
+        if (self.capacity_atom_mask is not None) and self._automatic_alchemical_bonds:
+            energy_function = "(lambda_bonds*alchemical + (1-alchemical))*(K/2)*(r-r0)^2;"
         custom_force = openmm.CustomBondForce(energy_function)
         custom_force.addGlobalParameter('lambda_bonds', 1.0)
         custom_force.addPerBondParameter('r0')
         custom_force.addPerBondParameter('K')
-        # Process reference torsions.
-        for bond_index in range(reference_force.getNumBonds()):
-            # Retrieve parameters.
-            [particle1, particle2, theta0, K] = reference_force.getBondParameters(bond_index)
-            if bond_index in self.alchemical_bonds:
-                # Alchemically modified torsion.
-                custom_force.addBond(particle1, particle2, [theta0, K])
-            else:
-                # Standard torsion.
-                force.addBond(particle1, particle2, theta0, K)
 
-        # Add newly-populated forces to system.
-        system.addForce(force)
-        system.addForce(custom_force)
+        if (self.capacity_atom_mask is None) or not self._automatic_alchemical_bonds:
+            # Bonds in the alchemical bond list are alchemically modified.
+            alchemical = self._indexMask(self.alchemical_bonds, len(bonds))
 
-    def _alchemicallyModifyNonbondedForce(self, system, reference_force):
+            # Add newly-populated forces to system.
+            builder.addForce(force, bonds=bonds[~alchemical].tolist())
+            builder.addForce(custom_force, bonds=bonds[alchemical].tolist())
+        else:
+            # Bonds involving any atom that may become alchemical are handled by the custom force, flagged if they involve any alchemical atom.
+            custom_force.addPerBondParameter('alchemical')
+            candidates = np.any(self.capacity_atom_mask[_term_particles(bonds, 2)], axis=1)
+            candidate_bonds = bonds[candidates]
+            particles = _term_particles(candidate_bonds, 2)
+            rows = _RegionTermRows(candidate_bonds, particles, reduction='any')
+            builder.addForce(force, bonds=bonds[~candidates].tolist())
+            custom_force_index = builder.addForce(custom_force, bonds=rows(self.alchemical_atom_mask).tolist())
+            self._addRegionTerms(custom_force_index, 'bonds', np.arange(len(candidate_bonds)), rows)
+
+    def _alchemicallyModifyNonbondedForce(self, builder, force_index):
         """
         Create alchemically-modified version of NonbondedForce.
 
         Parameters
         ----------
-        system : simtk.openmm.System
-            Alchemically-modified system being built.  This object will be modified.
-        nonbonded_force : simtk.openmm.NonbondedForce
-            The NonbondedForce used as a template.
+        builder : _SystemBuilder
+            Builder for the alchemically-modified system.  Forces will be added to it.
+        force_index : int
+            Index of the reference NonbondedForce used as a template.
 
         TODO
         ----
         Change softcore_beta to a dimensionless scalar to multiply some intrinsic length-scale, like Lennard-Jones alpha.
         Try using a single, common "reff" effective softcore distance for both Lennard-Jones and Coulomb.
 
+        If `nonbonded_layout` is 'fused', sterics and electrostatics between alchemical atoms and the rest of the system are
+        evaluated by a single CustomNonbondedForce with shared per-particle parameters, so that only one neighbor list and
+        pair loop is needed.
+
+        If `tabulate_softcore` is True, the softcore CustomNonbondedForces interpolate the kernels tabulated by
+        `_softcoreKernelTables`, while exceptions are still computed with the analytic expressions.
+
         References
         ----------
         [1] Pham TT and Shirts MR. Identifying low variance pathways for free energy calculations of molecular transformations in solution phase.
@@ -845,18 +3386,40 @@ class AbsoluteAlchemicalFactory(object):
 
         """
 
-        alchemical_atom_indices = self.ligand_atoms
+        reference_force = self.reference_system.getForce(force_index)
+        reference_tables = self.reference_force_tables[force_index]
+        particles = reference_tables['particles'].copy()
+        exceptions = reference_tables['exceptions'].copy()
+        alchemical_atom_mask = self.alchemical_atom_mask
 
-        # Create a copy of the NonbondedForce to handle non-alchemical interactions.
-        nonbonded_force = copy.deepcopy(reference_force)
-        system.addForce(nonbonded_force)
+        # Fix any NonbondedForce issues with Lennard-Jones sigma = 0 (epsilon = 0), which should have sigma > 0.
+        sigma_fix = (1.0 * unit.angstrom).value_in_unit_system(unit.md_unit_system)
+        modified_particles = (particles['sigma'] == 0.0)
+        for particle_index in np.where(modified_particles)[0]:
+            (charge, sigma, epsilon) = particles[particle_index].tolist()
+            logger.warning("particle %d has Lennard-Jones sigma = 0 (charge=%s, sigma=%s, epsilon=%s); setting sigma=1A" % (particle_index, str(charge), str(sigma), str(epsilon)))
+        particles['sigma'][modified_particles] = sigma_fix
+        modified_exceptions = (exceptions['sigma'] == 0.0)
+        for exception_index in np.where(modified_exceptions)[0]:
+            (iatom, jatom, chargeprod, sigma, epsilon) = exceptions[exception_index].tolist()
+            logger.warning("exception %d has Lennard-Jones sigma = 0 (iatom=%d, jatom=%d, chargeprod=%s, sigma=%s, epsilon=%s); setting sigma=1A" % (exception_index, iatom, jatom, str(chargeprod), str(sigma), str(epsilon)))
+        exceptions['sigma'][modified_exceptions] = sigma_fix
 
         # Create CustomNonbondedForce objects to handle softcore interactions between alchemically-modified system and rest of system.
 
         # Create atom groups.
-        natoms = system.getNumParticles()
-        atomset1 = set(alchemical_atom_indices) # only alchemically-modified atoms
-        atomset2 = set(range(system.getNumParticles())) # all atoms, including alchemical region
+        natoms = len(particles)
+        atomset1 = np.where(alchemical_atom_mask)[0].tolist() # only alchemically-modified atoms
+        atomset2 = list(range(natoms)) # all atoms, including alchemical region
+        capacity_atom_mask = self.capacity_atom_mask
+        if capacity_atom_mask is not None:
+            atomset1 = np.where(capacity_atom_mask)[0].tolist() # all atoms that may become alchemically-modified
+        softcore_atom_mask = alchemical_atom_mask if (capacity_atom_mask is None) else capacity_atom_mask
+        environment_mask = ~softcore_atom_mask
+        if self.local_environment_mask is not None:
+            # Only environment atoms near the alchemical region interact with it.
+            environment_mask = environment_mask & self.local_environment_mask
+            atomset2 = np.where(softcore_atom_mask | environment_mask)[0].tolist()
 
         # CustomNonbondedForce energy expression.
         sterics_energy_expression = ""
@@ -890,7 +3453,8 @@ class AbsoluteAlchemicalFactory(object):
             if alpha_ewald == 0.0:
                 # If alpha is 0.0, alpha_ewald is computed by OpenMM from from the error tolerance.
                 [alpha_ewald, nx, ny, nz] = reference_force.getPMEParameters()
-            electrostatics_energy_expression += "U_electrostatics = (lambda_electrostatics^softcore_d)*ONE_4PI_EPS0*chargeprod*erfc(alpha_ewald*reff_electrostatics)/reff_electrostatics;"
+            ewald_kernel_expression = "erfc(alpha_ewald*reff_electrostatics)/reff_electrostatics"
+            electrostatics_energy_expression += "U_electrostatics = (lambda_electrostatics^softcore_d)*ONE_4PI_EPS0*chargeprod*%s;" % ewald_kernel_expression
             electrostatics_energy_expression += "alpha_ewald = %f;" % (alpha_ewald.value_in_unit_system(unit.md_unit_system))
             # TODO: Handle reciprocal-space electrostatics for alchemically-modified particles.  These are otherwise neglected.
             # NOTE: There is currently no way to do this in OpenMM.
@@ -903,6 +3467,27 @@ class AbsoluteAlchemicalFactory(object):
         electrostatics_energy_expression += "reff_electrostatics = sigma*((softcore_beta*(1.-lambda_electrostatics)^softcore_e + (r/sigma)^softcore_f))^(1/softcore_f);" # effective softcore distance for electrostatics
         electrostatics_energy_expression += "ONE_4PI_EPS0 = %f;" % ONE_4PI_EPS0 # already in OpenMM units
 
+        # The softcore CustomNonbondedForces may interpolate tabulated kernels instead of evaluating the analytic expressions.
+        softcore_sterics_expression = sterics_energy_expression
+        softcore_electrostatics_expression = electrostatics_energy_expression
+        softcore_tables = dict()
+        if self.tabulate_softcore:
+            if reference_force.getUseDispersionCorrection() and (self.dispersion_correction != 'precomputed'):
+                raise Exception("Tabulated softcore kernels require dispersion_correction='precomputed' when the reference system uses a dispersion correction.")
+            softcore_tables = self._softcoreKernelTables(reference_force, particles['sigma'], softcore_atom_mask)
+            (s_min, s_max) = softcore_tables['sterics_kernel']['range'][:2]
+            softcore_sterics_expression = "U_sterics = step(%.17g - r/sigma)*epsilon*sterics_kernel(max(r/sigma, %.17g), lambda_sterics);" % (s_max, s_min)
+            if 'ewald_kernel' in softcore_tables:
+                (reff_min, reff_max) = softcore_tables['ewald_kernel']['range']
+                softcore_electrostatics_expression = electrostatics_energy_expression.replace(ewald_kernel_expression, "ewald_kernel(min(max(reff_electrostatics, %.17g), %.17g))" % (reff_min, reff_max))
+
+        # With multiple alchemical regions, the lambda of each pair is determined by the regions of its particles.
+        if self.alchemical_regions is not None:
+            sterics_energy_expression = sterics_energy_expression.replace('lambda_sterics', 'pair_lambda_sterics') + self._regionLambdaDefinitions('lambda_sterics')
+            electrostatics_energy_expression = electrostatics_energy_expression.replace('lambda_electrostatics', 'pair_lambda_electrostatics') + self._regionLambdaDefinitions('lambda_electrostatics')
+            softcore_sterics_expression = softcore_sterics_expression.replace('lambda_sterics', 'pair_lambda_sterics') + self._regionLambdaDefinitions('lambda_sterics')
+            softcore_electrostatics_expression = softcore_electrostatics_expression.replace('lambda_electrostatics', 'pair_lambda_electrostatics') + self._regionLambdaDefinitions('lambda_electrostatics')
+
         # Define mixing rules.
         sterics_mixing_rules = ""
         sterics_mixing_rules += "epsilon = sqrt(epsilon1*epsilon2);" # mixing rule for epsilon
@@ -911,128 +3496,429 @@ class AbsoluteAlchemicalFactory(object):
         electrostatics_mixing_rules += "chargeprod = charge1*charge2;" # mixing rule for charges
         electrostatics_mixing_rules += "sigma = 0.5*(sigma1 + sigma2);" # mixing rule for sigma
 
+        # Interactions are only computed for pairs involving an alchemical atom if the alchemical region can change, or if
+        # all pairs are evaluated without interaction groups.
+        masked = (self.region_decomposition == 'masked')
+        flag_alchemical_particles = (capacity_atom_mask is not None) or masked
+        electrostatics_energy = "U_electrostatics;"
+        sterics_energy = "U_sterics;"
+        if flag_alchemical_particles:
+            electrostatics_energy = "alchemical_pair*U_electrostatics; alchemical_pair = max(alchemical1, alchemical2);"
+            sterics_energy = "alchemical_pair*U_sterics; alchemical_pair = max(alchemical1, alchemical2);"
+
+        # The long-range correction of softcore sterics is either computed by OpenMM or precomputed and applied separately.
+        precomputed_dispersion_correction = reference_force.getUseDispersionCorrection() and (self.dispersion_correction == 'precomputed')
+        use_long_range_correction = reference_force.getUseDispersionCorrection() and not precomputed_dispersion_correction
+
+        # Sterics and electrostatics can only be fused if the switching function and long-range correction of the
+        # CustomNonbondedForce, which would apply to both, can be avoided for electrostatics.
+        fused = (self.nonbonded_layout == 'fused')
+        if fused and reference_force.getUseSwitchingFunction() and use_long_range_correction:
+            logger.warning("Sterics and electrostatics cannot be fused when both a switching function and a dispersion correction are used; using separate softcore forces.")
+            fused = False
+
+        # Energy expressions are specialized for the values of frozen softcore parameters.
+        specialize = lambda expression: expression
+        if len(self.frozen_softcore_parameters) > 0:
+            specialize = lambda expression: _specialize_energy_expression(expression, self.frozen_softcore_parameters)
+
         # Create CustomNonbondedForce to handle interactions between alchemically-modified atoms and rest of system.
-        electrostatics_custom_nonbonded_force = openmm.CustomNonbondedForce("U_electrostatics;" + electrostatics_energy_expression + electrostatics_mixing_rules + alchemical_function_expression)
+        electrostatics_custom_nonbonded_force = openmm.CustomNonbondedForce(specialize(electrostatics_energy + softcore_electrostatics_expression + electrostatics_mixing_rules + alchemical_function_expression))
         electrostatics_custom_nonbonded_force.addGlobalParameter("lambda_electrostatics", 1.0);
         electrostatics_custom_nonbonded_force.addPerParticleParameter("charge") # partial charge
         electrostatics_custom_nonbonded_force.addPerParticleParameter("sigma") # Lennard-Jones sigma
-        sterics_custom_nonbonded_force = openmm.CustomNonbondedForce("U_sterics;" + sterics_energy_expression + sterics_mixing_rules + alchemical_function_expression)
+        sterics_custom_nonbonded_force = openmm.CustomNonbondedForce(specialize(sterics_energy + softcore_sterics_expression + sterics_mixing_rules + alchemical_function_expression))
         sterics_custom_nonbonded_force.addGlobalParameter("lambda_sterics", 1.0);
+        if self.native_electrostatics:
+            sterics_custom_nonbonded_force.addGlobalParameter(NATIVE_ELECTROSTATICS_PARAMETER, 1.0);
         sterics_custom_nonbonded_force.addPerParticleParameter("sigma") # Lennard-Jones sigma
         sterics_custom_nonbonded_force.addPerParticleParameter("epsilon") # Lennard-Jones epsilon
+        if flag_alchemical_particles:
+            electrostatics_custom_nonbonded_force.addPerParticleParameter("alchemical") # 1 if alchemically-modified
+            sterics_custom_nonbonded_force.addPerParticleParameter("alchemical") # 1 if alchemically-modified
+        if self.alchemical_regions is not None:
+            electrostatics_custom_nonbonded_force.addPerParticleParameter("region") # alchemical region index
+            sterics_custom_nonbonded_force.addPerParticleParameter("region") # alchemical region index
 
         # Set parameters to match reference force.
-        sterics_custom_nonbonded_force.setUseSwitchingFunction(nonbonded_force.getUseSwitchingFunction())
+        sterics_custom_nonbonded_force.setUseSwitchingFunction(reference_force.getUseSwitchingFunction())
         electrostatics_custom_nonbonded_force.setUseSwitchingFunction(False) # no switch for electrostatics, since NonbondedForce doesn't use a switch
-        sterics_custom_nonbonded_force.setCutoffDistance(nonbonded_force.getCutoffDistance())
-        electrostatics_custom_nonbonded_force.setCutoffDistance(nonbonded_force.getCutoffDistance())
-        sterics_custom_nonbonded_force.setSwitchingDistance(nonbonded_force.getSwitchingDistance())
-        sterics_custom_nonbonded_force.setUseLongRangeCorrection(nonbonded_force.getUseDispersionCorrection())
+        sterics_custom_nonbonded_force.setCutoffDistance(reference_force.getCutoffDistance())
+        electrostatics_custom_nonbonded_force.setCutoffDistance(reference_force.getCutoffDistance())
+        sterics_custom_nonbonded_force.setSwitchingDistance(reference_force.getSwitchingDistance())
+        sterics_custom_nonbonded_force.setUseLongRangeCorrection(use_long_range_correction)
         electrostatics_custom_nonbonded_force.setUseLongRangeCorrection(False) # long-range dispersion correction is meaningless for electrostatics
 
-        # Set periodicity and cutoff parameters corresponding to reference Force.
-        if nonbonded_force.getNonbondedMethod() in [openmm.NonbondedForce.Ewald, openmm.NonbondedForce.PME, openmm.NonbondedForce.CutoffPeriodic]:
-            sterics_custom_nonbonded_force.setNonbondedMethod( openmm.CustomNonbondedForce.CutoffPeriodic )
-            electrostatics_custom_nonbonded_force.setNonbondedMethod( openmm.CustomNonbondedForce.CutoffPeriodic )
-        else:
-            sterics_custom_nonbonded_force.setNonbondedMethod( nonbonded_force.getNonbondedMethod() )
-            electrostatics_custom_nonbonded_force.setNonbondedMethod( nonbonded_force.getNonbondedMethod() )
+        # Create a single CustomNonbondedForce evaluating both sterics and electrostatics in one pass over pairs, if requested.
+        if fused:
+            # The switching function is applied to sterics only, and electrostatics is excluded from the long-range correction.
+            r_cutoff = reference_force.getCutoffDistance().value_in_unit_system(unit.md_unit_system)
+            fused_energy = "U_fused;"
+            if flag_alchemical_particles:
+                fused_energy = "alchemical_pair*U_fused; alchemical_pair = max(alchemical1, alchemical2);"
+            if reference_force.getUseSwitchingFunction():
+                r_switch = reference_force.getSwitchingDistance().value_in_unit_system(unit.md_unit_system)
+                fused_energy += "U_fused = switch_sterics*U_sterics + U_electrostatics;"
+                fused_energy += "switch_sterics = 1 - step(r - r_switch)*x_switch^3*(10 - 15*x_switch + 6*x_switch^2); x_switch = (r - r_switch)/(r_cutoff - r_switch);"
+                fused_energy += "r_switch = %f; r_cutoff = %f;" % (r_switch, r_cutoff)
+            elif use_long_range_correction:
+                fused_energy += "U_fused = U_sterics + (1 - step(r - r_cutoff))*U_electrostatics; r_cutoff = %f;" % r_cutoff
+            else:
+                fused_energy += "U_fused = U_sterics + U_electrostatics;"
+            fused_mixing_rules = "epsilon = sqrt(epsilon1*epsilon2); sigma = 0.5*(sigma1 + sigma2); chargeprod = charge1*charge2;"
+            fused_custom_nonbonded_force = openmm.CustomNonbondedForce(specialize(fused_energy + softcore_sterics_expression + softcore_electrostatics_expression + fused_mixing_rules + alchemical_function_expression))
+            fused_custom_nonbonded_force.addGlobalParameter("lambda_sterics", 1.0);
+            fused_custom_nonbonded_force.addGlobalParameter("lambda_electrostatics", 1.0);
+            fused_custom_nonbonded_force.addPerParticleParameter("charge") # partial charge
+            fused_custom_nonbonded_force.addPerParticleParameter("sigma") # Lennard-Jones sigma
+            fused_custom_nonbonded_force.addPerParticleParameter("epsilon") # Lennard-Jones epsilon
+            if flag_alchemical_particles:
+                fused_custom_nonbonded_force.addPerParticleParameter("alchemical") # 1 if alchemically-modified
+            if self.alchemical_regions is not None:
+                fused_custom_nonbonded_force.addPerParticleParameter("region") # alchemical region index
+            fused_custom_nonbonded_force.setUseSwitchingFunction(False)
+            fused_custom_nonbonded_force.setCutoffDistance(reference_force.getCutoffDistance())
+            fused_custom_nonbonded_force.setUseLongRangeCorrection(use_long_range_correction)
 
-        # Add custom forces.
-        system.addForce(sterics_custom_nonbonded_force)
-        system.addForce(electrostatics_custom_nonbonded_force)
+        # Set periodicity and cutoff parameters corresponding to reference Force.
+        # With native electrostatics, the charges of alchemical atoms are scaled in the NonbondedForce instead.
+        softcore_forces = [fused_custom_nonbonded_force] if fused else [sterics_custom_nonbonded_force, electrostatics_custom_nonbonded_force]
+        if self.native_electrostatics:
+            softcore_forces = [sterics_custom_nonbonded_force]
+        for force in softcore_forces:
+            if method in [openmm.NonbondedForce.Ewald, openmm.NonbondedForce.PME, openmm.NonbondedForce.CutoffPeriodic]:
+                force.setNonbondedMethod( openmm.CustomNonbondedForce.CutoffPeriodic )
+            else:
+                force.setNonbondedMethod( method )
+            for (name, table) in sorted(softcore_tables.items()):
+                if (name + '(') in force.getEnergyFunction():
+                    force.addTabulatedFunction(name, _softcore_kernel_function(table))
 
         # Create CustomBondForce to handle exceptions for both kinds of interactions.
-        custom_bond_force = openmm.CustomBondForce("U_sterics + U_electrostatics;" + sterics_energy_expression + electrostatics_energy_expression + alchemical_function_expression)
-        custom_bond_force.addGlobalParameter("lambda_electrostatics", 1.0);
+        # If the alchemical region can change, exceptions not flagged as alchemical are computed as in NonbondedForce.
+        exception_energy = "U_sterics + U_electrostatics;"
+        if capacity_atom_mask is not None:
+            exception_energy = "alchemical*(U_sterics + U_electrostatics) + (1-alchemical)*U_exception; U_exception = ONE_4PI_EPS0*chargeprod/r + 4*epsilon*((sigma/r)^12 - (sigma/r)^6);"
+        if self.native_electrostatics:
+            # Charge products of exceptions between alchemical atoms scale with the square of the charge scaling factor.
+            custom_bond_force = openmm.CustomBondForce(specialize("U_sterics + U_electrostatics; U_electrostatics = (lambda_electrostatics^2)*ONE_4PI_EPS0*chargeprod/r; ONE_4PI_EPS0 = %f;" % ONE_4PI_EPS0 + sterics_energy_expression))
+            custom_bond_force.addGlobalParameter("lambda_electrostatics", 1.0);
+        else:
+            custom_bond_force = openmm.CustomBondForce(specialize(exception_energy + sterics_energy_expression + electrostatics_energy_expression + alchemical_function_expression))
+            custom_bond_force.addGlobalParameter("lambda_electrostatics", 1.0);
         custom_bond_force.addGlobalParameter("lambda_sterics", 1.0);
         custom_bond_force.addPerBondParameter("chargeprod") # charge product
         custom_bond_force.addPerBondParameter("sigma") # Lennard-Jones effective sigma
         custom_bond_force.addPerBondParameter("epsilon") # Lennard-Jones effective epsilon
-        system.addForce(custom_bond_force)
+        if capacity_atom_mask is not None:
+            custom_bond_force.addPerBondParameter("alchemical") # 1 if both atoms are alchemically-modified
+        if self.alchemical_regions is not None:
+            custom_bond_force.addPerBondParameter("region1") # alchemical region index of first atom
+            custom_bond_force.addPerBondParameter("region2") # alchemical region index of second atom
 
-        # Fix any NonbondedForce issues with Lennard-Jones sigma = 0 (epsilon = 0), which should have sigma > 0.
-        for particle_index in range(nonbonded_force.getNumParticles()):
-            # Retrieve parameters.
-            [charge, sigma, epsilon] = nonbonded_force.getParticleParameters(particle_index)
-            # Check particle sigma is not zero.
-            if (sigma == 0.0 * unit.angstrom):
-                logger.warning("particle %d has Lennard-Jones sigma = 0 (charge=%s, sigma=%s, epsilon=%s); setting sigma=1A" % (particle_index, str(charge), str(sigma), str(epsilon)))
-                sigma = 1.0 * unit.angstrom
-                # Fix it.
-                nonbonded_force.setParticleParameters(particle_index, charge, sigma, epsilon)
-        for exception_index in range(nonbonded_force.getNumExceptions()):
-            # Retrieve parameters.
-            [iatom, jatom, chargeprod, sigma, epsilon] = nonbonded_force.getExceptionParameters(exception_index)
-            # Check particle sigma is not zero.
-            if (sigma == 0.0 * unit.angstrom):
-                logger.warning("exception %d has Lennard-Jones sigma = 0 (iatom=%d, jatom=%d, chargeprod=%s, sigma=%s, epsilon=%s); setting sigma=1A" % (exception_index, iatom, jatom, str(chargeprod), str(sigma), str(epsilon)))
-                sigma = 1.0 * unit.angstrom
-                # Fix it.
-                nonbonded_force.setExceptionParameters(exception_index, iatom, jatom, chargeprod, sigma, epsilon)
+        # Tabulate the dispersion correction of softcore sterics (only applied to periodic systems).
+        dispersion_correction_force = None
+        if precomputed_dispersion_correction and method in [openmm.NonbondedForce.Ewald, openmm.NonbondedForce.PME, openmm.NonbondedForce.CutoffPeriodic]:
+            dispersion_correction_force = self._createDispersionCorrectionForce(reference_force, particles['sigma'].copy(), particles['epsilon'].copy(), alchemical_function_expression)
 
         # Move NonbondedForce particle terms for alchemically-modified particles to CustomNonbondedForce.
-        for particle_index in range(nonbonded_force.getNumParticles()):
-            # Retrieve parameters.
-            [charge, sigma, epsilon] = nonbonded_force.getParticleParameters(particle_index)
-            if (sigma / unit.angstroms) == 0.0:
-                raise Exception('sigma is %s for particle %d; sigma must be positive' % (str(sigma), particle_index))
-            # Add parameters to custom force handling interactions between alchemically-modified atoms and rest of system.
-            sterics_custom_nonbonded_force.addParticle([sigma, epsilon])
-            electrostatics_custom_nonbonded_force.addParticle([charge, sigma])
-            # Turn off Lennard-Jones contribution from alchemically-modified particles.
-            if particle_index in alchemical_atom_indices:
-                nonbonded_force.setParticleParameters(particle_index, abs(0*charge), sigma, abs(0*epsilon))
+        # Parameters are added to custom forces handling interactions between alchemically-modified atoms and rest of system.
+        if capacity_atom_mask is not None:
+            # Record parameters of the NonbondedForce that depend on the alchemical region.
+            capacity_indices = np.where(capacity_atom_mask)[0]
+            native_particle_rows = _RegionTermRows(particles[capacity_indices], capacity_indices[:,np.newaxis], zeroed_fields=['charge', 'epsilon'])
+        def softcore_particle_terms(fields):
+            # Return the particle terms of a softcore force with the specified per-particle parameters, and (if the
+            # alchemical region can change) a function returning the rows of terms that depend on the alchemical region.
+            terms = particles[fields]
+            if (capacity_atom_mask is None) and (self.alchemical_regions is not None):
+                # Add the alchemical region index of each particle.
+                return (_append_field(terms, 'region', self.alchemical_region_index).tolist(), None)
+            elif (capacity_atom_mask is None) and masked:
+                # Flag alchemically-modified particles, since all pairs are evaluated.
+                return (_append_field(terms, 'alchemical', alchemical_atom_mask).tolist(), None)
+            elif capacity_atom_mask is None:
+                return (terms.tolist(), None)
+            # Flag alchemically-modified particles in custom forces.
+            rows = _RegionTermRows(terms[capacity_indices], capacity_indices[:,np.newaxis])
+            return (_append_field(terms, 'alchemical', alchemical_atom_mask).tolist(), rows)
+        if fused:
+            softcore_particles = [ softcore_particle_terms(['charge', 'sigma', 'epsilon']) ]
+        elif self.native_electrostatics:
+            softcore_particles = [ softcore_particle_terms(['sigma', 'epsilon']) ]
+        else:
+            softcore_particles = [ softcore_particle_terms(['sigma', 'epsilon']), softcore_particle_terms(['charge', 'sigma']) ]
+        # Turn off Lennard-Jones contribution from alchemically-modified particles.
+        if not self.native_electrostatics:
+            particles['charge'][alchemical_atom_mask] = 0.0
+        particles['epsilon'][alchemical_atom_mask] = 0.0
+        modified_particles |= alchemical_atom_mask
 
         # Move NonbondedForce exception terms for alchemically-modified particles to CustomNonbondedForce/CustomBondForce.
-        for exception_index in range(nonbonded_force.getNumExceptions()):
-            # Retrieve parameters.
-            [iatom, jatom, chargeprod, sigma, epsilon] = nonbonded_force.getExceptionParameters(exception_index)
-            # Exclude this atom pair in CustomNonbondedForce.
-            sterics_custom_nonbonded_force.addExclusion(iatom, jatom)
-            electrostatics_custom_nonbonded_force.addExclusion(iatom, jatom)
+        # Exception atom pairs are excluded in the CustomNonbondedForces; with the minimal interaction topology, only those
+        # involving an atom of the first interaction group are, since no other pair is evaluated.
+        excluded = np.ones([len(exceptions)], bool)
+        if (self.interaction_topology == 'minimal') and not masked:
+            excluded = np.any(softcore_atom_mask[_term_particles(exceptions, 2)], axis=1)
+        exclusions = exceptions[excluded][['particle1', 'particle2']].tolist()
+        alchemical_exceptions = np.zeros([len(exceptions)], bool)
+        if self.annihilate_sterics and (capacity_atom_mask is None):
             # Move exceptions involving alchemically-modified atoms to CustomBondForce.
-            if self.annihilate_sterics and (iatom in alchemical_atom_indices) and (jatom in alchemical_atom_indices):
-                # Add special CustomBondForce term to handle alchemically-modified Lennard-Jones exception.
-                custom_bond_force.addBond(iatom, jatom, [chargeprod, sigma, epsilon])
-                # Zero terms in NonbondedForce.
-                nonbonded_force.setExceptionParameters(exception_index, iatom, jatom, abs(0*chargeprod), sigma, abs(0*epsilon))
+            alchemical_exceptions = self._alchemicalParticleMask(exceptions, 2)
+        elif self.annihilate_sterics:
+            # Move all exceptions between atoms that may become alchemically-modified to CustomBondForce, flagging those between alchemical atoms.
+            alchemical_exceptions = np.all(capacity_atom_mask[_term_particles(exceptions, 2)], axis=1)
+            candidate_exceptions = exceptions[alchemical_exceptions].copy()
+            exception_rows = _RegionTermRows(candidate_exceptions, _term_particles(candidate_exceptions, 2))
+        # Add special CustomBondForce terms to handle alchemically-modified Lennard-Jones exceptions.
+        custom_bonds = exceptions[alchemical_exceptions]
+        if (capacity_atom_mask is not None) and self.annihilate_sterics:
+            custom_bonds = exception_rows(alchemical_atom_mask)
+        elif self.alchemical_regions is not None:
+            exception_particles = _term_particles(custom_bonds, 2)
+            custom_bonds = _append_field(custom_bonds, 'region1', self.alchemical_region_index[exception_particles[:,0]])
+            custom_bonds = _append_field(custom_bonds, 'region2', self.alchemical_region_index[exception_particles[:,1]])
+        custom_bonds = custom_bonds.tolist()
+        # Zero terms in NonbondedForce.
+        exceptions['chargeprod'][alchemical_exceptions] = 0.0
+        exceptions['epsilon'][alchemical_exceptions] = 0.0
+        modified_exceptions |= alchemical_exceptions
+        if self.native_electrostatics:
+            # Move the electrostatics of the remaining exceptions involving alchemically-modified atoms to a CustomBondForce,
+            # where they are scaled by lambda_electrostatics for each alchemical atom, since OpenMM cannot make zero
+            # exceptions of a NonbondedForce nonzero in a Context; their Lennard-Jones terms stay in NonbondedForce.
+            nalchemical = alchemical_atom_mask[_term_particles(exceptions, 2)].sum(axis=1)
+            native_exceptions = (nalchemical > 0) & (exceptions['chargeprod'] != 0.0)
+            native_exception_bonds = _append_field(exceptions[native_exceptions][['particle1', 'particle2', 'chargeprod']], 'nalchemical', nalchemical[native_exceptions]).tolist()
+            exceptions['chargeprod'][native_exceptions] = 0.0
+            modified_exceptions |= native_exceptions
 
         # TODO: Add back NonbondedForce terms for alchemical system needed in case of decoupling electrostatics or sterics via second CustomBondForce.
         # TODO: Also need to change current CustomBondForce to not alchemically disappearing system.
 
         # Restrict interaction evaluation to be between alchemical atoms and rest of environment.
         # TODO: Exclude intra-alchemical region if we are separately handling that through a separate CustomNonbondedForce for decoupling.
-        sterics_custom_nonbonded_force.addInteractionGroup(list(atomset1), list(atomset2))
-        electrostatics_custom_nonbonded_force.addInteractionGroup(list(atomset1), list(atomset2))
+        interaction_groups = [(atomset1, atomset2)]
+        if masked:
+            # All pairs are evaluated with the standard neighbor list, and vanish unless they involve an alchemical atom.
+            interaction_groups = []
+        elif self.interaction_topology == 'minimal':
+            # Evaluate alchemical-environment and alchemical-alchemical pairs in separate (disjoint) interaction groups.
+            environment = np.where(environment_mask)[0].tolist()
+            split_groups = list()
+            if (len(atomset1) > 0) and (len(environment) > 0):
+                split_groups.append((atomset1, environment))
+            if len(atomset1) > 1:
+                split_groups.append((atomset1, atomset1))
+            if len(split_groups) > 0:
+                interaction_groups = split_groups
 
         # Add global parameters to forces.
         def add_global_parameters(force):
-            force.addGlobalParameter('softcore_alpha', self.softcore_alpha)
-            force.addGlobalParameter('softcore_beta', self.softcore_beta)
-            force.addGlobalParameter('softcore_a', self.softcore_a)
-            force.addGlobalParameter('softcore_b', self.softcore_b)
-            force.addGlobalParameter('softcore_c', self.softcore_c)
-            force.addGlobalParameter('softcore_d', self.softcore_d)
-            force.addGlobalParameter('softcore_e', self.softcore_e)
-            force.addGlobalParameter('softcore_f', self.softcore_f)
+            for name in SOFTCORE_PARAMETERS:
+                if name not in self.frozen_softcore_parameters:
+                    force.addGlobalParameter(name, getattr(self, name))
 
             # Add control variables.
             control_variables = set(self.alchemical_functions.values())
             for variable in control_variables:
                 force.addGlobalParameter(variable, 1.0)
 
-        for force in [sterics_custom_nonbonded_force, electrostatics_custom_nonbonded_force, custom_bond_force]:
+        for force in softcore_forces + [custom_bond_force]:
             add_global_parameters(force)
 
+        # Add alchemical parameters of named regions.
+        if self.alchemical_regions is not None:
+            sterics_forces = [fused_custom_nonbonded_force] if fused else [sterics_custom_nonbonded_force]
+            electrostatics_forces = [fused_custom_nonbonded_force] if fused else [electrostatics_custom_nonbonded_force]
+            for name in sorted(self.alchemical_regions):
+                for force in sterics_forces + [custom_bond_force]:
+                    force.addGlobalParameter('lambda_sterics_%s' % name, 1.0)
+                for force in electrostatics_forces + [custom_bond_force]:
+                    force.addGlobalParameter('lambda_electrostatics_%s' % name, 1.0)
+
+        # Add a copy of the NonbondedForce with modified parameters to handle non-alchemical interactions.
+        modified_particle_indices = np.where(modified_particles)[0].tolist()
+        modified_exception_indices = np.where(modified_exceptions)[0].tolist()
+        nonbonded_force_index = builder.addModifiedForce(force_index,
+            particles=(modified_particle_indices, particles[modified_particle_indices].tolist()),
+            exceptions=(modified_exception_indices, exceptions[modified_exception_indices].tolist()))
+
+        # Add custom forces.
+        softcore_force_indices = [ builder.addForce(force, particles=force_particles, exclusions=exclusions, interaction_groups=interaction_groups)
+                                   for (force, (force_particles, particle_rows)) in zip(softcore_forces, softcore_particles) ]
+        custom_bond_force_index = builder.addForce(custom_bond_force, bonds=custom_bonds)
+        if self.native_electrostatics and (len(native_exception_bonds) > 0):
+            native_exception_force = openmm.CustomBondForce("(lambda_electrostatics^nalchemical)*ONE_4PI_EPS0*chargeprod/r; ONE_4PI_EPS0 = %f;" % ONE_4PI_EPS0)
+            native_exception_force.addGlobalParameter("lambda_electrostatics", 1.0);
+            native_exception_force.addPerBondParameter("chargeprod") # charge product
+            native_exception_force.addPerBondParameter("nalchemical") # number of alchemically-modified atoms (1 or 2)
+            builder.addForce(native_exception_force, bonds=native_exception_bonds)
+        if dispersion_correction_force is not None:
+            builder.addForce(dispersion_correction_force)
+
+        # Record parameters that depend on the alchemical region.
+        if capacity_atom_mask is not None:
+            self._addRegionTerms(nonbonded_force_index, 'particles', capacity_indices, native_particle_rows)
+            for (softcore_force_index, (force_particles, particle_rows)) in zip(softcore_force_indices, softcore_particles):
+                self._addRegionTerms(softcore_force_index, 'particles', capacity_indices, particle_rows)
+            if self.annihilate_sterics:
+                self._addRegionTerms(custom_bond_force_index, 'bonds', np.arange(len(candidate_exceptions)), exception_rows)
+
         return
 
-    def _alchemicallyModifyAmoebaMultipoleForce(self, system, reference_force):
+    def _createDispersionCorrectionForce(self, reference_force, sigma, epsilon, alchemical_function_expression):
+        """
+        Create a force applying the precomputed long-range dispersion correction of softcore sterics.
+
+        The correction energy is C(lambda_sterics) / V, where C is tabulated on a grid of lambda_sterics values by
+        `_softcore_dispersion_coefficients` and the inverse box volume is the global parameter INVERSE_VOLUME_PARAMETER,
+        whose default value is computed from the default periodic box vectors of the reference system.
+
+        Parameters
+        ----------
+        reference_force : simtk.openmm.NonbondedForce
+            The reference NonbondedForce.
+        sigma, epsilon : numpy array of float
+            Lennard-Jones parameters of every particle in the softcore sterics force, in OpenMM units.
+        alchemical_function_expression : str
+            Energy expression definitions of context parameters slaved to control variables.
+
+        Returns
+        -------
+        force : simtk.openmm.CustomCVForce
+            The dispersion correction force.
+
+        """
+        cutoff = reference_force.getCutoffDistance().value_in_unit_system(unit.md_unit_system)
+        switching_distance = None
+        if reference_force.getUseSwitchingFunction():
+            switching_distance = reference_force.getSwitchingDistance().value_in_unit_system(unit.md_unit_system)
+        lambda_values = np.linspace(0.0, 1.0, _DISPERSION_CORRECTION_GRID_SIZE)
+        softcore = (self.softcore_alpha, self.softcore_a, self.softcore_b, self.softcore_c)
+        coefficients = _softcore_dispersion_coefficients(sigma, epsilon, self.alchemical_atom_mask, lambda_values, softcore, cutoff, switching_distance)
+
+        force = openmm.CustomCVForce("dispersion_correction(lambda_sterics)*%s;" % INVERSE_VOLUME_PARAMETER + alchemical_function_expression)
+        force.addTabulatedFunction('dispersion_correction', openmm.Continuous1DFunction(coefficients.tolist(), 0.0, 1.0))
+        force.addGlobalParameter(INVERSE_VOLUME_PARAMETER, _inverse_box_volume(self.reference_system.getDefaultPeriodicBoxVectors()))
+        force.addGlobalParameter('lambda_sterics', 1.0)
+        for variable in set(self.alchemical_functions.values()):
+            force.addGlobalParameter(variable, 1.0)
+        return force
+
+    def _softcoreKernelTables(self, reference_force, sigma, atom_mask):
+        """
+        Tabulate the softcore kernels interpolated by the softcore CustomNonbondedForces when `tabulate_softcore` is True.
+
+        The tables cover the pairs between the atoms in `atom_mask` and all atoms that are within the cutoff.
+
+        Parameters
+        ----------
+        reference_force : simtk.openmm.NonbondedForce
+            The reference NonbondedForce.
+        sigma : numpy array of float
+            Lennard-Jones sigma of every particle (with sigma = 0 already fixed), in nm.
+        atom_mask : numpy array of bool
+            atom_mask[i] is True if particle i interacts through the softcore forces with all other particles.
+
+        Returns
+        -------
+        tables : dict of str : dict
+            tables[name] is the table (see `_tabulate_softcore_kernel`) of the tabulated function `name`:
+            'sterics_kernel' is the softcore Lennard-Jones energy in units of epsilon as a function of r/sigma and
+            lambda_sterics, and 'ewald_kernel' (Ewald and PME only) is erfc(alpha_ewald*reff)/reff as a function of the
+            effective softcore distance reff, in nm.
+
+        """
+        (xsize, lambda_size) = self.softcore_table_size
+        method = reference_force.getNonbondedMethod()
+        if not np.any(atom_mask):
+            atom_mask = np.ones([len(sigma)], bool)
+        pair_sigma_min = 0.5 * (sigma[atom_mask].min() + sigma.min())
+        pair_sigma_max = 0.5 * (sigma[atom_mask].max() + sigma.max())
+
+        tables = dict()
+        softcore = (self.softcore_alpha, self.softcore_a, self.softcore_b, self.softcore_c)
+        s_max = _SOFTCORE_TABLE_MAX_DISTANCE
+        if method != openmm.NonbondedForce.NoCutoff:
+            cutoff = reference_force.getCutoffDistance().value_in_unit_system(unit.md_unit_system)
+            s_max = 1.01 * cutoff / pair_sigma_min
+        sterics_kernel = lambda s, lambda_value: _softcore_sterics_kernel(s, lambda_value, softcore)
+        tables['sterics_kernel'] = _tabulate_softcore_kernel(sterics_kernel, (_SOFTCORE_TABLE_MIN_DISTANCE, s_max), xsize, (0.0, 1.0), lambda_size)
+
+        if method in [openmm.NonbondedForce.PME, openmm.NonbondedForce.Ewald]:
+            alpha_ewald = reference_force.getPMEParameters()[0].value_in_unit_system(unit.md_unit_system)
+            # The effective distance is largest for the largest sigma at the cutoff with lambda_electrostatics = 0.
+            reff_max = 1.01 * (self.softcore_beta * pair_sigma_max**self.softcore_f + cutoff**self.softcore_f)**(1.0 / self.softcore_f)
+            ewald_kernel = lambda reff: np.vectorize(math.erfc)(alpha_ewald * reff) / reff
+            tables['ewald_kernel'] = _tabulate_softcore_kernel(ewald_kernel, (_EWALD_TABLE_MIN_DISTANCE, reff_max), xsize)
+
+        return tables
+
+    def computeSoftcoreTableErrors(self, npoints=64, platform=None):
+        """
+        Compare the tabulated softcore kernels (see `tabulate_softcore`) with their analytic form.
+
+        Each kernel is evaluated by OpenMM midway between grid points, where the interpolation error is largest, for up
+        to `npoints` values of each variable.  The tables are those the factory creates (or would create) for its
+        reference system, so the accuracy of a `softcore_table_size` can be checked before it is used.
+
+        Parameters
+        ----------
+        npoints : int, optional, default=64
+            The maximum number of values of each variable at which the kernels are compared.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform used to evaluate the tabulated kernels; the Reference platform if None.
+
+        Returns
+        -------
+        errors : dict of str : dict
+            errors[name] reports the error of the tabulated kernel `name`: 'max_absolute_error', 'max_relative_error'
+            (relative to the magnitude of the analytic kernel, or to 1 where the magnitude is smaller), and 'location',
+            the tuple of variables at which the absolute error is largest.
+
+        """
+        force_index = [ index for index in range(self.reference_system.getNumForces()) if isinstance(self.reference_system.getForce(index), openmm.NonbondedForce) ]
+        if len(force_index) == 0:
+            raise Exception("The reference system has no NonbondedForce, so softcore kernels are not tabulated.")
+        reference_force = self.reference_system.getForce(force_index[0])
+        sigma = self.reference_force_tables[force_index[0]]['particles']['sigma'].copy()
+        sigma[sigma == 0.0] = (1.0 * unit.angstrom).value_in_unit_system(unit.md_unit_system)
+        atom_mask = self.alchemical_atom_mask if (self.capacity_atom_mask is None) else self.capacity_atom_mask
+        tables = self._softcoreKernelTables(reference_force, sigma, atom_mask)
+
+        def midpoints(minimum, maximum, size):
+            grid = np.linspace(minimum, maximum, size)
+            midpoints = 0.5 * (grid[1:] + grid[:-1])
+            return midpoints[np.unique(np.linspace(0, len(midpoints) - 1, min(npoints, len(midpoints))).round().astype(int))]
+
+        errors = dict()
+        for (name, table) in sorted(tables.items()):
+            values = table['values']
+            x = midpoints(table['range'][0], table['range'][1], values.shape[-1])
+            if values.ndim == 1:
+                variables = (x,)
+                analytic = table['function'](x)
+                tabulated = _evaluate_tabulated_function(_softcore_kernel_function(table), x, platform=platform)
+            else:
+                y = midpoints(table['range'][2], table['range'][3], values.shape[0])
+                variables = (x[np.newaxis,:], y[:,np.newaxis])
+                analytic = table['function'](*variables)
+                tabulated = _evaluate_tabulated_function(_softcore_kernel_function(table), x, y, platform=platform)
+            absolute_errors = np.abs(tabulated - analytic)
+            relative_errors = absolute_errors / np.maximum(np.abs(analytic), 1.0)
+            index = np.unravel_index(np.argmax(absolute_errors), absolute_errors.shape)
+            location = tuple(float(np.broadcast_to(variable, absolute_errors.shape)[index]) for variable in variables)
+            errors[name] = { 'max_absolute_error' : float(absolute_errors.max()), 'max_relative_error' : float(relative_errors.max()), 'location' : location }
+            logger.info("Tabulated %s: max absolute error %.3e at %s, max relative error %.3e" % (name, errors[name]['max_absolute_error'], str(location), errors[name]['max_relative_error']))
+        return errors
+
+    def _alchemicallyModifyAmoebaMultipoleForce(self, builder, force_index):
         raise Exception("Not implemented; needs CustomMultipleForce")
         alchemical_atom_indices = self.ligand_atoms
 
 
-    def _alchemicallyModifyAmoebaVdwForce(self, system, reference_force):
+    def _alchemicallyModifyAmoebaVdwForce(self, builder, force_index):
         # This feature is incompletely implemented, so raise an exception.
         raise Exception("Not implemented")
 
@@ -1085,16 +3971,16 @@ class AbsoluteAlchemicalFactory(object):
 
         return system
 
-    def _alchemicallyModifyGBSAOBCForce(self, system, reference_force, sasa_model='ACE'):
+    def _alchemicallyModifyGBSAOBCForce(self, builder, force_index, sasa_model='ACE'):
         """
         Create alchemically-modified version of GBSAOBCForce.
 
         Parameters
         ----------
-        system : simtk.openmm.System
-            Alchemically-modified System object being built.  This object will be modified.
-        reference_force : simtk.openmm.GBSAOBCForce
-            Reference force to use for template.
+        builder : _SystemBuilder
+            Builder for the alchemically-modified System object.  Forces will be added to it.
+        force_index : int
+            Index of the reference GBSAOBCForce to use for template.
         sasa_model : str, optional, default='ACE'
             Solvent accessible surface area model.
 
@@ -1104,6 +3990,9 @@ class AbsoluteAlchemicalFactory(object):
 
         """
 
+        reference_force = self.reference_system.getForce(force_index)
+        particles = self.reference_force_tables[force_index]['particles']
+
         custom_force = openmm.CustomGBForce()
 
         # Add per-particle parameters.
@@ -1113,6 +4002,18 @@ class AbsoluteAlchemicalFactory(object):
         custom_force.addPerParticleParameter("scale");
         custom_force.addPerParticleParameter("alchemical");
 
+        # With multiple alchemical regions, each alchemical particle is scaled by the electrostatics lambda of its region.
+        def scaled(expression, suffixes):
+            if self.alchemical_regions is None:
+                return expression
+            for suffix in suffixes:
+                expression = expression.replace('lambda_electrostatics*alchemical%s' % suffix, 'region_lambda_electrostatics%s*alchemical%s' % (suffix, suffix))
+            return expression + ';' + self._regionLambdaDefinitions('lambda_electrostatics', suffixes)[:-1]
+        if self.alchemical_regions is not None:
+            custom_force.addPerParticleParameter("region");
+            for name in sorted(self.alchemical_regions):
+                custom_force.addGlobalParameter('lambda_electrostatics_%s' % name, 1.0)
+
         # Set nonbonded method.
         custom_force.setNonbondedMethod(reference_force.getNonbondedMethod())
         custom_force.setCutoffDistance(reference_force.getCutoffDistance())
@@ -1122,36 +4023,37 @@ class AbsoluteAlchemicalFactory(object):
         custom_force.addGlobalParameter("soluteDielectric", reference_force.getSoluteDielectric())
         custom_force.addGlobalParameter("offset", 0.009)
 
-        custom_force.addComputedValue("I",  "(lambda_electrostatics*alchemical2 + (1-alchemical2))*step(r+sr2-or1)*0.5*(1/L-1/U+0.25*(r-sr2^2/r)*(1/(U^2)-1/(L^2))+0.5*log(L/U)/r);"
+        custom_force.addComputedValue("I",  scaled("(lambda_electrostatics*alchemical2 + (1-alchemical2))*step(r+sr2-or1)*0.5*(1/L-1/U+0.25*(r-sr2^2/r)*(1/(U^2)-1/(L^2))+0.5*log(L/U)/r);"
                                 "U=r+sr2;"
                                 "L=max(or1, D);"
                                 "D=abs(r-sr2);"
                                 "sr2 = scale2*or2;"
-                                "or1 = radius1-offset; or2 = radius2-offset", openmm.CustomGBForce.ParticlePairNoExclusions)
+                                "or1 = radius1-offset; or2 = radius2-offset", ['2']), openmm.CustomGBForce.ParticlePairNoExclusions)
 
         custom_force.addComputedValue("B", "1/(1/or-tanh(psi-0.8*psi^2+4.85*psi^3)/radius);"
                                   "psi=I*or; or=radius-offset", openmm.CustomGBForce.SingleParticle)
 
-        custom_force.addEnergyTerm("-0.5*138.935485*(1/soluteDielectric-1/solventDielectric)*(lambda_electrostatics*alchemical+(1-alchemical))*charge^2/B", openmm.CustomGBForce.SingleParticle)
+        custom_force.addEnergyTerm(scaled("-0.5*138.935485*(1/soluteDielectric-1/solventDielectric)*(lambda_electrostatics*alchemical+(1-alchemical))*charge^2/B", ['']), openmm.CustomGBForce.SingleParticle)
         if sasa_model == 'ACE':
-            custom_force.addEnergyTerm("(lambda_electrostatics*alchemical+(1-alchemical))*28.3919551*(radius+0.14)^2*(radius/B)^6", openmm.CustomGBForce.SingleParticle)
+            custom_force.addEnergyTerm(scaled("(lambda_electrostatics*alchemical+(1-alchemical))*28.3919551*(radius+0.14)^2*(radius/B)^6", ['']), openmm.CustomGBForce.SingleParticle)
 
-        custom_force.addEnergyTerm("-138.935485*(1/soluteDielectric-1/solventDielectric)*(lambda_electrostatics*alchemical1+(1-alchemical1))*charge1*(lambda_electrostatics*alchemical2+(1-alchemical2))*charge2/f;"
-                             "f=sqrt(r^2+B1*B2*exp(-r^2/(4*B1*B2)))", openmm.CustomGBForce.ParticlePairNoExclusions);
+        custom_force.addEnergyTerm(scaled("-138.935485*(1/soluteDielectric-1/solventDielectric)*(lambda_electrostatics*alchemical1+(1-alchemical1))*charge1*(lambda_electrostatics*alchemical2+(1-alchemical2))*charge2/f;"
+                             "f=sqrt(r^2+B1*B2*exp(-r^2/(4*B1*B2)))", ['1', '2']), openmm.CustomGBForce.ParticlePairNoExclusions);
 
-        # Add particle parameters.
-        for particle_index in range(reference_force.getNumParticles()):
-            # Retrieve parameters.
-            [charge, radius, scaling_factor] = reference_force.getParticleParameters(particle_index)
-            # Set particle parameters.
-            if particle_index in self.ligand_atoms:
-                parameters = [charge, radius, scaling_factor, 1.0]
-            else:
-                parameters = [charge, radius, scaling_factor, 0.0]
-            custom_force.addParticle(parameters)
+        # Add particle parameters, flagging alchemically-modified particles.
+        alchemical = self.alchemical_atom_mask.astype(np.float64).tolist()
+        custom_particles = [ (charge, radius, scaling_factor, alchemical_flag) for ((charge, radius, scaling_factor), alchemical_flag) in zip(particles.tolist(), alchemical) ]
+        if self.alchemical_regions is not None:
+            custom_particles = _append_field(_append_field(particles, 'alchemical', self.alchemical_atom_mask), 'region', self.alchemical_region_index).tolist()
 
         # Add alchemically-modified GBSAOBCForce to system.
-        system.addForce(custom_force)
+        custom_force_index = builder.addForce(custom_force, particles=custom_particles)
+
+        # Record parameters that depend on the alchemical region.
+        if self.capacity_atom_mask is not None:
+            capacity_indices = np.where(self.capacity_atom_mask)[0]
+            rows = _RegionTermRows(particles[capacity_indices], capacity_indices[:,np.newaxis])
+            self._addRegionTerms(custom_force_index, 'particles', capacity_indices, rows)
 
     def _createAlchemicallyModifiedSystem(self, mm=None):
         """
@@ -1171,22 +4073,11 @@ class AbsoluteAlchemicalFactory(object):
 
         reference_system = self.reference_system
 
-        # Create new deep copy reference system to modify.
-        system = openmm.System()
-
-        # Set periodic box vectors.
-        [a,b,c] = reference_system.getDefaultPeriodicBoxVectors()
-        system.setDefaultPeriodicBoxVectors(a,b,c)
-
-        # Add atoms.
-        for atom_index in range(reference_system.getNumParticles()):
-            mass = reference_system.getParticleMass(atom_index)
-            system.addParticle(mass)
+        # Modifiers record parameters that depend on the alchemical region here (see `_addRegionTerms`).
+        self._region_terms = list()
 
-        # Add constraints
-        for constraint_index in range(reference_system.getNumConstraints()):
-            [iatom, jatom, r0] = reference_system.getConstraintParameters(constraint_index)
-            system.addConstraint(iatom, jatom, r0)
+        # Create a builder for the new system.
+        builder = _SystemBuilder(reference_system)
 
         # Modify forces as appropriate, copying other forces without modification.
         # TODO: Use introspection to automatically dispatch registered modifiers?
@@ -1194,23 +4085,34 @@ class AbsoluteAlchemicalFactory(object):
         for force_index in range(nforces):
             reference_force = reference_system.getForce(force_index)
             if isinstance(reference_force, openmm.PeriodicTorsionForce) and (self.alchemical_torsions is not None):
-                self._alchemicallyModifyPeriodicTorsionForce(system, reference_force)
+                self._alchemicallyModifyPeriodicTorsionForce(builder, force_index)
             elif isinstance(reference_force, openmm.HarmonicAngleForce) and (self.alchemical_angles is not None):
-                self._alchemicallyModifyHarmonicAngleForce(system, reference_force)
+                self._alchemicallyModifyHarmonicAngleForce(builder, force_index)
             elif isinstance(reference_force, openmm.HarmonicBondForce) and (self.alchemical_bonds is not None):
-                self._alchemicallyModifyHarmonicBondForce(system, reference_force)
+                self._alchemicallyModifyHarmonicBondForce(builder, force_index)
             elif isinstance(reference_force, openmm.NonbondedForce):
-                self._alchemicallyModifyNonbondedForce(system, reference_force)
-            elif isinstance(reference_force, openmm.GBSAOBCForce):
-                self._alchemicallyModifyGBSAOBCForce(system, reference_force)
+                self._alchemicallyModifyNonbondedForce(builder, force_index)
+            elif isinstance(reference_force, openmm.GBSAOBCForce) and not self.native_electrostatics:
+                self._alchemicallyModifyGBSAOBCForce(builder, force_index)
             elif isinstance(reference_force, openmm.AmoebaMultipoleForce):
-                self._alchemicallyModifyAmoebaMultipoleForce(system, reference_force)
+                self._alchemicallyModifyAmoebaMultipoleForce(builder, force_index)
             elif isinstance(reference_force, openmm.AmoebaVdwForce):
-                self._alchemicallyModifyAmoebaVdwForce(system, reference_force)
+                self._alchemicallyModifyAmoebaVdwForce(builder, force_index)
             else:
                 # Copy force without modification.
-                force = copy.deepcopy(reference_force)
-                system.addForce(force)
+                builder.copyForce(force_index)
+
+        system = builder.getSystem()
+
+        # Remove forces without terms.
+        self.pruned_forces = list()
+        if self.prune_empty_forces:
+            self._pruneEmptyForces(system)
+
+        # Place each force in the force group of its role.
+        if self.assign_force_groups:
+            for force in system.getForces():
+                force.setForceGroup(ALCHEMICAL_FORCE_GROUPS[_alchemical_force_role(force)])
 
         # Record timing statistics.
         final_time = time.time()
@@ -1219,102 +4121,669 @@ class AbsoluteAlchemicalFactory(object):
 
         return system
 
+    def _selectRegionDecomposition(self, positions, platform=None, nevaluations=10):
+        """
+        Select the region decomposition whose softcore CustomNonbondedForces are cheapest to evaluate.
+
+        The CustomNonbondedForces of each decomposition are evaluated `nevaluations` times (energies and forces) at `positions`,
+        after one untimed evaluation; the timings (in seconds per evaluation) are stored in `region_decomposition_timings`.
+
+        Parameters
+        ----------
+        positions : simtk.unit.Quantity of shape [nparticles, 3] with units compatible with nanometers
+            Positions at which the forces are evaluated; if None, 'interaction_groups' is selected without timing.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform used for timing.
+        nevaluations : int, optional, default=10
+            The number of timed evaluations.
+
+        Returns
+        -------
+        region_decomposition : str
+            The selected decomposition, 'interaction_groups' or 'masked'.
+
+        """
+        if self.alchemical_regions is not None:
+            return 'interaction_groups'
+        if positions is None:
+            logger.warning("Selecting the 'interaction_groups' region decomposition without timing, since no test_positions were given.")
+            return 'interaction_groups'
+        self.region_decomposition_timings = dict()
+        for region_decomposition in ['interaction_groups', 'masked']:
+            self.region_decomposition = region_decomposition
+            system = self._createAlchemicallyModifiedSystem(self.reference_system)
+            self.region_decomposition_timings[region_decomposition] = _time_softcore_forces(system, positions, platform, nevaluations)
+        region_decomposition = min(self.region_decomposition_timings, key=self.region_decomposition_timings.get)
+        logger.info("Selected '%s' region decomposition (softcore force timings: %s)" % (region_decomposition, ', '.join('%s %.3f ms' % (name, timing * 1000) for (name, timing) in sorted(self.region_decomposition_timings.items()))))
+        return region_decomposition
+
+    def _pruneEmptyForces(self, system):
+        """
+        Remove forces without terms from an alchemically-modified system, recording them in `pruned_forces`.
+
+        Force indices of parameters that depend on the alchemical region are updated accordingly.
+
+        """
+        empty = [ force_index for force_index in range(system.getNumForces()) if _is_empty_force(system.getForce(force_index)) ]
+        for force_index in reversed(empty):
+            self.pruned_forces.insert(0, _describe_pruned_force(force_index, system.getForce(force_index), 'empty'))
+            system.removeForce(force_index)
+        if (len(empty) > 0) and (self._region_terms is not None):
+            kept = [ force_index for force_index in range(system.getNumForces() + len(empty)) if force_index not in empty ]
+            new_indices = { force_index : new_index for (new_index, force_index) in enumerate(kept) }
+            self._region_terms = [ (new_indices[force_index], kind, term_indices, rows) for (force_index, kind, term_indices, rows) in self._region_terms if force_index in new_indices ]
+        if len(empty) > 0:
+            logger.debug("Removed %d empty forces: %s" % (len(empty), ', '.join(force['force_class'] for force in self.pruned_forces)))
+
+    @classmethod
+    def _inactiveForceIndices(cls, system, alchemical_state=None):
+        """
+        Return the indices of the custom forces of a system whose energy is identically zero in an alchemical state.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System
+            The alchemically-modified system.
+        alchemical_state : AlchemicalState, optional, default=None
+            The alchemical state; if None, the default values of global parameters are used.
+
+        """
+        return [ force_index for (force_index, force) in enumerate(system.getForces()) if _is_inactive_force(force, alchemical_state) ]
+
+    def getPruningReport(self, alchemical_state=None):
+        """
+        Report the forces removed from the alchemically-modified system, and those that would be removed for an alchemical state.
+
+        Parameters
+        ----------
+        alchemical_state : AlchemicalState, optional, default=None
+            If specified, also report the forces that `createPerturbedSystem` removes for this state with
+            `prune_inactive_forces=True`.
+
+        Returns
+        -------
+        report : dict
+            'empty_forces' lists the forces without terms removed when the factory was created (see `prune_empty_forces`),
+            and 'inactive_forces' the forces whose energy is identically zero in `alchemical_state`.  Each force is described
+            by its 'force_index' (in the system it was removed from), 'force_class', 'role' (see `ALCHEMICAL_FORCE_GROUPS`),
+            and 'reason'.  'num_forces' is the number of forces that remain in the system for the state, and
+            'kernel_launches_saved' the number of removed forces: each force requires at least one kernel launch per
+            energy and force evaluation on GPU platforms.
+
+        """
+        system = self.alchemically_modified_system
+        inactive_forces = list()
+        if alchemical_state is not None:
+            inactive_forces = [ _describe_pruned_force(force_index, system.getForce(force_index), 'inactive') for force_index in self._inactiveForceIndices(system, alchemical_state) ]
+        report = { 'empty_forces' : list(self.pruned_forces), 'inactive_forces' : inactive_forces,
+                   'num_forces' : system.getNumForces() - len(inactive_forces),
+                   'kernel_launches_saved' : len(self.pruned_forces) + len(inactive_forces) }
+        return report
+
+    def getInteractionTopologyReport(self, positions=None, platform=None, nevaluations=10):
+        """
+        Count the interacting pairs and exclusions of the softcore CustomNonbondedForces for each interaction topology.
+
+        If `positions` are given, the softcore forces of both topologies are also timed as in `region_decomposition='auto'`.
+
+        Parameters
+        ----------
+        positions : simtk.unit.Quantity of shape [nparticles, 3] with units compatible with nanometers, optional, default=None
+            Positions at which the softcore forces are timed; if None, no timings are reported.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform used for timing; if None, the platform given to the factory (or the fastest available one) is used.
+        nevaluations : int, optional, default=10
+            The number of timed evaluations of energies and forces.
+
+        Returns
+        -------
+        report : dict
+            report[interaction_topology] (for 'full' and 'minimal', see `interaction_topology`) reports the number of
+            'interaction_groups', the number of 'interacting_pairs' with 'alchemical_environment_pairs' and
+            'alchemical_alchemical_pairs' among them, and the number of 'exclusions' of each softcore force.  If
+            `positions` are given, 'ms_per_step' is the measured time in milliseconds per evaluation of the energies and
+            forces of the softcore forces.
+            report['interaction_topology'] is the topology used by this factory.
+
+        Examples
+        --------
+
+        >>> from openmmtools import testsystems
+        >>> waterbox = testsystems.WaterBox()
+        >>> factory = AbsoluteAlchemicalFactory(waterbox.system, ligand_atoms=[0, 1, 2])
+        >>> report = factory.getInteractionTopologyReport(waterbox.positions)
+        >>> excluded_pairs_removed = report['full']['exclusions'] - report['minimal']['exclusions']
+        >>> speedup = report['full']['ms_per_step'] / report['minimal']['ms_per_step']
+
+        """
+        force_index = [ index for index in range(self.reference_system.getNumForces()) if isinstance(self.reference_system.getForce(index), openmm.NonbondedForce) ]
+        if len(force_index) == 0:
+            raise Exception("The reference system has no NonbondedForce, so there are no softcore CustomNonbondedForces.")
+        exceptions = self.reference_force_tables[force_index[0]]['exceptions']
+        atom_mask = self.alchemical_atom_mask if (self.capacity_atom_mask is None) else self.capacity_atom_mask
+        nalchemical = int(atom_mask.sum())
+        nenvironment = len(atom_mask) - nalchemical
+        if self.local_environment_mask is not None:
+            nenvironment = int((self.local_environment_mask & ~atom_mask).sum())
+        (alchemical_environment_pairs, alchemical_alchemical_pairs) = (nalchemical * nenvironment, nalchemical * (nalchemical - 1) // 2)
+        report = dict()
+        for (interaction_topology, ngroups, nexclusions) in [('full', 1, len(exceptions)),
+                                                             ('minimal', (nenvironment > 0) + (nalchemical > 1), int(np.any(atom_mask[_term_particles(exceptions, 2)], axis=1).sum()))]:
+            report[interaction_topology] = { 'interaction_groups' : max(ngroups, 1), 'exclusions' : nexclusions,
+                                             'interacting_pairs' : alchemical_environment_pairs + alchemical_alchemical_pairs,
+                                             'alchemical_environment_pairs' : alchemical_environment_pairs, 'alchemical_alchemical_pairs' : alchemical_alchemical_pairs }
+        if positions is not None:
+            if platform is None:
+                platform = self.platform
+            for interaction_topology in ['full', 'minimal']:
+                system = self._createSystemVariant(interaction_topology=interaction_topology)
+                report[interaction_topology]['ms_per_step'] = 1000.0 * _time_softcore_forces(system, positions, platform, nevaluations)
+            logger.info("Softcore force timings: %.3f ms (full) vs %.3f ms (minimal)" % (report['full']['ms_per_step'], report['minimal']['ms_per_step']))
+        report['interaction_topology'] = self.interaction_topology
+        logger.info("Softcore exclusions: %d (full) vs %d (minimal) for %d interacting pairs" % (report['full']['exclusions'], report['minimal']['exclusions'], report['full']['interacting_pairs']))
+        return report
+
     @classmethod
     def perturbSystem(cls, system, alchemical_state):
         """
-        Perturb the specified system (previously generated by this alchemical factory) by setting default global parameters.
+        Perturb the specified system (previously generated by this alchemical factory) by setting default global parameters.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System created by AlchemicalFactory
+            The alchemically-modified system whose default global parameters are to be perturbed.
+        alchemical_state : AlchemicalState
+            The alchemical state to create from the reference system.
+
+        Examples
+        --------
+
+        Create alchemical intermediates for 'denihilating' one water in a water box.
+
+        >>> # Create a reference system.
+        >>> from openmmtools import testsystems
+        >>> waterbox = testsystems.WaterBox()
+        >>> [reference_system, positions] = [waterbox.system, waterbox.positions]
+        >>> # Create a factory to produce alchemical intermediates.
+        >>> factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=[0, 1, 2])
+        >>> # Create an alchemically-perturbed state corresponding to fully-interacting.
+        >>> alchemical_state = AlchemicalState(lambda_sterics=1.00, lambda_electrostatics=1.00)
+        >>> # Create the perturbed system.
+        >>> alchemical_system = factory.createPerturbedSystem(alchemical_state)
+        >>> # Perturb this system.
+        >>> alchemical_state = AlchemicalState(lambda_sterics=0.90, lambda_electrostatics=0.90)
+        >>> factory.perturbSystem(alchemical_system, alchemical_state)
+
+        """
+
+        cls.getParameterBindingPlan(system).apply(system, alchemical_state)
+
+        return
+
+    @classmethod
+    def perturbContext(cls, context, alchemical_state, use_all_parameters=False):
+        """
+        Perturb the specified context (using a system previously generated by this alchemical factory) by setting context parameters.
+
+        Contexts of systems created with `native_electrostatics=True` must be perturbed with `perturbNativeContext` to
+        change lambda_electrostatics, since it scales the charges of native forces; an Exception is raised otherwise.
+
+        Parameters
+        ----------
+        context : simtk.openmm.Context
+            The Context object associated with a System that has been alchemically modified.
+        alchemical_state : AlchemicalState
+            The alchemical state to est the Context to.
+        use_all_parameters : bool, optional, default=False
+            If True, will ensure that all parameters are used or raise an Exception if not.
+
+        Examples
+        --------
+
+        Create an alchemically-modified water box and set alchemical parameters appropriately.
+
+        >>> # Create a reference system.
+        >>> from openmmtools import testsystems
+        >>> waterbox = testsystems.WaterBox()
+        >>> [reference_system, positions] = [waterbox.system, waterbox.positions]
+        >>> # Create a factory to produce alchemical intermediates.
+        >>> factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=[0, 1, 2])
+        >>> # Create an alchemically-perturbed state corresponding to fully-interacting.
+        >>> alchemical_state = AlchemicalState()
+        >>> # Create the perturbed system.
+        >>> alchemical_system = factory.createPerturbedSystem(alchemical_state)
+        >>> # Create a Context.
+        >>> integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+        >>> context = openmm.Context(alchemical_system, integrator)
+        >>> # Set alchemical state.
+        >>> alchemical_state = AlchemicalState(lambda_electrostatics=0.5, lambda_sterics=0.5)
+        >>> factory.perturbContext(context, alchemical_state)
+
+        """
+
+        # Charges of native forces can only be scaled by the factory that created the system.
+        plan = cls.getParameterBindingPlan(context)
+        if (NATIVE_ELECTROSTATICS_PARAMETER in plan.parameters) and ('lambda_electrostatics' in alchemical_state):
+            if alchemical_state['lambda_electrostatics'] != context.getParameter(NATIVE_ELECTROSTATICS_PARAMETER):
+                raise Exception("The Context uses native electrostatics; use perturbNativeContext of its factory to change lambda_electrostatics.")
+
+        # Set parameters in Context; it's OK if some parameters are not found unless use_all_parameters is True.
+        plan.apply(context, alchemical_state, use_all_parameters=use_all_parameters)
+        return
+
+    def _nativeElectrostaticsTerms(self):
+        """
+        Return the terms of native forces of the alchemically-modified system whose charges are scaled by lambda_electrostatics.
+
+        Returns
+        -------
+        terms : list of (int, list of int, list of float)
+            For each NonbondedForce and GBSAOBCForce, the force index in the alchemically-modified system, the indices of
+            the alchemical particles, and their reference charges.
+
+        Exceptions involving alchemical atoms are not included: OpenMM cannot make zero exceptions nonzero in a Context,
+        so their electrostatics are handled by CustomBondForces scaled by lambda_electrostatics for each alchemical atom.
+
+        """
+        names = ['NonbondedForce', 'GBSAOBCForce']
+        reference_indices = [ index for (index, force) in enumerate(self.reference_system.getForces()) if force.__class__.__name__ in names ]
+        alchemical_indices = [ index for (index, force) in enumerate(self.alchemically_modified_system.getForces()) if force.__class__.__name__ in names ]
+        alchemical_particles = np.where(self.alchemical_atom_mask)[0]
+        terms = list()
+        for (reference_index, force_index) in zip(reference_indices, alchemical_indices):
+            charges = self.reference_force_tables[reference_index]['particles']['charge'][alchemical_particles]
+            terms.append((force_index, alchemical_particles.tolist(), charges.tolist()))
+        return terms
+
+    def _scaleNativeElectrostatics(self, system, lambda_electrostatics, context=None):
+        """
+        Scale the charges of alchemical atoms in the native forces of a System, and update them in a Context if specified.
+
+        The scaling factor is recorded in the global parameter `NATIVE_ELECTROSTATICS_PARAMETER`.
+
+        """
+        for (force_index, indices, charges) in self._native_electrostatics_terms:
+            force = system.getForce(force_index)
+            for (index, charge) in zip(indices, charges):
+                parameters = force.getParticleParameters(index)
+                force.setParticleParameters(index, lambda_electrostatics * charge, *parameters[1:])
+            if context is not None:
+                force.updateParametersInContext(context)
+        for target in [system, context]:
+            if target is not None:
+                self.getParameterBindingPlan(target).apply(target, { NATIVE_ELECTROSTATICS_PARAMETER : lambda_electrostatics })
+
+    def perturbNativeSystem(self, system, alchemical_state):
+        """
+        Perturb a system created by this factory, including the charges of native forces if `native_electrostatics` is True.
+
+        This is equivalent to `perturbSystem` unless the factory was created with `native_electrostatics=True`.
+
+        Parameters
+        ----------
+        system : simtk.openmm.System created by this factory
+            The alchemically-modified system whose default global parameters and charges are to be perturbed.
+        alchemical_state : AlchemicalState
+            The alchemical state to set.
+
+        """
+        self.perturbSystem(system, alchemical_state)
+        if self._native_electrostatics_terms is not None:
+            self._scaleNativeElectrostatics(system, alchemical_state['lambda_electrostatics'])
+
+    def perturbNativeContext(self, context, alchemical_state, use_all_parameters=False):
+        """
+        Perturb a Context of a system created by this factory, including the charges of native forces if `native_electrostatics` is True.
+
+        This is equivalent to `perturbContext` unless the factory was created with `native_electrostatics=True`, in which
+        case the charges of alchemical atoms are also pushed with `updateParametersInContext`.
+
+        Parameters
+        ----------
+        context : simtk.openmm.Context
+            The Context of a System created by this factory.
+        alchemical_state : AlchemicalState
+            The alchemical state to set.
+        use_all_parameters : bool, optional, default=False
+            If True, will ensure that all parameters are used or raise an Exception if not.
+
+        Examples
+        --------
+
+        >>> from openmmtools import testsystems
+        >>> testsystem = testsystems.AlanineDipeptideImplicit()
+        >>> factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=[0, 1, 2], softcore_beta=0.0, native_electrostatics=True)
+        >>> context = openmm.Context(factory.createPerturbedSystem(), openmm.VerletIntegrator(1.0 * unit.femtoseconds))
+        >>> factory.perturbNativeContext(context, AlchemicalState(lambda_electrostatics=0.5))
+
+        """
+        if self._native_electrostatics_terms is None:
+            self.perturbContext(context, alchemical_state, use_all_parameters=use_all_parameters)
+            return
+        # The charges are always pushed, since the Context may have been changed by other means.
+        self._scaleNativeElectrostatics(context.getSystem(), alchemical_state['lambda_electrostatics'], context)
+        # lambda_electrostatics is only a global parameter if exceptions between alchemical atoms are annihilated.
+        parameters = alchemical_state
+        if 'lambda_electrostatics' not in self.getParameterBindingPlan(context).parameters:
+            parameters = dict((name, value) for (name, value) in alchemical_state.items() if name != 'lambda_electrostatics')
+        self.perturbContext(context, parameters, use_all_parameters=use_all_parameters)
+
+    @classmethod
+    def getParameterBindingPlan(cls, target):
+        """
+        Return the parameter binding plan used by `perturbSystem` and `perturbContext` for a System or Context.
+
+        The plan is created on first use and kept for as long as the target exists.  It only pushes parameters whose
+        values differ from the current parameters of a Context, or from the default values it last applied to a System;
+        if the default values of a System are changed by other means, call `invalidate()` on the plan.
+
+        Parameters
+        ----------
+        target : simtk.openmm.System or simtk.openmm.Context
+            The System or Context.
+
+        Returns
+        -------
+        plan : ParameterBindingPlan
+            The binding plan; its `applied` and `skipped` attributes count parameter values pushed and skipped.
+
+        """
+        return ParameterBindingPlan.forTarget(target)
+
+    def checkAlchemicalRegionChange(self, ligand_atoms):
+        """
+        Determine whether the alchemical region can be changed in an existing Context without rebuilding it.
+
+        Parameters
+        ----------
+        ligand_atoms : list of int
+            The new set of alchemically-modified atoms.
+
+        Returns
+        -------
+        reason : str or None
+            None if the change only requires updating parameters, or a description of why the System and Context must be rebuilt.
+
+        """
+        if self.capacity_atom_mask is None:
+            return "factory was not created with alchemical_region_capacity"
+        new_atom_mask = self._indexMask(ligand_atoms, self.reference_system.getNumParticles())
+        outside = np.where(new_atom_mask & ~self.capacity_atom_mask)[0]
+        if len(outside) > 0:
+            return "atoms %s are outside alchemical_region_capacity" % str(outside.tolist())
+        return None
+
+    def _setAlchemicalRegion(self, ligand_atoms):
+        """
+        Set the alchemically-modified atoms, updating automatically selected alchemical bonds, angles, and torsions.
+
+        """
+        nparticles = self.reference_system.getNumParticles()
+        if not set(ligand_atoms).issubset(set(range(nparticles))):
+            raise Exception('Some specified ligand atom indices >= number of particles (%d)' % nparticles)
+        self.ligand_atoms = list(ligand_atoms)
+        self.ligand_atomset = set(self.ligand_atoms)
+        self.alchemical_atom_mask = self._indexMask(self.ligand_atoms, nparticles)
+        if self._automatic_alchemical_bonds:
+            self.alchemical_bonds = self._buildAlchemicalBondList(self.alchemical_atom_mask)
+        if self._automatic_alchemical_angles:
+            self.alchemical_angles = self._buildAlchemicalAngleList(self.alchemical_atom_mask)
+        if self._automatic_alchemical_torsions:
+            self.alchemical_torsions = self._buildAlchemicalTorsionList(self.alchemical_atom_mask)
+        # Systems for the previous alchemical region can no longer be shared.
+        self._shared_perturbed_systems.clear()
+        self._endpoint_systems.clear()
+        self.cache_key = None
+
+    def updateAlchemicalRegion(self, context, ligand_atoms):
+        """
+        Change which atoms are alchemically modified in an existing Context.
+
+        If the factory was created with `alchemical_region_capacity` including all new alchemical atoms, only per-particle and
+        per-term parameters change: they are updated in the Context with updateParametersInContext(), which does not require
+        recompiling kernels.  Otherwise, a warning explaining why is logged, and the alchemically-modified System and Context
+        are rebuilt (growing the capacity to include the new alchemical atoms, if one was specified), preserving the integrator,
+        platform, positions, velocities, box vectors, and context parameters.
+
+        The alchemically-modified system cached by this factory is updated as well, so subsequently created perturbed systems
+        use the new alchemical region.
+
+        Parameters
+        ----------
+        context : simtk.openmm.Context
+            A Context whose System was created by this factory.
+        ligand_atoms : list of int
+            The new set of alchemically-modified atoms.
+
+        Returns
+        -------
+        context : simtk.openmm.Context
+            The updated Context; this is a new Context if a rebuild was necessary.
+
+        Examples
+        --------
+
+        Move the alchemical region from one water molecule to the next in a water box.
+
+        >>> from openmmtools import testsystems
+        >>> waterbox = testsystems.WaterBox()
+        >>> [reference_system, positions] = [waterbox.system, waterbox.positions]
+        >>> factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=[0, 1, 2], alchemical_region_capacity=range(0,6))
+        >>> alchemical_system = factory.createPerturbedSystem(AlchemicalState(lambda_electrostatics=0.5))
+        >>> integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+        >>> context = openmm.Context(alchemical_system, integrator)
+        >>> context.setPositions(positions)
+        >>> context = factory.updateAlchemicalRegion(context, [3, 4, 5])
+
+        """
+        reason = self.checkAlchemicalRegionChange(ligand_atoms)
+        if reason is not None:
+            logger.warning("Changing the alchemical region requires rebuilding the System and Context: %s" % reason)
+            self._setAlchemicalRegion(ligand_atoms)
+            if self.capacity_atom_mask is not None:
+                # Grow the capacity to include the new alchemical region.
+                self.capacity_atom_mask = self.capacity_atom_mask | self.alchemical_atom_mask
+            self.alchemically_modified_system = self._createAlchemicallyModifiedSystem(self.reference_system)
+            return self._rebuildAlchemicalContext(context)
+
+        if self._region_terms is None:
+            # Parameters depending on the alchemical region were not recorded in the cache entry the system was retrieved from.
+            self._createAlchemicallyModifiedSystem(self.reference_system)
+
+        initial_time = time.time()
+        old_atom_mask = self.alchemical_atom_mask
+        new_atom_mask = self._indexMask(ligand_atoms, self.reference_system.getNumParticles())
+        system = context.getSystem()
+        modified_forces = set()
+        for (force_index, kind, term_indices, rows) in self._region_terms:
+            new_rows = rows(new_atom_mask)
+            changed = np.where(rows(old_atom_mask) != new_rows)[0]
+            if len(changed) == 0:
+                continue
+            for modified_system in [system, self.alchemically_modified_system]:
+                _set_force_terms(modified_system.getForce(force_index), kind, term_indices[changed], new_rows[changed].tolist())
+            modified_forces.add(force_index)
+        for force_index in sorted(modified_forces):
+            system.getForce(force_index).updateParametersInContext(context)
+        self._setAlchemicalRegion(ligand_atoms)
+        logger.debug("updateAlchemicalRegion: updated %d forces in %.3f s." % (len(modified_forces), time.time() - initial_time))
+
+        return context
+
+    def _rebuildAlchemicalContext(self, context, local_environment_mask=None):
+        """
+        Create a new Context for the current alchemically-modified system, copying the state of an existing Context.
+
+        The local environment of the existing Context is kept unless `local_environment_mask` is given.
+        Native charges are not carried over with the global parameters, so they are set again if `native_electrostatics` is True.
+
+        """
+        if local_environment_mask is None:
+            local_environment_mask = self._local_environment_masks.get(context)
+        if (local_environment_mask is None) or np.array_equal(local_environment_mask, self.local_environment_mask):
+            new_context = self._rebuildContext(context, copy.deepcopy(self.alchemically_modified_system))
+        else:
+            new_context = self._rebuildContext(context, self._createSystemVariant(local_environment_mask=local_environment_mask))
+            self._local_environment_masks[new_context] = local_environment_mask
+        if self.native_electrostatics:
+            self._native_electrostatics_terms = self._nativeElectrostaticsTerms()
+            lambda_electrostatics = 1.0
+            if NATIVE_ELECTROSTATICS_PARAMETER in self.getParameterBindingPlan(context).parameters:
+                lambda_electrostatics = context.getParameter(NATIVE_ELECTROSTATICS_PARAMETER)
+            self.perturbNativeContext(new_context, { 'lambda_electrostatics' : lambda_electrostatics })
+        return new_context
+
+    def _selectLocalEnvironment(self, positions, radius):
+        """
+        Return a boolean mask of the environment atoms within `radius` of an atom that is (or may become) alchemically modified.
+
+        """
+        center_mask = self.alchemical_atom_mask if (self.capacity_atom_mask is None) else self.capacity_atom_mask
+        return _local_environment_mask(positions, center_mask, radius.value_in_unit(unit.nanometers))
+
+    def _createSystemVariant(self, **options):
+        """
+        Create an alchemically-modified system with some options of the factory replaced (for example `local_environment_mask`).
+
+        The state of the factory, including its options and alchemically-modified system, is not changed.
+
+        """
+        saved = dict((name, getattr(self, name)) for name in list(options.keys()) + ['_region_terms', 'pruned_forces'])
+        for (name, value) in options.items():
+            setattr(self, name, value)
+        try:
+            return self._createAlchemicallyModifiedSystem(self.reference_system)
+        finally:
+            for (name, value) in saved.items():
+                setattr(self, name, value)
+
+    def getLocalEnvironmentMask(self, context=None):
+        """
+        Return the environment atoms included in the softcore forces of a Context.
 
         Parameters
         ----------
-        system : simtk.openmm.System created by AlchemicalFactory
-            The alchemically-modified system whose default global parameters are to be perturbed.
-        alchemical_state : AlchemicalState
-            The alchemical state to create from the reference system.
-
-        Examples
-        --------
-
-        Create alchemical intermediates for 'denihilating' one water in a water box.
+        context : simtk.openmm.Context, optional, default=None
+            A Context returned by `updateLocalEnvironment`; if None, or if the local environment of the Context was never
+            rebuilt, the environment selected from the test positions when the factory was created is returned.
 
-        >>> # Create a reference system.
-        >>> from openmmtools import testsystems
-        >>> waterbox = testsystems.WaterBox()
-        >>> [reference_system, positions] = [waterbox.system, waterbox.positions]
-        >>> # Create a factory to produce alchemical intermediates.
-        >>> factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=[0, 1, 2])
-        >>> # Create an alchemically-perturbed state corresponding to fully-interacting.
-        >>> alchemical_state = AlchemicalState(lambda_sterics=1.00, lambda_electrostatics=1.00)
-        >>> # Create the perturbed system.
-        >>> alchemical_system = factory.createPerturbedSystem(alchemical_state)
-        >>> # Perturb this system.
-        >>> alchemical_state = AlchemicalState(lambda_sterics=0.90, lambda_electrostatics=0.90)
-        >>> factory.perturbSystem(alchemical_system, alchemical_state)
+        Returns
+        -------
+        local_environment_mask : numpy.array of bool
+            local_environment_mask[atom] is True if the atom is included in the softcore forces.
 
         """
+        if self.local_environment_mask is None:
+            raise Exception("The factory was not created with a local_environment_radius.")
+        if context is None:
+            return self.local_environment_mask
+        return self._local_environment_masks.get(context, self.local_environment_mask)
 
-        for force_index in range(system.getNumForces()):
-            force = system.getForce(force_index)
-            if hasattr(force, 'getNumGlobalParameters'):
-                for parameter_index in range(force.getNumGlobalParameters()):
-                    parameter_name = force.getGlobalParameterName(parameter_index)
-                    if parameter_name in alchemical_state:
-                        force.setGlobalParameterDefaultValue(parameter_index, alchemical_state[parameter_name])
+    def updateLocalEnvironment(self, context, positions=None):
+        """
+        Refresh the environment atoms included in the softcore forces from the current positions.
 
-        return
+        The selection is only rebuilt (with a new System and Context) if an environment atom within
+        `local_environment_radius` of an alchemical atom is not included; it then includes all environment atoms within
+        `local_environment_radius` plus `local_environment_buffer`.  This should be called periodically, for example
+        every few hundred steps.
 
-    @classmethod
-    def perturbContext(cls, context, alchemical_state, use_all_parameters=False):
-        """
-        Perturb the specified context (using a system previously generated by this alchemical factory) by setting context parameters.
+        The selection is recorded for the returned Context only (see `getLocalEnvironmentMask`), so that Contexts of the
+        same factory, such as the replicas of a replica-exchange simulation, each follow their own environment; the
+        alchemically-modified system of the factory is not changed.
 
         Parameters
         ----------
         context : simtk.openmm.Context
-            The Context object associated with a System that has been alchemically modified.
-        alchemical_state : AlchemicalState
-            The alchemical state to est the Context to.
-        use_all_parameters : bool, optional, default=False
-            If True, will ensure that all parameters are used or raise an Exception if not.
+            The Context of a System created by this factory.
+        positions : simtk.unit.Quantity of dimension (natoms,3) with units compatible with nanometers, optional, default=None
+            The positions from which the environment is selected; if None, the positions of `context` are used.
 
-        Examples
-        --------
+        Returns
+        -------
+        context : simtk.openmm.Context
+            The Context to use from now on, which is `context` itself unless the selection was rebuilt.
 
-        Create an alchemically-modified water box and set alchemical parameters appropriately.
+        """
+        if self.local_environment_mask is None:
+            raise Exception("The factory was not created with a local_environment_radius.")
+        if positions is None:
+            positions = context.getState(getPositions=True).getPositions(asNumpy=True)
+        missing = self._selectLocalEnvironment(positions, self.local_environment_radius) & ~self.getLocalEnvironmentMask(context)
+        if not np.any(missing):
+            return context
+        local_environment_mask = self._selectLocalEnvironment(positions, self.local_environment_radius + self.local_environment_buffer)
+        logger.info("Rebuilding local environment with %d atoms, since %d atoms entered it." % (int(local_environment_mask.sum()), int(missing.sum())))
+        return self._rebuildAlchemicalContext(context, local_environment_mask)
+
+    def computeLocalEnvironmentError(self, positions, alchemical_state=None, platform=None):
+        """
+        Compute the energy of the interactions neglected by restricting the softcore forces to the local environment.
 
-        >>> # Create a reference system.
-        >>> from openmmtools import testsystems
-        >>> waterbox = testsystems.WaterBox()
-        >>> [reference_system, positions] = [waterbox.system, waterbox.positions]
-        >>> # Create a factory to produce alchemical intermediates.
-        >>> factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=[0, 1, 2])
-        >>> # Create an alchemically-perturbed state corresponding to fully-interacting.
-        >>> alchemical_state = AlchemicalState()
-        >>> # Create the perturbed system.
-        >>> alchemical_system = factory.createPerturbedSystem(alchemical_state)
-        >>> # Create a Context.
-        >>> integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
-        >>> context = openmm.Context(alchemical_system, integrator)
-        >>> # Set alchemical state.
-        >>> alchemical_state = AlchemicalState(lambda_electrostatics=0.5, lambda_sterics=0.5)
-        >>> factory.perturbContext(context, alchemical_state)
+        The energy of the softcore CustomNonbondedForces including all environment atoms is compared to that of the local
+        environment; the difference is the energy of interactions between alchemical atoms and the remaining environment.
+
+        Parameters
+        ----------
+        positions : simtk.unit.Quantity of dimension (natoms,3) with units compatible with nanometers
+            The positions at which the error is computed.
+        alchemical_state : AlchemicalState, optional, default=None
+            The alchemical state; if None, the fully interacting state is used.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform to use; if None, the platform given to the factory (or the fastest available one) is used.
+
+        Returns
+        -------
+        report : dict
+            'energy_error' is the neglected energy (simtk.unit.Quantity), and 'local_environment_atoms' and
+            'environment_atoms' count the environment atoms included in the softcore forces and in the system.
 
         """
+        if self.local_environment_mask is None:
+            raise Exception("The factory was not created with a local_environment_radius.")
+        if alchemical_state is None:
+            alchemical_state = AlchemicalState()
+        if platform is None:
+            platform = self.platform
+        # Create the system including all environment atoms, keeping the state recorded for the local one.
+        full_system = self._createSystemVariant(local_environment_mask=None)
+        potentials = list()
+        for system in [full_system, copy.deepcopy(self.alchemically_modified_system)]:
+            for force_index in reversed(range(system.getNumForces())):
+                if not isinstance(system.getForce(force_index), openmm.CustomNonbondedForce):
+                    system.removeForce(force_index)
+            self.perturbSystem(system, alchemical_state)
+            integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+            context = openmm.Context(system, integrator, platform) if (platform is not None) else openmm.Context(system, integrator)
+            context.setPositions(positions)
+            potentials.append(context.getState(getEnergy=True).getPotentialEnergy())
+            del context, integrator
+        center_mask = self.alchemical_atom_mask if (self.capacity_atom_mask is None) else self.capacity_atom_mask
+        report = { 'energy_error' : potentials[0] - potentials[1],
+                   'local_environment_atoms' : int((self.local_environment_mask & ~center_mask).sum()),
+                   'environment_atoms' : int((~center_mask).sum()) }
+        logger.info("Local environment of %d of %d environment atoms neglects %s" % (report['local_environment_atoms'], report['environment_atoms'], str(report['energy_error'])))
+        return report
 
-        # Set parameters in Context.
-        for parameter in alchemical_state.keys():
-            try:
-                context.setParameter(parameter, alchemical_state[parameter])
-            except:
-                if use_all_parameters:
-                    # Print some useful output about what parameters were available.
-                    available_parameters = context.getState(getParameters=True).getParameters().keys()
-                    raise Exception("Parameter '%s' not available in Context; available parameters are: %s" % (parameter, str(available_parameters)))
-                else:
-                    # It's OK if some parameters are not found.
-                    pass
-        return
+    @classmethod
+    def _rebuildContext(cls, context, system):
+        """
+        Create a new Context for a System, copying the integrator, platform, and state of an existing Context.
 
-    def createPerturbedSystem(self, alchemical_state=None, mm=None):
+        """
+        state = context.getState(getPositions=True, getVelocities=True, getParameters=True)
+        integrator = copy.deepcopy(context.getIntegrator())
+        platform = context.getPlatform()
+        properties = { name : platform.getPropertyValue(context, name) for name in platform.getPropertyNames() }
+        new_context = openmm.Context(system, integrator, platform, properties)
+        new_context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+        new_context.setPositions(state.getPositions())
+        new_context.setVelocities(state.getVelocities())
+        parameters = state.getParameters()
+        cls.getParameterBindingPlan(new_context).apply(new_context, { name : parameters[name] for name in parameters.keys() })
+        return new_context
+
+    def createPerturbedSystem(self, alchemical_state=None, mm=None, share_identical_systems=False, prune_inactive_forces=False):
         """
         Create a perturbed copy of the system given the specified alchemical state.
 
@@ -1322,10 +4791,28 @@ class AbsoluteAlchemicalFactory(object):
         ----------
         alchemical_state : AlchemicalState, optional, default=None
             The alchemical state to create from the reference system; if None, will create a fully-interacting alchemically-modified version.
+        share_identical_systems : bool, optional, default=False
+            If True, the returned System may be shared with other callers requesting an identical alchemical state, and a System
+            is only created if no System for an identical alchemical state is still alive.  Shared Systems are not copied when
+            modified, so they must not be modified, including by `perturbSystem`; make a copy with copy.deepcopy() first.
+            This only memoizes identical states: the System of each distinct state is a full copy of the alchemically-modified
+            system, since forces cannot be shared among Systems (see Notes).
+        prune_inactive_forces : bool, optional, default=False
+            If True, custom forces whose energy is identically zero in this alchemical state (for example the softcore
+            electrostatics when lambda_electrostatics = 0) are omitted, so that they are not evaluated.  The returned System
+            is then specialized for this state and must not be perturbed to other alchemical states; the omitted forces
+            are listed by `getPruningReport`.
+
+        Notes
+        -----
+        OpenMM System objects take ownership of their Force objects, so unmodified forces (such as the NonbondedForce or
+        the bonded forces) cannot be shared among perturbed systems, and each distinct alchemical state costs a full copy.
+        When many states are needed, memory is bounded by evaluating all of them in a single Context of one System and
+        switching states with `perturbContext` (as `computeReducedPotentials` does), or by creating them one at a time
+        with `iterPerturbedSystems`.
 
         TODO
         ----
-        * This could be streamlined if it was possible to modify System or Force objects.
         * isinstance(mm.NonbondedForce) and related expressions won't work if reference system was created with a different OpenMM implementation.
           Use class names instead.
 
@@ -1366,6 +4853,16 @@ class AbsoluteAlchemicalFactory(object):
             # TODO: Also set any other alchemical parameters defined for this system to be fully interacting.
             alchemical_state = AlchemicalState()
 
+        # Reuse a live system for an identical alchemical state if sharing is allowed.
+        if share_identical_systems:
+            key = _alchemical_state_key(alchemical_state)
+            if prune_inactive_forces:
+                key += (('prune_inactive_forces', True),)
+            system = self._shared_perturbed_systems.get(key)
+            if system is not None:
+                logger.debug("Reusing alchemically modified intermediate for identical alchemical state.")
+                return system
+
         # Record timing statistics.
         initial_time = time.time()
         logger.debug("Creating alchemically modified intermediate...")
@@ -1373,8 +4870,15 @@ class AbsoluteAlchemicalFactory(object):
         # Return an alchemically modified copy.
         system = copy.deepcopy(self.alchemically_modified_system)
 
-        # Perturb the default global parameters for this system according to the alchemical parameters.
-        self.perturbSystem(system, alchemical_state)
+        # Perturb the default global parameters (and native charges) for this system according to the alchemical parameters.
+        self.perturbNativeSystem(system, alchemical_state)
+
+        # Omit forces that do not contribute in this alchemical state.
+        if prune_inactive_forces:
+            inactive = self._inactiveForceIndices(system)
+            for force_index in reversed(inactive):
+                system.removeForce(force_index)
+            logger.debug("Omitted %d forces that are inactive in this alchemical state." % len(inactive))
 
         # Test the system energy if requested.
         if self.test_positions is not None:
@@ -1385,9 +4889,12 @@ class AbsoluteAlchemicalFactory(object):
         elapsed_time = final_time - initial_time
         logger.debug("Elapsed time %.3f s." % (elapsed_time))
 
+        if share_identical_systems:
+            self._shared_perturbed_systems[key] = system
+
         return system
 
-    def createPerturbedSystems(self, alchemical_states):
+    def createPerturbedSystems(self, alchemical_states, share_identical_systems=False, n_workers=None):
         """
         Create a list of perturbed copies of the system given a specified set of alchemical states.
 
@@ -1395,6 +4902,11 @@ class AbsoluteAlchemicalFactory(object):
         ----------
         states : list of AlchemicalState
             List of alchemical states to generate.
+        share_identical_systems : bool, optional, default=False
+            If True, identical alchemical states share a single System, which must be treated as read-only (see `createPerturbedSystem`).
+        n_workers : int, optional, default=None
+            If specified, perturbed systems are created (and checked, if test positions were provided) in parallel by this many
+            worker processes (see `iterPerturbedSystems`).  The resulting systems are identical to those created serially.
 
         Returns
         -------
@@ -1423,11 +4935,14 @@ class AbsoluteAlchemicalFactory(object):
 
         initial_time = time.time()
 
-        systems = list()
-        for (state_index, alchemical_state) in enumerate(alchemical_states):
-            logger.debug("Creating alchemical system %d / %d..." % (state_index, len(alchemical_states)))
-            system = self.createPerturbedSystem(alchemical_state)
-            systems.append(system)
+        if n_workers is not None:
+            systems = list(self.iterPerturbedSystems(alchemical_states, share_identical_systems=share_identical_systems, n_workers=n_workers))
+        else:
+            systems = list()
+            for (state_index, alchemical_state) in enumerate(alchemical_states):
+                logger.debug("Creating alchemical system %d / %d..." % (state_index, len(alchemical_states)))
+                system = self.createPerturbedSystem(alchemical_state, share_identical_systems=share_identical_systems)
+                systems.append(system)
 
         # Report timing.
         final_time = time.time()
@@ -1436,6 +4951,622 @@ class AbsoluteAlchemicalFactory(object):
 
         return systems
 
+    def iterPerturbedSystems(self, alchemical_states, prefetch=0, share_identical_systems=False, n_workers=None):
+        """
+        Iterate over perturbed copies of the system for a specified set of alchemical states, creating each System on demand.
+
+        Unlike `createPerturbedSystems`, only a bounded number of Systems are alive at any time, provided the caller
+        does not keep references to Systems it has finished with.
+
+        Parameters
+        ----------
+        alchemical_states : list of AlchemicalState
+            List of alchemical states to generate.
+        prefetch : int, optional, default=0
+            If positive, Systems are created in a background thread, at most `prefetch` ahead of the System being used by the caller.
+            At most `prefetch` Systems are then held by the iterator in addition to the one yielded to the caller.
+            If zero, each System is created only when the next one is requested.
+        share_identical_systems : bool, optional, default=False
+            If True, identical alchemical states share a single System, which must be treated as read-only (see `createPerturbedSystem`).
+        n_workers : int, optional, default=None
+            If specified, a pool of this many worker processes is sent the pickled factory once (see `__getstate__`), and
+            creates (and checks, if test positions were provided) the perturbed systems for all states in parallel.
+            Systems are returned in serialized form and deserialized only when yielded; `prefetch` is ignored.
+
+        Yields
+        ------
+        system : simtk.openmm.System
+            The alchemically-modified System for the next alchemical state.
+
+        Examples
+        --------
+
+        Compute the potential energy of each alchemical state for one water in a water box.
+
+        >>> # Create a reference system.
+        >>> from openmmtools import testsystems
+        >>> waterbox = testsystems.WaterBox()
+        >>> [reference_system, positions] = [waterbox.system, waterbox.positions]
+        >>> # Create a factory to produce alchemical intermediates.
+        >>> factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=[0, 1, 2])
+        >>> # Get the default protocol for 'denihilating' in solvent.
+        >>> protocol = factory.defaultSolventProtocolExplicit()
+        >>> # Iterate over the perturbed systems, creating the next one in the background.
+        >>> for system in factory.iterPerturbedSystems(protocol, prefetch=1):
+        ...     integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+        ...     context = openmm.Context(system, integrator)
+        ...     context.setPositions(positions)
+        ...     potential_energy = context.getState(getEnergy=True).getPotentialEnergy()
+        ...     del context, integrator
+
+        """
+
+        alchemical_states = list(alchemical_states)
+        nstates = len(alchemical_states)
+
+        def create_system(state_index):
+            logger.debug("Creating alchemical system %d / %d..." % (state_index, nstates))
+            initial_time = time.time()
+            system = self.createPerturbedSystem(alchemical_states[state_index], share_identical_systems=share_identical_systems)
+            logger.debug("iterPerturbedSystems: System %d / %d created in %.3f s." % (state_index, nstates, time.time() - initial_time))
+            return system
+
+        if n_workers is not None:
+            pool = multiprocessing.Pool(processes=n_workers, initializer=_initialize_perturbed_system_worker, initargs=(pickle.dumps(self, protocol=2),))
+            try:
+                # Create each distinct alchemical state only once.
+                results = dict()
+                for alchemical_state in alchemical_states:
+                    key = _alchemical_state_key(alchemical_state)
+                    if key not in results:
+                        results[key] = pool.apply_async(_create_serialized_perturbed_system, (alchemical_state,))
+                pool.close()
+                for (state_index, alchemical_state) in enumerate(alchemical_states):
+                    initial_time = time.time()
+                    key = _alchemical_state_key(alchemical_state)
+                    system = self._shared_perturbed_systems.get(key) if share_identical_systems else None
+                    if system is None:
+                        system = openmm.XmlSerializer.deserialize(results[key].get())
+                        if share_identical_systems:
+                            self._shared_perturbed_systems[key] = system
+                    logger.debug("iterPerturbedSystems: Waited %.3f s for system %d / %d." % (time.time() - initial_time, state_index, nstates))
+                    yield system
+                    del system
+            finally:
+                # Stop the workers, including those still busy if iteration was stopped early.
+                pool.terminate()
+                pool.join()
+            return
+
+        if prefetch <= 0:
+            for state_index in range(nstates):
+                yield create_system(state_index)
+            return
+
+        # Create systems in a background thread; each slot allows one system to be held ahead of the caller.
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        slots = threading.Semaphore(prefetch)
+        stop = threading.Event()
+        results = queue.Queue()
+
+        def produce():
+            for state_index in range(nstates):
+                slots.acquire()
+                if stop.is_set():
+                    return
+                try:
+                    results.put((create_system(state_index), None))
+                except Exception as e:
+                    results.put((None, e))
+                    return
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            for state_index in range(nstates):
+                initial_time = time.time()
+                (system, exception) = results.get()
+                if exception is not None:
+                    raise exception
+                logger.debug("iterPerturbedSystems: Waited %.3f s for system %d / %d." % (time.time() - initial_time, state_index, nstates))
+                slots.release()
+                yield system
+                del system
+        finally:
+            # Stop the background thread if the caller stops iterating early.
+            stop.set()
+            slots.release()
+            thread.join()
+
+    def getForceGroupLayout(self):
+        """
+        Return the force groups used by the alchemically-modified system.
+
+        Returns
+        -------
+        layout : dict of str : int
+            layout[role] is the force group of the forces with the given role (see `ALCHEMICAL_FORCE_GROUPS`), for every
+            role of a force in the alchemically-modified system.
+
+        Examples
+        --------
+
+        Evaluate only the energy that depends on the alchemical state.
+
+        >>> from openmmtools import testsystems
+        >>> testsystem = testsystems.AlanineDipeptideImplicit()
+        >>> factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=[0, 1, 2], assign_force_groups=True)
+        >>> layout = factory.getForceGroupLayout()
+        >>> groups = sum(1 << group for (role, group) in layout.items() if role != 'lambda_independent')
+        >>> context = openmm.Context(factory.createPerturbedSystem(), openmm.VerletIntegrator(1.0 * unit.femtoseconds))
+        >>> context.setPositions(testsystem.positions)
+        >>> alchemical_energy = context.getState(getEnergy=True, groups=groups).getPotentialEnergy()
+
+        """
+        if not self.assign_force_groups:
+            raise Exception("Force groups were not assigned; create the factory with assign_force_groups=True.")
+        return { _alchemical_force_role(force) : force.getForceGroup() for force in self.alchemically_modified_system.getForces() }
+
+    def createMultipleTimeStepIntegrator(self, timestep, substeps=2):
+        """
+        Create a multiple-time-step integrator that evaluates the softcore CustomNonbondedForces only on the outer timestep.
+
+        All other forces are integrated with the inner timestep `timestep / substeps`.  Since the softcore forces include
+        short-range repulsion between alchemical atoms and their environment, the outer timestep should be chosen with care.
+
+        Parameters
+        ----------
+        timestep : simtk.unit.Quantity with units compatible with femtoseconds
+            The outer timestep.
+        substeps : int, optional, default=2
+            The number of inner timesteps per outer timestep.
+
+        Returns
+        -------
+        integrator : simtk.openmm.CustomIntegrator
+            A reversible multiple-time-step (r-RESPA) velocity Verlet integrator for systems created by this factory.
+
+        """
+        layout = self.getForceGroupLayout()
+        outer_groups = sorted(set( group for (role, group) in layout.items() if role.startswith('softcore_') ))
+        inner_groups = sorted(set( group for (role, group) in layout.items() if not role.startswith('softcore_') ))
+        levels = [ (groups, level_substeps) for (groups, level_substeps) in [(outer_groups, 1), (inner_groups, substeps)] if len(groups) > 0 ]
+        return _create_multiple_time_step_integrator(timestep, levels)
+
+    def getPolynomialLambdaDegrees(self):
+        """
+        Determine which forces of the alchemically-modified system have energies that are exact polynomials in a single lambda.
+
+        Alchemically-softened torsions, angles, and bonds are linear in their lambdas.  Softcore electrostatics is a
+        polynomial of degree `softcore_d` in `lambda_electrostatics` if `softcore_beta` is zero and `softcore_d` is an
+        integer, and softcore sterics is a polynomial of degree `softcore_a` in `lambda_sterics` if `softcore_alpha` is zero
+        and `softcore_a` is an integer.  Forces that depend on more than one lambda (such as the alchemical exceptions, or
+        forces of systems with named alchemical regions) or on `alchemical_functions` control variables are not decomposed,
+        and neither is the generalized Born force, since lambda_electrostatics enters the Born radii nonlinearly.
+
+        Returns
+        -------
+        degrees : list of dict or None
+            degrees[force_index] is the dict { parameter : degree } for a force whose energy is a polynomial of this degree
+            in `parameter`, an empty dict for a force that does not depend on the alchemical state, or None otherwise.
+
+        """
+        def polynomial_degree(exponent):
+            if (float(exponent) >= 0.0) and float(exponent).is_integer():
+                return int(exponent)
+            return None
+
+        control_variables = set(self.alchemical_functions.values())
+        system = self.alchemically_modified_system
+        degrees = list()
+        for force in system.getForces():
+            parameters = list()
+            if hasattr(force, 'getNumGlobalParameters'):
+                parameters = [ force.getGlobalParameterName(index) for index in range(force.getNumGlobalParameters()) ]
+            if control_variables.intersection(parameters):
+                degrees.append(None)
+                continue
+            lambdas = [ parameter for parameter in parameters if parameter.startswith('lambda_') ]
+            if len(lambdas) == 0:
+                degrees.append(dict())
+                continue
+            degree = None
+            if len(lambdas) == 1:
+                [parameter] = lambdas
+                if parameter in ['lambda_torsions', 'lambda_angles', 'lambda_bonds']:
+                    degree = 1
+                elif isinstance(force, openmm.CustomNonbondedForce) and (parameter == 'lambda_electrostatics') and (self.softcore_beta == 0.0):
+                    degree = polynomial_degree(self.softcore_d)
+                elif isinstance(force, openmm.CustomNonbondedForce) and (parameter == 'lambda_sterics') and (self.softcore_alpha == 0.0):
+                    degree = polynomial_degree(self.softcore_a)
+            degrees.append({ parameter : degree } if (degree is not None) else None)
+        return degrees
+
+    def getEndpointKind(self, alchemical_state):
+        """
+        Return the kind of endpoint of an alchemical state that can be evaluated with native forces only.
+
+        A state is 'fully_interacting' if all of its nonbonded and valence lambdas are 1, and 'decoupled' if its
+        electrostatics and sterics lambdas (including those of named regions) are 0 while its valence lambdas are 1.
+        Region lambdas not listed in the state are taken to be 1.  Endpoints are only recognized where the
+        alchemically-modified system reduces to native forces: not with `alchemical_functions` or AMOEBA forces, not for
+        fully interacting states with Ewald or PME electrostatics unless `native_electrostatics` is True (reciprocal-space
+        interactions of alchemical atoms are otherwise neglected in the alchemically-modified system), and not for decoupled states with a GBSAOBCForce (its surface area
+        term cannot be removed per particle) or with nonpositive `softcore_a` or `softcore_d`.
+
+        Parameters
+        ----------
+        alchemical_state : AlchemicalState
+            The alchemical state.
+
+        Returns
+        -------
+        kind : str or None
+            'fully_interacting', 'decoupled', or None if the state has no native-force equivalent.
+
+        """
+        if len(self.alchemical_functions) > 0:
+            return None
+        nonbonded_parameters = ['lambda_electrostatics', 'lambda_sterics']
+        for name in sorted(self.alchemical_regions or dict()):
+            nonbonded_parameters += ['lambda_electrostatics_%s' % name, 'lambda_sterics_%s' % name]
+        if any(alchemical_state.get(name, 1.0) != 1.0 for name in ['lambda_torsions', 'lambda_angles', 'lambda_bonds']):
+            return None
+        values = set(alchemical_state.get(name, 1.0) for name in nonbonded_parameters)
+        if values == set([1.0]):
+            kind = 'fully_interacting'
+        elif values == set([0.0]):
+            kind = 'decoupled'
+        else:
+            return None
+
+        force_names = set(force.__class__.__name__ for force in self.reference_system.getForces())
+        if force_names & set(['AmoebaMultipoleForce', 'AmoebaVdwForce']):
+            return None
+        if kind == 'fully_interacting':
+            for force in self.reference_system.getForces():
+                if isinstance(force, openmm.NonbondedForce) and (force.getNonbondedMethod() in [openmm.NonbondedForce.Ewald, openmm.NonbondedForce.PME]) and not self.native_electrostatics:
+                    return None
+        elif ('GBSAOBCForce' in force_names) or (self.softcore_a <= 0.0) or (self.softcore_d <= 0.0):
+            return None
+        return kind
+
+    def _endpointSystem(self, kind):
+        """
+        Return the System with native forces only for the specified kind of endpoint, creating it if necessary.
+
+        The fully interacting endpoint is the reference system; the decoupled endpoint is the reference system with the
+        charges and Lennard-Jones well depths of alchemical atoms zeroed in the NonbondedForce, along with the exceptions
+        between alchemical atoms if sterics are annihilated.
+
+        """
+        if kind not in self._endpoint_systems:
+            system = copy.deepcopy(self.reference_system)
+            if kind == 'decoupled':
+                for (force_index, force) in enumerate(system.getForces()):
+                    if not isinstance(force, openmm.NonbondedForce):
+                        continue
+                    for particle_index in np.where(self.alchemical_atom_mask)[0].tolist():
+                        [charge, sigma, epsilon] = force.getParticleParameters(particle_index)
+                        force.setParticleParameters(particle_index, 0.0*charge, sigma, 0.0*epsilon)
+                    if self.annihilate_sterics:
+                        exceptions = self.reference_force_tables[force_index]['exceptions']
+                        for exception_index in np.where(self._alchemicalParticleMask(exceptions, 2))[0].tolist():
+                            [iatom, jatom, chargeprod, sigma, epsilon] = force.getExceptionParameters(exception_index)
+                            force.setExceptionParameters(exception_index, iatom, jatom, 0.0*chargeprod, sigma, 0.0*epsilon)
+            self._endpoint_systems[kind] = system
+        return self._endpoint_systems[kind]
+
+    def createEndpointSystem(self, alchemical_state):
+        """
+        Create a System with native forces only that is equivalent to an endpoint alchemical state.
+
+        Parameters
+        ----------
+        alchemical_state : AlchemicalState
+            The alchemical state, which must be an endpoint (see `getEndpointKind`).
+
+        Returns
+        -------
+        system : simtk.openmm.System
+            The System with native forces only; use `checkEndpointConsistency` to verify it against the alchemically-modified
+            system at given positions.
+
+        Examples
+        --------
+
+        >>> from openmmtools import testsystems
+        >>> testsystem = testsystems.AlanineDipeptideVacuum()
+        >>> factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=[0, 1, 2])
+        >>> system = factory.createEndpointSystem(AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.0))
+
+        """
+        kind = self.getEndpointKind(alchemical_state)
+        if kind is None:
+            raise Exception("Alchemical state %s is not an endpoint that can be evaluated with native forces." % str(alchemical_state))
+        return copy.deepcopy(self._endpointSystem(kind))
+
+    def checkEndpointConsistency(self, alchemical_state, positions, box_vectors=None, platform=None):
+        """
+        Compute the energy difference between the native-force endpoint system and the alchemically-modified system.
+
+        Parameters
+        ----------
+        alchemical_state : AlchemicalState
+            The alchemical state, which must be an endpoint (see `getEndpointKind`).
+        positions : simtk.unit.Quantity of dimension (natoms,3) with units compatible with nanometers
+            Positions at which the energies are compared; unitless values are assumed to be in nanometers.
+        box_vectors : simtk.unit.Quantity of dimension (3,3) with units compatible with nanometers, optional, default=None
+            Periodic box vectors; if None, the default box vectors of the systems are used.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform to use; if None, the platform given to the factory (or the fastest available one) is used.
+
+        Returns
+        -------
+        energy_error : simtk.unit.Quantity with units compatible with kilojoules_per_mole
+            The potential energy of the endpoint system minus that of the alchemically-modified system.
+
+        """
+        if self.getEndpointKind(alchemical_state) is None:
+            raise Exception("Alchemical state %s is not an endpoint that can be evaluated with native forces." % str(alchemical_state))
+        if platform is None:
+            platform = self.platform
+        potentials = list()
+        for system in [self._endpointSystem(self.getEndpointKind(alchemical_state)), self.createPerturbedSystem(alchemical_state)]:
+            integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+            context = openmm.Context(system, integrator, platform) if (platform is not None) else openmm.Context(system, integrator)
+            if box_vectors is not None:
+                _set_periodic_box_vectors(context, box_vectors)
+            context.setPositions(positions)
+            potentials.append(context.getState(getEnergy=True).getPotentialEnergy())
+            del context, integrator
+        energy_error = potentials[0] - potentials[1]
+        logger.debug("Difference between endpoint and alchemical potential energy is %8.3f kcal/mol" % (energy_error / unit.kilocalories_per_mole))
+        return energy_error
+
+    def _selectEndpointStates(self, alchemical_states, frames, box_frames, beta, platform, endpoint_tolerance):
+        """
+        Select the states of `computeReducedPotentials` to evaluate with endpoint systems.
+
+        Endpoint systems are only used for states whose endpoint system agrees with the alchemically-modified system on
+        the first frame within `endpoint_tolerance` (in reduced units).
+
+        Returns
+        -------
+        endpoint_kinds : list of str or None
+            The endpoint kind of each state evaluated with an endpoint system, or None.
+        frames, box_frames : iterators
+            The frames of positions and box vectors, including the first frame.
+
+        """
+        nstates = len(alchemical_states)
+        endpoint_kinds = [ self.getEndpointKind(alchemical_state) for alchemical_state in alchemical_states ]
+        if all(kind is None for kind in endpoint_kinds):
+            return (endpoint_kinds, frames, box_frames)
+        first_positions = next(frames, None)
+        first_box_vectors = next(box_frames) if ((box_frames is not None) and (first_positions is not None)) else None
+        if first_positions is not None:
+            frames = itertools.chain([first_positions], frames)
+            if box_frames is not None:
+                box_frames = itertools.chain([first_box_vectors], box_frames)
+        for kind in set(endpoint_kinds) - set([None]):
+            state_indices = [ index for index in range(nstates) if endpoint_kinds[index] == kind ]
+            if first_positions is not None:
+                energy_error = self.checkEndpointConsistency(alchemical_states[state_indices[0]], first_positions, first_box_vectors, platform)
+                if not (abs(beta * energy_error.value_in_unit(unit.kilojoules_per_mole)) <= endpoint_tolerance):
+                    logger.warning("computeReducedPotentials: %s endpoint system differs from alchemically-modified system by %s; not using it." % (kind, str(energy_error)))
+                    for index in state_indices:
+                        endpoint_kinds[index] = None
+                    continue
+            logger.debug("computeReducedPotentials: %d %s states are evaluated with native forces only." % (len(state_indices), kind))
+        return (endpoint_kinds, frames, box_frames)
+
+    def _planReducedPotentialSweep(self, system, alchemical_states, endpoint_kinds, polynomial_decomposition):
+        """
+        Plan the energy evaluations of `computeReducedPotentials`, assigning the force groups of `system` if needed.
+
+        With `polynomial_decomposition`, forces whose energy is an exact polynomial in a single lambda are assigned to
+        separate force groups, so `system` must not be shared.  Otherwise, if force groups were assigned (see
+        `getForceGroupLayout`), forces that do not depend on the alchemical state are evaluated once per frame.
+
+        Returns
+        -------
+        sweep : _ReducedPotentialSweep
+            The plan of energy evaluations for each frame.
+
+        """
+        native = (self._native_electrostatics_terms is not None)
+        sweep_groups = -1 # force groups evaluated in every distinct state
+        constant_groups = 0 # force groups that do not depend on the alchemical state
+        polynomials = list() # (parameter, interpolation nodes, force groups) for each polynomial lambda
+        if polynomial_decomposition:
+            polynomial_groups = dict()
+            sweep_groups = 0
+            for (force_index, degrees) in enumerate(self.getPolynomialLambdaDegrees()):
+                if degrees is None:
+                    group = 0
+                elif len(degrees) == 0:
+                    group = 1
+                else:
+                    [(parameter, degree)] = degrees.items()
+                    if parameter not in polynomial_groups:
+                        polynomial_groups[parameter] = (2 + len(polynomial_groups), 0)
+                    polynomial_groups[parameter] = (polynomial_groups[parameter][0], max(degree, polynomial_groups[parameter][1]))
+                    group = polynomial_groups[parameter][0]
+                system.getForce(force_index).setForceGroup(group)
+                if group == 0:
+                    sweep_groups = 1
+                elif group == 1:
+                    constant_groups = 2
+            polynomials = [ (parameter, np.linspace(0.0, 1.0, degree + 1), 1 << group) for (parameter, (group, degree)) in sorted(polynomial_groups.items()) ]
+            logger.debug("computeReducedPotentials: energies polynomial in %s are reconstructed from %d evaluations per frame." % (str(sorted(polynomial_groups.keys())), sum(len(nodes) for (parameter, nodes, groups) in polynomials)))
+        elif self.assign_force_groups and not native:
+            # The (possibly shared) System already has the force groups of `getForceGroupLayout`.
+            layout = self.getForceGroupLayout()
+            if 'lambda_independent' in layout:
+                constant_groups = 1 << layout['lambda_independent']
+                sweep_groups = sum(1 << group for group in set(layout.values()) if group != layout['lambda_independent'])
+
+        # Only the parameters of the swept forces distinguish the states that have to be swept.
+        swept_parameters = set()
+        for force in system.getForces():
+            if ((not polynomial_decomposition) or (force.getForceGroup() == 0)) and hasattr(force, 'getNumGlobalParameters'):
+                swept_parameters.update(force.getGlobalParameterName(index) for index in range(force.getNumGlobalParameters()))
+        if native:
+            swept_parameters.add('lambda_electrostatics')
+        return _ReducedPotentialSweep(alchemical_states, swept_parameters, endpoint_kinds, sweep_groups, constant_groups, polynomials)
+
+    def computeReducedPotentials(self, alchemical_states, positions, box_vectors=None, temperature=298.0*unit.kelvin, pressure=None,
+                                 platform=None, n_threads=1, chunk_size=64, out=None, polynomial_decomposition=False,
+                                 use_endpoint_systems=False, endpoint_tolerance=1.0e-3):
+        """
+        Compute the reduced potential of each frame of a trajectory in every alchemical state, as required by MBAR.
+
+        Each worker thread keeps a single Context and, for each of its frames, sweeps through the alchemical states in an
+        order that minimizes the number of parameters changed between consecutive evaluations, reversing the sweep
+        direction on every frame so that the last state of one frame is the first state of the next.  Frames are
+        processed in chunks, and each chunk of results is written to `out` as soon as it is complete.
+
+        Parameters
+        ----------
+        alchemical_states : list of AlchemicalState
+            The K alchemical states at which to evaluate the reduced potential.
+        positions : simtk.unit.Quantity, numpy array, or iterable
+            The N frames of positions; either an array (possibly memory-mapped) of shape (N, natoms, 3), or an iterable of
+            frames of shape (natoms, 3).  Unitless values are assumed to be in nanometers.
+        box_vectors : simtk.unit.Quantity, numpy array, or iterable, optional, default=None
+            Periodic box vectors of each frame, with shape (3, 3) per frame and in the same form as `positions`.
+            If None, the default box vectors of the system are used.
+        temperature : simtk.unit.Quantity with units compatible with kelvin, optional, default=298 K
+            The temperature defining the reduced potential.
+        pressure : simtk.unit.Quantity with units compatible with atmospheres, optional, default=None
+            If specified, the reduced potential includes the pressure-volume term.
+        platform : simtk.openmm.Platform, optional, default=None
+            The platform to use; if None, the platform given to the factory (or the fastest available one) is used.
+        n_threads : int, optional, default=1
+            Number of worker threads, each of which uses its own Context.
+        chunk_size : int, optional, default=64
+            Number of frames processed before results are written to `out`.
+        out : array-like of shape (K, N), optional, default=None
+            Array to which the results are written in chunks; any object supporting slice assignment, such as a numpy
+            array, a numpy memmap, or an h5py dataset, can be used.  If None, a numpy array is allocated.
+        polynomial_decomposition : bool, optional, default=False
+            If True, the energy of forces that are exact polynomials of degree d in a single lambda (see
+            `getPolynomialLambdaDegrees`) is reconstructed for all states from d+1 evaluations per frame, forces that do
+            not depend on the alchemical state are evaluated once per frame, and only the remaining forces are evaluated
+            in each distinct state.  Otherwise, if force groups were assigned (see `getForceGroupLayout`), forces that do
+            not depend on the alchemical state are evaluated once per frame, and the alchemical force groups in each state.
+        use_endpoint_systems : bool, optional, default=False
+            If True, states that are endpoints with native-force equivalents (see `getEndpointKind`) are evaluated with
+            the endpoint systems instead of the alchemically-modified system, provided that their energies agree on the
+            first frame within `endpoint_tolerance`.  Since agreement is only checked on the first frame, this should
+            only be used if the endpoint systems were validated for the configurations sampled (see
+            `checkEndpointConsistency`).
+        endpoint_tolerance : float, optional, default=1.0e-3
+            Largest difference in reduced potential between an endpoint system and the alchemically-modified system on
+            the first frame for which the endpoint system is used.
+
+        Returns
+        -------
+        u_kn : array-like of shape (K, N)
+            u_kn[k,n] is the reduced potential of frame n in alchemical state k; this is `out` if it was specified.
+
+        Examples
+        --------
+
+        Compute the reduced potentials of a short trajectory of alanine dipeptide in all states of a protocol.
+
+        >>> from openmmtools import testsystems
+        >>> testsystem = testsystems.AlanineDipeptideImplicit()
+        >>> factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=[0, 1, 2])
+        >>> protocol = factory.defaultComplexProtocolImplicit()
+        >>> trajectory = [ testsystem.positions ] * 4
+        >>> u_kn = factory.computeReducedPotentials(protocol, trajectory)
+
+        """
+
+        alchemical_states = list(alchemical_states)
+        nstates = len(alchemical_states)
+        kT = kB * temperature
+        beta = 1.0 / kT.value_in_unit(unit.kilojoules_per_mole)
+        if platform is None:
+            platform = self.platform
+
+        # Route endpoint states to systems with native forces only, if they agree with the alchemically-modified system on the first frame.
+        frames = _iterate_frames(positions)
+        box_frames = _iterate_frames(box_vectors) if (box_vectors is not None) else None
+        endpoint_kinds = [ None for alchemical_state in alchemical_states ]
+        if use_endpoint_systems:
+            (endpoint_kinds, frames, box_frames) = self._selectEndpointStates(alchemical_states, frames, box_frames, beta, platform, endpoint_tolerance)
+
+        # With native electrostatics, the charges of native forces depend on lambda_electrostatics, so that all forces are
+        # evaluated in each state.
+        native = (self._native_electrostatics_terms is not None)
+        if native and polynomial_decomposition:
+            logger.warning("computeReducedPotentials: polynomial decomposition is not available with native electrostatics.")
+            polynomial_decomposition = False
+
+        # Create one worker per thread, each with its own Context.  Native charges are scaled in the System of a Context,
+        # so that workers only share the System without native electrostatics.
+        system = self.createPerturbedSystem(alchemical_states[0], share_identical_systems=not (polynomial_decomposition or native))
+        sweep = self._planReducedPotentialSweep(system, alchemical_states, endpoint_kinds, polynomial_decomposition)
+        endpoint_systems = dict((kind, self._endpointSystem(kind)) for kind in sweep.endpoint_indices)
+        workers = [ _ReducedPotentialWorker(self, copy.deepcopy(system) if (native and (thread_index > 0)) else system, endpoint_systems, platform) for thread_index in range(n_threads) ]
+
+        def evaluate(worker, frames, u_kn):
+            for (frame_index, (frame_positions, frame_box_vectors)) in frames:
+                worker.setFrame(frame_positions, frame_box_vectors)
+                reduced_volume = 0.0
+                if pressure is not None:
+                    reduced_volume = pressure * worker.computeVolume() * unit.AVOGADRO_CONSTANT_NA / kT
+                u_kn[:, frame_index] = beta * sweep.evaluate(worker) + reduced_volume
+
+        if hasattr(positions, '__len__') and (out is None):
+            out = np.zeros([nstates, len(positions)], np.float64)
+        blocks = list()
+
+        initial_time = time.time()
+        nframes = 0
+        while True:
+            chunk = list()
+            for frame_positions in frames:
+                chunk.append((frame_positions, next(box_frames) if (box_frames is not None) else None))
+                if len(chunk) == chunk_size:
+                    break
+            if len(chunk) == 0:
+                break
+
+            # Distribute the frames of this chunk among the workers.
+            u_kn = np.zeros([nstates, len(chunk)], np.float64)
+            assignments = [ list(enumerate(chunk))[thread_index::n_threads] for thread_index in range(n_threads) ]
+            if n_threads == 1:
+                evaluate(workers[0], assignments[0], u_kn)
+            else:
+                threads = [ threading.Thread(target=evaluate, args=(workers[thread_index], assignments[thread_index], u_kn)) for thread_index in range(n_threads) ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            if out is not None:
+                out[:, nframes:nframes+len(chunk)] = u_kn
+            else:
+                blocks.append(u_kn)
+            nframes += len(chunk)
+            logger.debug("computeReducedPotentials: %d frames processed." % nframes)
+
+        elapsed_time = time.time() - initial_time
+        throughput = (nframes * nstates / elapsed_time) if (elapsed_time > 0.0) else float('inf')
+        logger.info("computeReducedPotentials: %d frames x %d states in %.3f s (%.1f frames x states / s)" % (nframes, nstates, elapsed_time, throughput))
+
+        if out is None:
+            out = np.concatenate(blocks, axis=1) if blocks else np.zeros([nstates, 0], np.float64)
+        return out
+
     def _is_restraint(self, valence_atoms):
         """
         Determine whether specified valence term connects the ligand with its environment.
@@ -1478,3 +5609,31 @@ class AbsoluteAlchemicalFactory(object):
             return True
 
         return False
+
+#=============================================================================================
+# PARALLEL CONSTRUCTION OF PERTURBED SYSTEMS
+#=============================================================================================
+
+# Alchemical factory held by each worker process, initialized once per worker.
+_worker_factory = None
+
+def _initialize_perturbed_system_worker(serialized_factory):
+    """
+    Initialize a worker process with a copy of the alchemical factory.
+
+    Parameters
+    ----------
+    serialized_factory : bytes
+        The pickled factory (see `AbsoluteAlchemicalFactory.__getstate__`).
+
+    """
+    global _worker_factory
+    _worker_factory = pickle.loads(serialized_factory)
+
+def _create_serialized_perturbed_system(alchemical_state):
+    """
+    Create and check a perturbed system in a worker process, returning it in serialized form.
+
+    """
+    return openmm.XmlSerializer.serialize(_worker_factory.createPerturbedSystem(alchemical_state))
+
@@ -17,6 +17,7 @@ import os, os.path
 import numpy as np
 import copy
 import time
+import threading
 from functools import partial
 
 from simtk import unit, openmm
@@ -30,7 +31,7 @@ logger = logging.getLogger(__name__)
 
 from openmmtools import testsystems
 
-from alchemy import AlchemicalState, AbsoluteAlchemicalFactory
+from alchemy import AlchemicalState, AbsoluteAlchemicalFactory, global_context_cache
 
 from nose.plugins.skip import Skip, SkipTest
 
@@ -147,16 +148,11 @@ def dump_xml(system=None, integrator=None, state=None):
     return
 
 def compute_energy(system, positions, platform=None, precision=None):
-    timestep = 1.0 * unit.femtoseconds
-    integrator = openmm.VerletIntegrator(timestep)
-    if platform:
-        context = openmm.Context(system, integrator, platform)
-    else:
-        context = openmm.Context(system, integrator)
+    context = global_context_cache.getContext(system, platform)
     context.setPositions(positions)
     state = context.getState(getEnergy=True)
     potential = state.getPotentialEnergy()
-    del context, integrator, state
+    del state
     return potential
 
 def check_waterbox(platform=None, precision=None, nonbondedMethod=openmm.NonbondedForce.CutoffPeriodic):
@@ -304,8 +300,6 @@ def test_annihilated_states(platform_name=None, precision=None):
 
 def compareSystemEnergies(positions, systems, descriptions, platform=None, precision=None):
     # Compare energies.
-    timestep = 1.0 * unit.femtosecond
-
     if platform:
         platform_name = platform.getName()
         if precision:
@@ -318,19 +312,14 @@ def compareSystemEnergies(positions, systems, descriptions, platform=None, preci
     states = list()
     for system in systems:
         #dump_xml(system=system)
-        integrator = openmm.VerletIntegrator(timestep)
-        #dump_xml(integrator=integrator)
-        if platform:
-            context = openmm.Context(system, integrator, platform)
-        else:
-            context = openmm.Context(system, integrator)
+        context = global_context_cache.getContext(system, platform)
         context.setPositions(positions)
         state = context.getState(getEnergy=True, getPositions=True)
-        #dump_xml(system=system, integrator=integrator, state=state)
+        #dump_xml(system=system, state=state)
         potential = state.getPotentialEnergy()
         potentials.append(potential)
         states.append(state)
-        del context, integrator, state
+        del state
 
     logger.info("========")
     for i in range(len(systems)):
@@ -466,6 +455,44 @@ def benchmark(reference_system, positions, platform_name=None, nsteps=500, times
 
     return delta
 
+def compare_option_values(reference_system, positions, option, values, factory_args=None, absolute_tolerance=1.0e-6, relative_tolerance=0.0):
+    """
+    Compare energies of alchemically modified systems created with different values of a factory option.
+
+    Parameters
+    ----------
+    reference_system : simtk.openmm.System
+       The reference System object to alchemically modify
+    positions : simtk.unit.Quantity with units compatible with nanometers
+       The positions to assess energetics for.
+    option : str
+       The name of the AbsoluteAlchemicalFactory option to vary.
+    values : list
+       The values of the option; energies for each value are compared to those of the first.
+    factory_args : dict(), optional, default=None
+       Additional arguments passed to AbsoluteAlchemicalFactory.
+    absolute_tolerance : float, optional, default=1.0e-6
+       Absolute tolerance on energy differences, in kJ/mol.
+    relative_tolerance : float, optional, default=0.0
+       Tolerance on energy differences relative to the energy for the first value.
+
+    """
+    if factory_args is None: factory_args = dict()
+    platform = openmm.Platform.getPlatformByName('Reference')
+    alchemical_states = [ AlchemicalState(), AlchemicalState(lambda_electrostatics=0.5, lambda_sterics=0.5), AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.75),
+                          AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.3), AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.0) ]
+    factories = list()
+    for value in values:
+        option_args = dict(factory_args)
+        option_args[option] = value
+        factories.append(AbsoluteAlchemicalFactory(reference_system, **option_args))
+    for alchemical_state in alchemical_states:
+        energies = [ compute_energy(factory.createPerturbedSystem(alchemical_state), positions, platform=platform) / unit.kilojoules_per_mole for factory in factories ]
+        for (value, energy) in zip(values[1:], energies[1:]):
+            delta = energy - energies[0]
+            if abs(delta) > max(absolute_tolerance, relative_tolerance * abs(energies[0])):
+                raise Exception("Energy with %s=%s differs from %s=%s by %.6f kJ/mol at %s" % (option, str(value), option, str(values[0]), delta, str(alchemical_state)))
+
 def overlap_check(reference_system, positions, platform_name=None, precision=None, nsteps=50, nsamples=200, factory_args=None, cached_trajectory_filename=None):
     """
     Test overlap between reference system and alchemical system by running a short simulation.
@@ -672,16 +699,10 @@ def lambda_trace(reference_system, positions, platform_name=None, precision=None
     delta = 1.0 / nsteps
 
     def compute_potential(system, positions, platform=None):
-        timestep = 1.0 * unit.femtoseconds
-        integrator = openmm.VerletIntegrator(timestep)
-        if platform:
-            context = openmm.Context(system, integrator, platform)
-        else:
-            context = openmm.Context(system, integrator)
+        context = global_context_cache.getContext(system, platform)
         context.setPositions(positions)
         state = context.getState(getEnergy=True)
         potential = state.getPotentialEnergy()
-        del integrator, context
         return potential
 
     # Compute unmodified energy.
@@ -843,6 +864,24 @@ overlap_testsystem_names = [
     'toluene in implicit solvent',
 ]
 
+# Values of factory options that must reproduce the energies of the first value, as
+# (option, values, test system names, additional factory arguments, absolute tolerance in kJ/mol, relative tolerance)
+equivalent_option_values = [
+    ('nonbonded_layout', ['split', 'fused'], ['Lennard-Jones fluid without dispersion correction', 'TIP3P with reaction field, switch, no dispersion correction',
+        'TIP3P with reaction field, no switch, dispersion correction', 'alanine dipeptide in OBC GBSA'], dict(), 1.0e-3, 0.0),
+    # The precomputed dispersion correction allows sterics and electrostatics to be fused with a switching function.
+    ('nonbonded_layout', ['split', 'fused'], ['TIP3P with reaction field, switch, dispersion correction'], dict(dispersion_correction='precomputed'), 1.0e-3, 0.0),
+    ('dispersion_correction', ['native', 'precomputed'], ['Lennard-Jones fluid with dispersion correction', 'TIP3P with reaction field, switch, dispersion correction'], dict(), 1.0e-3, 0.0),
+    ('tabulate_softcore', [False, True], ['Lennard-Jones cluster', 'TIP3P with reaction field, switch, dispersion correction',
+        'TIP3P with PME, no switch, no dispersion correction'], dict(dispersion_correction='precomputed'), 1.0e-2, 0.0),
+    ('freeze_softcore_parameters', [None, True], ['alanine dipeptide in vacuum with annihilated sterics', 'TIP3P with reaction field, switch, dispersion correction',
+        'TIP3P with PME, no switch, no dispersion correction'], dict(), 1.0e-6, 1.0e-6),
+    ('interaction_topology', ['full', 'minimal'], ['TIP3P with reaction field, no switch, dispersion correction', 'alanine dipeptide in OBC GBSA, with sterics annihilated',
+        'toluene in implicit solvent'], dict(), 1.0e-6, 1.0e-6),
+    ('region_decomposition', ['interaction_groups', 'masked'], ['TIP3P with reaction field, no switch, dispersion correction',
+        'alanine dipeptide in OBC GBSA, with sterics annihilated'], dict(), 1.0e-6, 1.0e-6),
+]
+
 #=============================================================================================
 # Test various options to AbsoluteAlchemicalFactory
 #=============================================================================================
@@ -877,10 +916,729 @@ def test_softcore_parameters():
     alchemical_system = factory.createPerturbedSystem()
     compareSystemEnergies(positions, [reference_system, alchemical_system], ['reference', 'alchemical'])
 
+def test_force_tables():
+    """
+    Testing columnar force parameter tables match reference force parameters
+    """
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=range(0,6), alchemical_angles=True)
+    for (force_index, force) in enumerate(factory.reference_system.getForces()):
+        tables = factory.reference_force_tables[force_index]
+        if force.__class__.__name__ == 'NonbondedForce':
+            assert len(tables['particles']) == force.getNumParticles()
+            assert len(tables['exceptions']) == force.getNumExceptions()
+            [charge, sigma, epsilon] = force.getParticleParameters(3)
+            assert np.allclose(list(tables['particles'][3]), [charge / unit.elementary_charge, sigma / unit.nanometers, epsilon / unit.kilojoules_per_mole])
+        elif force.__class__.__name__ == 'HarmonicAngleForce':
+            assert len(tables['angles']) == force.getNumAngles()
+            [particle1, particle2, particle3, theta0, K] = force.getAngleParameters(0)
+            assert list(tables['angles'][0])[:3] == [particle1, particle2, particle3]
+    # Alchemical particle mask should match ligand atoms.
+    assert np.all(np.where(factory.alchemical_atom_mask)[0] == np.arange(0,6))
+
+def test_molecular_graph():
+    """
+    Testing bond graph queries match bonds and torsions of the reference system
+    """
+    from alchemy import MolecularGraph
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    system = testsystem.system
+    graph = MolecularGraph.fromSystem(system)
+    bonds = [ set() for particle_index in range(system.getNumParticles()) ]
+    for force in system.getForces():
+        if force.__class__.__name__ == 'HarmonicBondForce':
+            for bond_index in range(force.getNumBonds()):
+                [particle1, particle2, r, K] = force.getBondParameters(bond_index)
+                bonds[particle1].add(particle2)
+                bonds[particle2].add(particle1)
+    for particle_index in range(system.getNumParticles()):
+        assert graph.neighbors(particle_index).tolist() == sorted(bonds[particle_index])
+    # Torsion properness matches chains of bonds.
+    for force in system.getForces():
+        if force.__class__.__name__ == 'PeriodicTorsionForce':
+            torsions = np.array([ force.getTorsionParameters(index)[:4] for index in range(force.getNumTorsions()) ])
+            proper = [ (j in bonds[i]) and (k in bonds[j]) and (l in bonds[k]) for (i, j, k, l) in torsions ]
+            assert graph.isProperTorsion(torsions).tolist() == proper
+    # Neighborhoods grow by one bond at a time.
+    assert graph.withinBonds([0], 0).tolist() == [0]
+    assert graph.withinBonds([0], 1).tolist() == sorted(bonds[0] | set([0]))
+    assert set(graph.withinBonds([0], 2).tolist()) == set([0]).union(*[ bonds[i] | set([i]) for i in bonds[0] ])
+
+def test_fused_nonbonded_layout():
+    """
+    Testing fused softcore sterics and electrostatics replace the separate softcore forces with one force
+    """
+    test_system = test_systems['TIP3P with reaction field, switch, no dispersion correction']
+    factories = [ AbsoluteAlchemicalFactory(test_system['test'].system, nonbonded_layout=layout, **test_system['factory_args']) for layout in ['split', 'fused'] ]
+    assert factories[1].alchemically_modified_system.getNumForces() == factories[0].alchemically_modified_system.getNumForces() - 1
+
+def test_dispersion_correction_volume():
+    """
+    Testing the precomputed dispersion correction scales with the inverse volume of a non-cubic box
+    """
+    from alchemy.alchemy import INVERSE_VOLUME_PARAMETER, _set_periodic_box_vectors
+    test_system = copy.deepcopy(test_systems['Lennard-Jones fluid with dispersion correction'])
+    reference_system = test_system['test'].system
+    [a, b, c] = [ vector / unit.nanometers for vector in reference_system.getDefaultPeriodicBoxVectors() ]
+    box_vectors = [ openmm.Vec3(a[0], 0.0, 0.0), openmm.Vec3(0.2*a[0], 1.1*b[1], 0.0), openmm.Vec3(0.3*a[0], 0.2*b[1], 1.3*c[2]) ] * unit.nanometers
+    reference_system.setDefaultPeriodicBoxVectors(*box_vectors)
+    factory = AbsoluteAlchemicalFactory(reference_system, dispersion_correction='precomputed', **test_system['factory_args'])
+    force = [ force for force in factory.alchemically_modified_system.getForces() if isinstance(force, openmm.CustomCVForce) ][0]
+    coefficient = force.getTabulatedFunction(0).getFunctionParameters()[0][-1]
+    # Evaluate the correction alone at lambda_sterics = 1.
+    system = openmm.System()
+    for particle_index in range(reference_system.getNumParticles()):
+        system.addParticle(reference_system.getParticleMass(particle_index))
+    system.setDefaultPeriodicBoxVectors(*box_vectors)
+    system.addForce(copy.deepcopy(force))
+    context = openmm.Context(system, openmm.VerletIntegrator(1.0 * unit.femtoseconds), openmm.Platform.getPlatformByName('Reference'))
+    context.setPositions(test_system['test'].positions)
+    for box in [box_vectors, [a, b, c] * unit.nanometers]:
+        _set_periodic_box_vectors(context, box)
+        volume = context.getState().getPeriodicBoxVolume() / unit.nanometers**3
+        energy = context.getState(getEnergy=True).getPotentialEnergy() / unit.kilojoules_per_mole
+        assert abs(context.getParameter(INVERSE_VOLUME_PARAMETER) * volume - 1.0) < 1.0e-10
+        assert abs(energy - coefficient / volume) < 1.0e-6 * max(1.0, abs(energy))
+    # The inverse box volume cannot follow a barostat.
+    reference_system.addForce(openmm.MonteCarloBarostat(1.0 * unit.atmospheres, 300.0 * unit.kelvin))
+    error_message = None
+    try:
+        AbsoluteAlchemicalFactory(reference_system, dispersion_correction='precomputed', **test_system['factory_args'])
+    except Exception as e:
+        error_message = str(e)
+    assert (error_message is not None) and ('barostat' in error_message)
+
+def test_tabulated_softcore():
+    """
+    Testing tabulated softcore kernel error estimates, and that tabulation requires the precomputed dispersion correction
+    """
+    for name in ['Lennard-Jones cluster', 'TIP3P with PME, no switch, no dispersion correction']:
+        test_system = test_systems[name]
+        factory = AbsoluteAlchemicalFactory(test_system['test'].system, dispersion_correction='precomputed', tabulate_softcore=True, **test_system['factory_args'])
+        errors = factory.computeSoftcoreTableErrors(npoints=16)
+        assert errors['sterics_kernel']['max_relative_error'] < 0.05
+        if 'PME' in name:
+            assert errors['ewald_kernel']['max_relative_error'] < 1.0e-4
+    # Tabulated kernels cannot be combined with the long-range correction computed by OpenMM.
+    test_system = test_systems['TIP3P with reaction field, switch, dispersion correction']
+    error_message = None
+    try:
+        AbsoluteAlchemicalFactory(test_system['test'].system, tabulate_softcore=True, **test_system['factory_args'])
+    except Exception as e:
+        error_message = str(e)
+    assert (error_message is not None) and ('precomputed' in error_message)
+
+def test_frozen_softcore_parameters():
+    """
+    Testing frozen softcore parameters are removed from the global parameters of softcore forces
+    """
+    from alchemy import SOFTCORE_PARAMETERS
+    test_system = test_systems['TIP3P with reaction field, switch, dispersion correction']
+    reference_system = test_system['test'].system
+    # Frozen softcore parameters are constants, and default powers are strength-reduced.
+    factory = AbsoluteAlchemicalFactory(reference_system, freeze_softcore_parameters=True, **test_system['factory_args'])
+    for force in factory.alchemically_modified_system.getForces():
+        if isinstance(force, (openmm.CustomNonbondedForce, openmm.CustomBondForce)):
+            global_parameters = [ force.getGlobalParameterName(index) for index in range(force.getNumGlobalParameters()) ]
+            assert not set(SOFTCORE_PARAMETERS).intersection(global_parameters)
+            assert 'softcore_' not in force.getEnergyFunction()
+    # Only the listed parameters are frozen.
+    factory = AbsoluteAlchemicalFactory(reference_system, freeze_softcore_parameters=['softcore_c', 'softcore_f'], **test_system['factory_args'])
+    force = [ force for force in factory.alchemically_modified_system.getForces() if isinstance(force, openmm.CustomNonbondedForce) ][0]
+    global_parameters = [ force.getGlobalParameterName(index) for index in range(force.getNumGlobalParameters()) ]
+    assert ('softcore_alpha' in global_parameters) and ('softcore_c' not in global_parameters)
+
+def test_expression_simplification():
+    """
+    Testing parsing and simplification of energy expressions, including powers that cannot be folded
+    """
+    from alchemy.alchemy import _parse_expression, _format_expression_tree, _simplify_expression_tree, _reduce_power, _fold_expression, _specialize_energy_expression
+    def simplify(expression):
+        return _format_expression_tree(_simplify_expression_tree(_parse_expression(expression)[0]))
+    # Parser precedence: unary minus binds looser than '^', which is right-associative.
+    (energy, definitions) = _parse_expression("-x^2^y + 2*f(a, b); a = 1.5e-1; b = .5")
+    assert energy == ('+', ('neg', ('^', ('var', 'x'), ('^', ('num', 2.0), ('var', 'y')))), ('*', ('num', 2.0), ('call', 'f', (('var', 'a'), ('var', 'b')))))
+    assert definitions == [('a', ('num', 0.15)), ('b', ('num', 0.5))]
+    for expression in ["x = 1", "x; a = 1; a = 2", "(x", "x +* y"]:
+        try:
+            _parse_expression(expression)
+        except Exception:
+            continue
+        raise Exception("Malformed expression '%s' was accepted." % expression)
+    # Constant folding and strength reduction.
+    assert simplify("1*x + 0*y - 0") == "x"
+    assert simplify("2^3 + x^6") == "8+(x^2)^3"
+    assert simplify("x^0.5 * y^-2") == "sqrt(x)/y^2"
+    assert simplify("(x^2)^3") == "(x^2)^3"
+    # Zero bases with negative exponents, and negative bases with fractional exponents, are left unreduced.
+    assert simplify("0^-1") == "0^(-1)"
+    assert simplify("(-8)^(1/3)") == "(-8)^0.3333333333333333"
+    assert simplify("(0*x)^-2") == "0^(-2)"
+    assert _fold_expression("x*a^-1; a = b", { 'b' : 0.0 })[None] == ('/', ('var', 'x'), ('num', 0.0))
+    # Nested powers only combine for integer inner exponents: (x^0.5)^2 is not x for x < 0, and (x^1.5)^2 is not x^3.
+    assert simplify("(x^1.5)^2") == "(x^1.5)^2"
+    assert _reduce_power(('^', ('var', 'x'), ('num', 0.5)), ('num', 2.0)) == ('^', ('^', ('var', 'x'), ('num', 0.5)), ('num', 2.0))
+    assert _reduce_power(('^', ('var', 'x'), ('num', -1.0)), ('num', 2.0)) == ('/', ('num', 1.0), ('^', ('var', 'x'), ('num', 2.0)))
+    # Specialization hoists repeated subexpressions and drops unused definitions.
+    assert _specialize_energy_expression("a*(x+y)^2 + b*(x+y)^2; a = c^2; b = 1; unused = z", { 'c' : 2.0 }) == "4*cse0+cse0; cse0 = (x+y)^2;"
+    assert _specialize_energy_expression("(x+y)*(x+y)*z; x = r^2", {}) == "cse0*cse0*z; cse0 = x+y; x = r^2;"
+
+def test_force_pruning():
+    """
+    Testing removal of empty forces and of forces that are inactive in an alchemical state
+    """
+    platform = openmm.Platform.getPlatformByName('Reference')
+    test_system = copy.deepcopy(test_systems['TIP3P with reaction field, switch, no dispersion correction'])
+    [reference_system, positions] = [test_system['test'].system, test_system['test'].positions]
+    factories = [ AbsoluteAlchemicalFactory(reference_system, prune_empty_forces=prune_empty_forces, **test_system['factory_args']) for prune_empty_forces in [False, True] ]
+    # Without annihilated sterics, the CustomBondForce for alchemical exceptions is empty.
+    report = factories[1].getPruningReport()
+    assert [ (force['force_class'], force['role']) for force in report['empty_forces'] ] == [('CustomBondForce', 'lambda_nonbonded')]
+    assert factories[1].alchemically_modified_system.getNumForces() == factories[0].alchemically_modified_system.getNumForces() - 1
+    # Softcore forces are omitted in states where their energy is identically zero.
+    for alchemical_state in [ AlchemicalState(lambda_electrostatics=0.0), AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.0), AlchemicalState(lambda_electrostatics=0.5) ]:
+        report = factories[1].getPruningReport(alchemical_state)
+        system = factories[1].createPerturbedSystem(alchemical_state, prune_inactive_forces=True)
+        assert system.getNumForces() == report['num_forces']
+        assert report['kernel_launches_saved'] == len(report['empty_forces']) + len(report['inactive_forces'])
+        assert ('softcore_electrostatics' in [ force['role'] for force in report['inactive_forces'] ]) == (alchemical_state['lambda_electrostatics'] == 0.0)
+        assert ('softcore_sterics' in [ force['role'] for force in report['inactive_forces'] ]) == (alchemical_state['lambda_sterics'] == 0.0)
+        energies = [ compute_energy(system, positions, platform=platform) ] + [ compute_energy(factory.createPerturbedSystem(alchemical_state), positions, platform=platform) for factory in factories ]
+        for energy in energies[1:]:
+            assert abs(energy - energies[0]) < 1.0e-6 * unit.kilojoules_per_mole
+
+def test_interaction_topology():
+    """
+    Testing the interaction topology report matches the softcore forces that were created
+    """
+    platform = openmm.Platform.getPlatformByName('Reference')
+    test_system = test_systems['alanine dipeptide in OBC GBSA, with sterics annihilated']
+    [reference_system, positions] = [test_system['test'].system, test_system['test'].positions]
+    factories = [ AbsoluteAlchemicalFactory(reference_system, interaction_topology=interaction_topology, **test_system['factory_args']) for interaction_topology in ['full', 'minimal'] ]
+    report = factories[1].getInteractionTopologyReport(positions, platform=platform, nevaluations=1)
+    assert report['minimal']['exclusions'] <= report['full']['exclusions']
+    assert (report['full']['ms_per_step'] > 0.0) and (report['minimal']['ms_per_step'] > 0.0)
+    for (interaction_topology, factory) in zip(['full', 'minimal'], factories):
+        for force in factory.alchemically_modified_system.getForces():
+            if isinstance(force, openmm.CustomNonbondedForce):
+                assert force.getNumExclusions() == report[interaction_topology]['exclusions']
+                assert force.getNumInteractionGroups() == report[interaction_topology]['interaction_groups']
+
+def test_region_decomposition():
+    """
+    Testing the masked region decomposition uses no interaction groups, and automatic selection
+    """
+    platform = openmm.Platform.getPlatformByName('Reference')
+    test_system = test_systems['TIP3P with reaction field, no switch, dispersion correction']
+    [reference_system, positions] = [test_system['test'].system, test_system['test'].positions]
+    factory = AbsoluteAlchemicalFactory(reference_system, region_decomposition='masked', **test_system['factory_args'])
+    for force in factory.alchemically_modified_system.getForces():
+        if isinstance(force, openmm.CustomNonbondedForce):
+            assert force.getNumInteractionGroups() == 0
+    # Automatic selection times both decompositions.
+    factory = AbsoluteAlchemicalFactory(reference_system, region_decomposition='auto', test_positions=positions, platform=platform, **test_system['factory_args'])
+    assert set(factory.region_decomposition_timings.keys()) == set(['interaction_groups', 'masked'])
+    assert factory.region_decomposition == min(factory.region_decomposition_timings, key=factory.region_decomposition_timings.get)
+
+def test_local_environment():
+    """
+    Testing restriction of softcore forces to the environment near the alchemical region
+    """
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    platform = openmm.Platform.getPlatformByName('Reference')
+    factory_args = dict(ligand_atoms=range(0,6), test_positions=positions, platform=platform)
+    full_factory = AbsoluteAlchemicalFactory(reference_system, **factory_args)
+    factory = AbsoluteAlchemicalFactory(reference_system, local_environment_radius=0.3*unit.nanometers, local_environment_buffer=0.0*unit.nanometers, **factory_args)
+    alchemical_state = AlchemicalState(lambda_electrostatics=0.5, lambda_sterics=0.8)
+    report = factory.computeLocalEnvironmentError(positions, alchemical_state)
+    assert 0 < report['local_environment_atoms'] < report['environment_atoms']
+    # The neglected energy accounts for the difference from the full environment.
+    [full_energy, local_energy] = [ compute_energy(f.createPerturbedSystem(alchemical_state), positions, platform=platform) for f in [full_factory, factory] ]
+    assert abs((full_energy - local_energy) - report['energy_error']) < 1.0e-6 * unit.kilojoules_per_mole
+    # The selection is only rebuilt when an environment atom comes within the radius.
+    context = openmm.Context(factory.createPerturbedSystem(), openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+    context.setPositions(positions)
+    assert factory.updateLocalEnvironment(context) is context
+    moved_positions = np.array(positions / unit.nanometers)
+    far_atom = np.where(~factory.local_environment_mask & ~factory.alchemical_atom_mask)[0][0]
+    moved_positions[far_atom] = moved_positions[0] + [0.25, 0.0, 0.0]
+    new_context = factory.updateLocalEnvironment(context, moved_positions * unit.nanometers)
+    assert (new_context is not context) and factory.getLocalEnvironmentMask(new_context)[far_atom]
+    # Other Contexts of the factory keep their own environment.
+    assert not factory.getLocalEnvironmentMask()[far_atom]
+    other_context = openmm.Context(factory.createPerturbedSystem(), openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+    other_context.setPositions(positions)
+    assert factory.updateLocalEnvironment(other_context) is other_context
+    assert factory.updateLocalEnvironment(new_context, moved_positions * unit.nanometers) is new_context
+
+def test_force_groups():
+    """
+    Testing force group layout of alchemically-modified systems and multiple-time-step integration
+    """
+    from alchemy import ALCHEMICAL_FORCE_GROUPS
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    platform = openmm.Platform.getPlatformByName('Reference')
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6), alchemical_torsions=True, annihilate_sterics=True, assign_force_groups=True)
+    layout = factory.getForceGroupLayout()
+    for role in ['lambda_independent', 'lambda_torsions', 'lambda_electrostatics', 'lambda_nonbonded', 'softcore_sterics', 'softcore_electrostatics']:
+        assert layout[role] == ALCHEMICAL_FORCE_GROUPS[role]
+    # The energy of the alchemical force groups accounts for all of the change in energy with the alchemical state.
+    alchemical_groups = sum(1 << group for (role, group) in layout.items() if role != 'lambda_independent')
+    def compute_group_energies(alchemical_state):
+        context = openmm.Context(factory.createPerturbedSystem(alchemical_state), openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+        context.setPositions(positions)
+        return [ context.getState(getEnergy=True, groups=groups).getPotentialEnergy() / unit.kilojoules_per_mole for groups in [-1, alchemical_groups] ]
+    [total_energy1, alchemical_energy1] = compute_group_energies(AlchemicalState())
+    [total_energy0, alchemical_energy0] = compute_group_energies(AlchemicalState(lambda_electrostatics=0.2, lambda_sterics=0.4, lambda_torsions=0.5))
+    assert abs((total_energy1 - total_energy0) - (alchemical_energy1 - alchemical_energy0)) < 1.0e-6
+    # Multiple-time-step integration with the softcore forces on the outer timestep.
+    integrator = factory.createMultipleTimeStepIntegrator(2.0 * unit.femtoseconds, substeps=2)
+    context = openmm.Context(factory.createPerturbedSystem(AlchemicalState(lambda_sterics=0.5)), integrator, platform)
+    context.setPositions(positions)
+    integrator.step(10)
+    assert np.isfinite(context.getState(getEnergy=True).getPotentialEnergy() / unit.kilojoules_per_mole)
+
+def test_share_identical_systems():
+    """
+    Testing identical alchemical states share perturbed systems if requested
+    """
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=range(0,22))
+    alchemical_states = [ AlchemicalState(lambda_sterics=0.5), AlchemicalState(lambda_electrostatics=0.5), AlchemicalState(lambda_sterics=0.5) ]
+    systems = factory.createPerturbedSystems(alchemical_states, share_identical_systems=True)
+    assert systems[0] is systems[2]
+    assert systems[0] is not systems[1]
+    assert factory.createPerturbedSystem(AlchemicalState(lambda_sterics=0.5), share_identical_systems=True) is systems[0]
+    # Without sharing, every state gets its own system.
+    assert factory.createPerturbedSystem(AlchemicalState(lambda_sterics=0.5)) is not systems[0]
+
+def test_iter_perturbed_systems():
+    """
+    Testing streaming creation of perturbed systems matches createPerturbedSystems
+    """
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=range(0,22))
+    protocol = factory.defaultVacuumProtocol()
+    serialized_systems = [ openmm.XmlSerializer.serialize(system) for system in factory.createPerturbedSystems(protocol) ]
+    for prefetch in [0, 2]:
+        assert [ openmm.XmlSerializer.serialize(system) for system in factory.iterPerturbedSystems(protocol, prefetch=prefetch) ] == serialized_systems
+    # Stopping iteration early must stop the background thread.
+    for system in factory.iterPerturbedSystems(protocol, prefetch=1):
+        break
+
+def test_parallel_perturbed_systems():
+    """
+    Testing perturbed systems created by worker processes are identical to those created serially
+    """
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=range(0,22), test_positions=testsystem.positions)
+    protocol = factory.defaultSolventProtocolImplicit()
+    serial_systems = factory.createPerturbedSystems(protocol)
+    parallel_systems = factory.createPerturbedSystems(protocol, n_workers=2)
+    for (serial_system, parallel_system) in zip(serial_systems, parallel_systems):
+        assert openmm.XmlSerializer.serialize(serial_system) == openmm.XmlSerializer.serialize(parallel_system)
+    # Workers check the energy of each system against the reference system for the test positions.
+    parallel_systems = list(factory.iterPerturbedSystems(protocol, n_workers=2))
+    for (serial_system, parallel_system) in zip(serial_systems, parallel_systems):
+        assert openmm.XmlSerializer.serialize(serial_system) == openmm.XmlSerializer.serialize(parallel_system)
+    # Workers receive the factory in pickled form, which must reproduce all of its options.
+    import pickle
+    pickled_factory = pickle.loads(pickle.dumps(factory, protocol=2))
+    assert sorted(pickled_factory.__dict__) == sorted(factory.__dict__)
+    for alchemical_state in protocol[:3]:
+        assert openmm.XmlSerializer.serialize(pickled_factory.createPerturbedSystem(alchemical_state)) == openmm.XmlSerializer.serialize(factory.createPerturbedSystem(alchemical_state))
+
+def test_template_cache():
+    """
+    Testing on-disk cache of alchemically-modified template systems
+    """
+    import tempfile, shutil
+    from alchemy import AlchemicalTemplateCache
+    directory = tempfile.mkdtemp()
+    try:
+        testsystem = testsystems.AlanineDipeptideImplicit()
+        cache = AlchemicalTemplateCache(directory)
+        factory_args = { 'ligand_atoms' : range(0,6), 'alchemical_torsions' : True, 'alchemical_angles' : True }
+        factory = AbsoluteAlchemicalFactory(testsystem.system, cache=cache, **factory_args)
+        cached_factory = AbsoluteAlchemicalFactory(testsystem.system, cache=cache, **factory_args)
+        assert cache.statistics()['hits'] == 1 and cache.statistics()['misses'] == 1
+        assert cached_factory.cache_key == factory.cache_key
+        assert cached_factory.alchemical_torsions == factory.alchemical_torsions
+        assert openmm.XmlSerializer.serialize(cached_factory.alchemically_modified_system) == openmm.XmlSerializer.serialize(factory.alchemically_modified_system)
+        # Changing any factory argument must change the key.
+        other_factory = AbsoluteAlchemicalFactory(testsystem.system, cache=cache, softcore_alpha=0.4, **factory_args)
+        assert other_factory.cache_key != factory.cache_key
+        assert cache.statistics()['entries'] == 2
+        # Explicit invalidation and size-bounded eviction.
+        cache.invalidate(factory.cache_key)
+        assert cache.statistics()['entries'] == 1
+        cache.max_size = 0
+        AbsoluteAlchemicalFactory(testsystem.system, cache=cache, **factory_args)
+        assert cache.statistics()['entries'] == 1
+        cache.invalidate()
+        assert cache.statistics()['entries'] == 0
+        # Parameters depending on the alchemical region are cached, so cached factories change the region without a rebuild.
+        cache.max_size = 1024**3
+        factory_args['alchemical_region_capacity'] = range(0,14)
+        factories = [ AbsoluteAlchemicalFactory(testsystem.system, cache=cache, **factory_args) for index in range(2) ]
+        assert cache.statistics()['hits'] == 2
+        assert len(factories[1]._region_terms) == len(factories[0]._region_terms)
+        alchemical_state = AlchemicalState(lambda_electrostatics=0.5, lambda_sterics=0.5, lambda_torsions=0.5, lambda_angles=0.5)
+        platform = openmm.Platform.getPlatformByName('Reference')
+        energies = list()
+        for factory in factories:
+            context = openmm.Context(factory.createPerturbedSystem(alchemical_state), openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+            context.setPositions(testsystem.positions)
+            context = factory.updateAlchemicalRegion(context, range(6,12))
+            energies.append(context.getState(getEnergy=True).getPotentialEnergy())
+        assert abs(energies[0] - energies[1]) < 1.0e-6 * unit.kilojoules_per_mole
+    finally:
+        shutil.rmtree(directory)
+
+def test_update_alchemical_region():
+    """
+    Testing changing the alchemical region of an existing Context
+    """
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    factory_args = { 'annihilate_sterics' : True, 'alchemical_torsions' : True, 'alchemical_angles' : True, 'alchemical_bonds' : True }
+    alchemical_state = AlchemicalState(lambda_electrostatics=0.3, lambda_sterics=0.6, lambda_torsions=0.4, lambda_angles=0.7, lambda_bonds=0.8)
+    platform = openmm.Platform.getPlatformByName('Reference')
+    def compute_context_energy(context):
+        return context.getState(getEnergy=True).getPotentialEnergy() / unit.kilojoules_per_mole
+    def compute_reference_energy(ligand_atoms):
+        factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=ligand_atoms, **factory_args)
+        context = openmm.Context(factory.createPerturbedSystem(alchemical_state), openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+        context.setPositions(positions)
+        return compute_context_energy(context)
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6), alchemical_region_capacity=range(0,14), **factory_args)
+    context = openmm.Context(factory.createPerturbedSystem(alchemical_state), openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+    context.setPositions(positions)
+    assert abs(compute_context_energy(context) - compute_reference_energy(range(0,6))) < 1.0e-4
+    # Changing the region within the capacity updates the existing Context.
+    assert factory.checkAlchemicalRegionChange(range(6,12)) is None
+    updated_context = factory.updateAlchemicalRegion(context, range(6,12))
+    assert updated_context is context
+    assert abs(compute_context_energy(context) - compute_reference_energy(range(6,12))) < 1.0e-4
+    # Growing the region beyond the capacity requires a rebuild.
+    assert factory.checkAlchemicalRegionChange(range(10,16)) is not None
+    updated_context = factory.updateAlchemicalRegion(context, range(10,16))
+    assert updated_context is not context
+    assert abs(compute_context_energy(updated_context) - compute_reference_energy(range(10,16))) < 1.0e-4
+
+def test_alchemical_regions():
+    """
+    Testing independently controlled named alchemical regions
+    """
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    platform = openmm.Platform.getPlatformByName('Reference')
+    def compute_energy(factory, alchemical_state):
+        context = openmm.Context(factory.createPerturbedSystem(alchemical_state), openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+        context.setPositions(positions)
+        return context.getState(getEnergy=True).getPotentialEnergy() / unit.kilojoules_per_mole
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6), alchemical_regions={ 'solute' : range(10,16) })
+    # The ligand lambdas leave the named region fully interacting.
+    alchemical_state = AlchemicalState(lambda_electrostatics=0.3, lambda_sterics=0.6)
+    reference_factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6))
+    assert abs(compute_energy(factory, alchemical_state) - compute_energy(reference_factory, alchemical_state)) < 1.0e-4
+    # The region lambdas leave the ligand fully interacting.
+    region_state = AlchemicalState(lambda_electrostatics_solute=0.3, lambda_sterics_solute=0.6)
+    reference_factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(10,16))
+    assert abs(compute_energy(factory, region_state) - compute_energy(reference_factory, alchemical_state)) < 1.0e-4
+
+def test_context_cache():
+    """
+    Testing reuse of cached Contexts for systems that differ only in alchemical parameters
+    """
+    from alchemy import ContextCache
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    platform = openmm.Platform.getPlatformByName('Reference')
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6))
+    cache = ContextCache(capacity=2)
+    for lambda_value in [1.0, 0.5, 0.0]:
+        alchemical_system = factory.createPerturbedSystem(AlchemicalState(lambda_electrostatics=lambda_value, lambda_sterics=lambda_value))
+        context = cache.getContext(alchemical_system, platform)
+        context.setPositions(positions)
+        cached_potential = context.getState(getEnergy=True).getPotentialEnergy()
+        potential = compute_energy(alchemical_system, positions, platform=platform)
+        assert abs(cached_potential - potential) < MAX_DELTA
+    assert cache.statistics()['misses'] == 1
+    assert cache.statistics()['hits'] == 2
+    # Different systems and platform properties create new Contexts, evicting the least recently used.
+    cache.getContext(reference_system, platform)
+    cache.getContext(alchemical_system, openmm.Platform.getPlatformByName('CPU'))
+    statistics = cache.statistics()
+    assert (statistics['misses'] == 3) and (statistics['entries'] == 2)
+    # Other threads get their own Contexts.
+    contexts = list()
+    thread = threading.Thread(target=lambda: contexts.append(cache.getContext(alchemical_system, platform)))
+    thread.start()
+    thread.join()
+    assert (cache.statistics()['misses'] == 4) and (contexts[0] is not cache.getContext(alchemical_system, platform))
+    # Contexts of threads that have exited are dropped when another Context is cached.
+    assert all(thread_ident == threading.current_thread().ident for (thread_ident, key) in cache._entries)
+    # Platform properties distinguish Contexts even if the platform is not specified.
+    assert ContextCache.fingerprint(alchemical_system, None, { 'Threads' : '1' }) != ContextCache.fingerprint(alchemical_system)
+
+def test_reduced_potentials():
+    """
+    Testing batched computation of reduced potentials for all alchemical states
+    """
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    platform = openmm.Platform.getPlatformByName('Reference')
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6))
+    alchemical_states = factory.defaultComplexProtocolImplicit()
+    temperature = 300.0 * unit.kelvin
+    # Generate a short trajectory.
+    integrator = openmm.LangevinIntegrator(temperature, 5.0 / unit.picoseconds, 1.0 * unit.femtoseconds)
+    context = openmm.Context(reference_system, integrator, platform)
+    context.setPositions(positions)
+    trajectory = list()
+    for iteration in range(5):
+        integrator.step(10)
+        trajectory.append(context.getState(getPositions=True).getPositions(asNumpy=True))
+    del context, integrator
+    # Compare with energies of the individual perturbed systems, streaming results in chunks.
+    u_kn = np.zeros([len(alchemical_states), len(trajectory)], np.float64)
+    factory.computeReducedPotentials(alchemical_states, iter(trajectory), temperature=temperature, platform=platform, chunk_size=2, out=u_kn)
+    kT = kB * temperature
+    for (state_index, alchemical_state) in enumerate(alchemical_states):
+        alchemical_system = factory.createPerturbedSystem(alchemical_state)
+        for (frame_index, frame_positions) in enumerate(trajectory):
+            reduced_potential = compute_energy(alchemical_system, frame_positions, platform=platform) / kT
+            assert abs(u_kn[state_index, frame_index] - reduced_potential) < 1.0e-6
+    # Worker threads, each with its own Context, produce the same results.
+    threaded_u_kn = factory.computeReducedPotentials(alchemical_states, trajectory, temperature=temperature, platform=platform, n_threads=3)
+    assert np.allclose(threaded_u_kn, u_kn, rtol=0.0, atol=1.0e-6)
+
+def test_endpoint_systems():
+    """
+    Testing evaluation of endpoint states with native forces only
+    """
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    platform = openmm.Platform.getPlatformByName('Reference')
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6), annihilate_sterics=True)
+    alchemical_states = [ AlchemicalState(), AlchemicalState(lambda_electrostatics=0.5, lambda_sterics=1.0), AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.0) ]
+    assert [ factory.getEndpointKind(alchemical_state) for alchemical_state in alchemical_states ] == ['fully_interacting', None, 'decoupled']
+    for alchemical_state in [alchemical_states[0], alchemical_states[2]]:
+        energy_error = factory.checkEndpointConsistency(alchemical_state, positions, platform=platform)
+        assert abs(energy_error / unit.kilojoules_per_mole) < 1.0e-6
+    # Endpoint states are routed to the endpoint systems without changing reduced potentials.
+    u_kn = factory.computeReducedPotentials(alchemical_states, [positions], platform=platform)
+    endpoint_u_kn = factory.computeReducedPotentials(alchemical_states, [positions], platform=platform, use_endpoint_systems=True)
+    assert np.allclose(u_kn, endpoint_u_kn, rtol=0.0, atol=1.0e-6)
+    # The surface area term of a GBSAOBCForce has no native decoupled equivalent.
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=range(0,6))
+    assert factory.getEndpointKind(alchemical_states[2]) is None
+
+def test_native_electrostatics():
+    """
+    Testing linear electrostatics scaling with native NonbondedForce and GBSAOBCForce charges
+    """
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    platform = openmm.Platform.getPlatformByName('Reference')
+    ligand_atoms = range(0,6)
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=ligand_atoms, annihilate_sterics=True, softcore_beta=0.0, native_electrostatics=True)
+    force_names = [ force.__class__.__name__ for force in factory.alchemically_modified_system.getForces() ]
+    assert ('NonbondedForce' in force_names) and ('GBSAOBCForce' in force_names) and ('CustomGBForce' not in force_names)
+    assert force_names.count('CustomNonbondedForce') == 1
+    # The fully interacting state reproduces the reference system.
+    reference_energy = compute_energy(reference_system, positions, platform=platform)
+    alchemical_energy = compute_energy(factory.createPerturbedSystem(), positions, platform=platform)
+    assert abs(alchemical_energy - reference_energy) < 1.0e-6 * unit.kilojoules_per_mole
+    # Intermediate states scale the charges of alchemical atoms in the native forces.
+    lambda_electrostatics = 0.4
+    alchemical_state = AlchemicalState(lambda_electrostatics=lambda_electrostatics)
+    scaled_system = copy.deepcopy(reference_system)
+    for force in scaled_system.getForces():
+        if isinstance(force, (openmm.NonbondedForce, openmm.GBSAOBCForce)):
+            for particle_index in ligand_atoms:
+                parameters = force.getParticleParameters(particle_index)
+                force.setParticleParameters(particle_index, lambda_electrostatics * parameters[0], *parameters[1:])
+        if isinstance(force, openmm.NonbondedForce):
+            # Exceptions are scaled by lambda_electrostatics for each alchemical atom.
+            boundary_exceptions = 0
+            for exception_index in range(force.getNumExceptions()):
+                [particle1, particle2, chargeprod, sigma, epsilon] = force.getExceptionParameters(exception_index)
+                nalchemical = (particle1 in ligand_atoms) + (particle2 in ligand_atoms)
+                force.setExceptionParameters(exception_index, particle1, particle2, lambda_electrostatics**nalchemical * chargeprod, sigma, epsilon)
+                if (nalchemical == 1) and (chargeprod / chargeprod.unit != 0.0):
+                    boundary_exceptions += 1
+            assert boundary_exceptions > 0
+    scaled_energy = compute_energy(scaled_system, positions, platform=platform)
+    for annihilate_sterics in [True, False]:
+        sterics_factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=ligand_atoms, annihilate_sterics=annihilate_sterics, softcore_beta=0.0, native_electrostatics=True)
+        alchemical_energy = compute_energy(sterics_factory.createPerturbedSystem(alchemical_state), positions, platform=platform)
+        assert abs(alchemical_energy - scaled_energy) < 1.0e-6 * unit.kilojoules_per_mole, "annihilate_sterics=%s" % annihilate_sterics
+    # Contexts are perturbed by updating the parameters of the native forces.
+    context = openmm.Context(factory.createPerturbedSystem(), openmm.VerletIntegrator(1.0 * unit.femtoseconds), platform)
+    context.setPositions(positions)
+    factory.perturbNativeContext(context, alchemical_state)
+    context_energy = context.getState(getEnergy=True).getPotentialEnergy()
+    assert abs(context_energy - scaled_energy) < 1.0e-6 * unit.kilojoules_per_mole
+    # perturbContext cannot scale native charges.
+    error_message = None
+    try:
+        factory.perturbContext(context, AlchemicalState())
+    except Exception as e:
+        error_message = str(e)
+    assert (error_message is not None) and ('perturbNativeContext' in error_message)
+    factory.perturbNativeContext(context, AlchemicalState())
+    context_energy = context.getState(getEnergy=True).getPotentialEnergy()
+    assert abs(context_energy - reference_energy) < 1.0e-6 * unit.kilojoules_per_mole
+    del context
+    # Reduced potentials are computed with the same charges.
+    alchemical_states = [ AlchemicalState(lambda_electrostatics=0.0, lambda_sterics=0.5), alchemical_state, AlchemicalState() ]
+    u_kn = factory.computeReducedPotentials(alchemical_states, [positions], platform=platform)
+    kT = kB * 298.0 * unit.kelvin
+    for (state_index, alchemical_state) in enumerate(alchemical_states):
+        reduced_potential = compute_energy(factory.createPerturbedSystem(alchemical_state), positions, platform=platform) / kT
+        assert abs(u_kn[state_index, 0] - reduced_potential) < 1.0e-6
+    # Worker threads scale the charges of their own Systems.
+    threaded_u_kn = factory.computeReducedPotentials(alchemical_states, [positions] * 6, platform=platform, n_threads=3)
+    assert np.allclose(threaded_u_kn, np.tile(u_kn, 6), rtol=0.0, atol=1.0e-6)
+
+def test_polynomial_lambda_decomposition():
+    """
+    Testing reconstruction of reduced potentials from energies that are polynomial in lambda
+    """
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    platform = openmm.Platform.getPlatformByName('Reference')
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6), alchemical_torsions=True, softcore_alpha=0.0, softcore_beta=0.0)
+    degrees = factory.getPolynomialLambdaDegrees()
+    assert { 'lambda_torsions' : 1 } in degrees
+    assert { 'lambda_electrostatics' : 1 } in degrees
+    assert { 'lambda_sterics' : 1 } in degrees
+    alchemical_states = [ AlchemicalState(lambda_electrostatics=lambda_value, lambda_sterics=lambda_value**2, lambda_torsions=1.0-lambda_value) for lambda_value in np.linspace(0.0, 1.0, 7) ]
+    u_kn = factory.computeReducedPotentials(alchemical_states, [positions], platform=platform)
+    decomposed_u_kn = factory.computeReducedPotentials(alchemical_states, [positions], platform=platform, polynomial_decomposition=True)
+    assert np.allclose(u_kn, decomposed_u_kn, rtol=0.0, atol=1.0e-8)
+
+def test_parameter_binding_plan():
+    """
+    Testing that perturbContext and perturbSystem only push changed parameters
+    """
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    [reference_system, positions] = [testsystem.system, testsystem.positions]
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6), alchemical_torsions=True)
+    alchemical_system = factory.createPerturbedSystem()
+    context = openmm.Context(alchemical_system, openmm.VerletIntegrator(1.0 * unit.femtoseconds), openmm.Platform.getPlatformByName('Reference'))
+    alchemical_state = AlchemicalState(lambda_electrostatics=0.5)
+    AbsoluteAlchemicalFactory.perturbContext(context, alchemical_state)
+    plan = AbsoluteAlchemicalFactory.getParameterBindingPlan(context)
+    assert context.getParameter('lambda_electrostatics') == 0.5
+    # Only lambda_sterics changes; lambda_restraints is not present in the Context.
+    alchemical_state['lambda_sterics'] = 0.5
+    [applied, skipped] = [plan.applied, plan.skipped]
+    AbsoluteAlchemicalFactory.perturbContext(context, alchemical_state)
+    assert (plan.applied == applied + 1) and (plan.skipped == skipped + len(plan.parameters.intersection(alchemical_state.keys())) - 1)
+    assert context.getParameter('lambda_sterics') == 0.5
+    # Parameters changed outside the plan are pushed again.
+    context.setParameter('lambda_sterics', 1.0)
+    AbsoluteAlchemicalFactory.perturbContext(context, alchemical_state)
+    assert (plan.applied == applied + 2) and (context.getParameter('lambda_sterics') == 0.5)
+    context.reinitialize()
+    AbsoluteAlchemicalFactory.perturbContext(context, alchemical_state)
+    assert (context.getParameter('lambda_sterics') == 0.5) and (context.getParameter('lambda_electrostatics') == 0.5)
+    error_message = None
+    try:
+        AbsoluteAlchemicalFactory.perturbContext(context, alchemical_state, use_all_parameters=True)
+    except Exception as e:
+        error_message = str(e)
+    assert (error_message is not None) and ('lambda_restraints' in error_message)
+    # Systems are perturbed by setting default values.
+    AbsoluteAlchemicalFactory.perturbSystem(alchemical_system, alchemical_state)
+    for force in alchemical_system.getForces():
+        if hasattr(force, 'getNumGlobalParameters'):
+            for index in range(force.getNumGlobalParameters()):
+                if force.getGlobalParameterName(index) == 'lambda_sterics':
+                    assert force.getGlobalParameterDefaultValue(index) == 0.5
+
+def test_nonfinite_energy_diagnostics():
+    """
+    Testing identification of the terms responsible for non-finite energies
+    """
+    from alchemy import NonFiniteEnergyError
+    testsystem = testsystems.AlanineDipeptideVacuum()
+    [reference_system, positions] = [testsystem.system, copy.deepcopy(testsystem.positions)]
+    factory = AbsoluteAlchemicalFactory(reference_system, ligand_atoms=range(0,6))
+    # Place an alchemical atom on top of a nonbonded environment atom.
+    positions[0] = positions[15]
+    report = None
+    try:
+        factory._checkEnergyIsFinite(factory.alchemically_modified_system, positions)
+    except NonFiniteEnergyError as e:
+        report = e.report
+    assert report is not None
+    assert len(report['force_energies']) == factory.alchemically_modified_system.getNumForces()
+    custom_nonbonded_terms = [ term for term in report['nonfinite_terms'] if term['force_class'] == 'CustomNonbondedForce' ]
+    assert len(custom_nonbonded_terms) > 0
+    for term in custom_nonbonded_terms:
+        assert term['particles'] == (0, 15)
+    # Collapse an angle.
+    positions = copy.deepcopy(testsystem.positions)
+    positions[5] = positions[4]
+    report = AbsoluteAlchemicalFactory.diagnoseNonFiniteEnergy(factory.alchemically_modified_system, positions)
+    angle_terms = [ term for term in report['nonfinite_terms'] if term['force_class'] == 'HarmonicAngleForce' ]
+    assert (len(angle_terms) == 1) and (set([4, 5]) <= set(angle_terms[0]['particles']))
+    # Forces without particles or terms cannot be bisected.
+    from alchemy.alchemy import _split_serialized_system, _serialize_force_element, _bisect_nonfinite_pairs, _bisect_nonfinite_terms
+    (root, forces) = _split_serialized_system(openmm.XmlSerializer.serialize(openmm.System()))
+    assert _bisect_nonfinite_pairs(root, openmm.CustomNonbondedForce('r'), []) is None
+    assert _bisect_nonfinite_terms(root, _serialize_force_element(openmm.HarmonicBondForce()), []) is None
+
 #=============================================================================================
 # NOSETEST GENERATORS
 #=============================================================================================
 
+benchmark_testsystem_names = [
+    'Lennard-Jones fluid without dispersion correction',
+    'TIP3P with reaction field, switch, no dispersion correction',
+    'T4 lysozyme L99A with p-xylene in OBC GBSA',
+]
+
+@attr('slow')
+def test_benchmark_factory_options():
+    """
+    Generate nose tests benchmarking each value of the factory options in equivalent_option_values.
+    """
+    benchmarked_options = list()
+    for (option, values, names, factory_args, absolute_tolerance, relative_tolerance) in equivalent_option_values:
+        if option in benchmarked_options: continue
+        benchmarked_options.append(option)
+        for name in benchmark_testsystem_names:
+            test_system = test_systems[name]
+            reference_system = test_system['test'].system
+            positions = test_system['test'].positions
+            for value in values:
+                benchmark_args = dict(test_system['factory_args'], **factory_args)
+                benchmark_args[option] = value
+                f = partial(benchmark, reference_system, positions, factory_args=benchmark_args)
+                f.description = "Benchmarking %s=%s for %s..." % (option, str(value), name)
+                yield f
+
+def test_equivalent_option_values():
+    """
+    Generate nose tests checking that equivalent values of factory options produce identical energies.
+    """
+    for (option, values, names, factory_args, absolute_tolerance, relative_tolerance) in equivalent_option_values:
+        for name in names:
+            test_system = test_systems[name]
+            reference_system = test_system['test'].system
+            positions = test_system['test'].positions
+            f = partial(compare_option_values, reference_system, positions, option, values, factory_args=dict(test_system['factory_args'], **factory_args), absolute_tolerance=absolute_tolerance, relative_tolerance=relative_tolerance)
+            f.description = "Comparing %s=%s for %s..." % (option, ' and '.join([ str(value) for value in values ]), name)
+            yield f
+
 @attr('slow')
 def test_overlap():
     """